@@ -20,6 +20,7 @@
 #include <sstream>
 #include <cmath>
 #include <stdlib.h>
+#include <memory>
 
 inline double radian_to_angle(double radian)
 {
@@ -119,6 +120,20 @@ vector<set<int>> BasicSimulator::decompose(const igraph_t* g) {
     return results;
 }
 
+vector<int> BasicSimulator::serial_order(const igraph_t* g, igraph_vector_t *vs_res)
+{
+    vector<set<int>> complist = decompose(g);
+    vector<int> vids;
+    for (size_t i = 0; i < complist.size(); i++) {
+        for (int j = 0; j < igraph_vector_size(vs_res); j++) {
+            int vid = VECTOR(*vs_res)[j];
+            if (complist[i].find(vid) != complist[i].end()) {
+                vids.push_back(vid);
+            }
+        }
+    }
+    return vids;
+}
 
 inline void append_I_gate(vector<vector<gate_unit>> & time_list, size_t qubit, int timeslot, int last)
 {
@@ -242,7 +257,8 @@ inline size_t BasicSimulator::add_element(const igraph_t *g,
                                  igraph_integer_t vid, 
                                  unordered_map<int, size_t> & qreg_map,
                                  unordered_map<int, size_t> & creg_map,
-                                 vector<vector<gate_unit>> & time_list) 
+                                 vector<vector<gate_unit>> & time_list,
+                                 vector<param_slot> *slots) 
 {
     igraph_es_t es;
     igraph_vector_t qubit_res;
@@ -300,6 +316,9 @@ inline size_t BasicSimulator::add_element(const igraph_t *g,
         if (igraph_vector_size(&params_res) > 0) {
             double angle = radian_to_angle(VECTOR(params_res)[0]);
             gate_time_slot = append_to_timelist(time_list, gate_name, {qb0}, {angle}, cond); 
+            if (slots != nullptr) {
+                slots->push_back(param_slot{qb0, gate_time_slot, vector<int>{(int)vid}});
+            }
         } else {
             gate_time_slot = append_to_timelist(time_list, gate_name, {qb0}, {}, cond);
         }
@@ -334,7 +353,9 @@ inline size_t BasicSimulator::expand_caller(const igraph_t *g,
                                  const condition & cond,
                                  unordered_map<int, size_t> & qreg_map,
                                  unordered_map<int, size_t> & creg_map,
-                                 vector<vector<gate_unit>> & time_list)
+                                 vector<vector<gate_unit>> & time_list,
+                                 vector<param_slot> *slots,
+                                 vector<int> & path)
 {
     size_t max_time_slot = 0;
 
@@ -355,6 +376,7 @@ inline size_t BasicSimulator::expand_caller(const igraph_t *g,
     
     for (i = 0; i < igraph_vector_size(&callees); i++) {
         igraph_integer_t callee = VECTOR(callees)[ (long int)i ];
+        path.push_back((int)callee);
         
         get_string_vertex_attr(g, node_name_attr, callee, &callee_name);
 
@@ -399,7 +421,8 @@ inline size_t BasicSimulator::expand_caller(const igraph_t *g,
         igraph_real_t type = node_type_callee;
         get_numeric_vertex_attr(g, node_type_attr, callee, &type);
         if (((igraph_integer_t)type) == node_type_caller) {
-            gate_time_slot = expand_caller(g, callee_name, &qubit_list, &param_list, callee_cond, qreg_map, creg_map, time_list);
+            gate_time_slot = expand_caller(g, callee_name, &qubit_list, &param_list, callee_cond, qreg_map, creg_map, time_list,
+                                           slots, path);
         } else {
             int ori_qubit0 = (int)VECTOR(qubit_list)[0];
             size_t qb0 = qreg_map[ori_qubit0];
@@ -407,6 +430,9 @@ inline size_t BasicSimulator::expand_caller(const igraph_t *g,
                 if (igraph_vector_size(&param_list) > 0) {
                     double angle = radian_to_angle(VECTOR(param_list)[0]);
                     gate_time_slot = append_to_timelist(time_list, callee_name, {qb0}, {angle}, callee_cond);
+                    if (slots != nullptr) {
+                        slots->push_back(param_slot{qb0, gate_time_slot, path});
+                    }
                 } else {
                     gate_time_slot = append_to_timelist(time_list, callee_name, {qb0}, {}, callee_cond);
                 }
@@ -428,6 +454,7 @@ inline size_t BasicSimulator::expand_caller(const igraph_t *g,
             max_time_slot = gate_time_slot;
         }
 
+        path.pop_back();
         free(callee_name);
         igraph_es_destroy(&callee_es);
         igraph_vector_destroy(&qindex_list);
@@ -439,10 +466,12 @@ inline size_t BasicSimulator::expand_caller(const igraph_t *g,
     return max_time_slot;
 } 
 
-circuit BasicSimulator::translate(const igraph_t *g, vector<int> & component, int qnum, int cnum) 
+size_t BasicSimulator::build_time_list(const igraph_t *g, vector<int> & component, vector<vector<gate_unit>> & time_list,
+                                       vector<param_slot> *slots) 
 {
-    vector<vector<gate_unit>> time_list(qnum, vector<gate_unit>());
     size_t max_time_slot = 0;
+    // The caller and callee vertices from the top level caller to the current callee
+    vector<int> path;
     
     size_t qcounter = 0;
     size_t ccounter = 0;
@@ -475,7 +504,7 @@ circuit BasicSimulator::translate(const igraph_t *g, vector<int> & component, in
         
         int gate_time_slot = 0;
         if (((igraph_integer_t)type) == node_type_op) 
-            gate_time_slot = add_element(g, vid, qreg_map, creg_map, time_list); 
+            gate_time_slot = add_element(g, vid, qreg_map, creg_map, time_list, slots); 
         else if (((igraph_integer_t)type) == node_type_caller) {
             igraph_es_t es;
             igraph_vector_t qubit_res;
@@ -505,7 +534,10 @@ circuit BasicSimulator::translate(const igraph_t *g, vector<int> & component, in
                 }
             }
 
-            gate_time_slot = expand_caller(g, gate_name, &qubit_res, &params_res, cond, qreg_map, creg_map, time_list);
+            path.assign(1, vid);
+            gate_time_slot = expand_caller(g, gate_name, &qubit_res, &params_res, cond, qreg_map, creg_map, time_list,
+                                           slots, path);
+            path.clear();
             free(gate_name);
             igraph_es_destroy(&es);
             igraph_vector_destroy(&qubit_res);
@@ -515,6 +547,11 @@ circuit BasicSimulator::translate(const igraph_t *g, vector<int> & component, in
         if (gate_time_slot > max_time_slot) max_time_slot = gate_time_slot;
     }
 
+    return max_time_slot;
+}
+
+circuit BasicSimulator::assemble_circuit(const vector<vector<gate_unit>> & time_list, size_t max_time_slot, int qnum, int cnum)
+{
     vector<circuit_unit> circuits;
     
     set<int> measured_qubits;
@@ -523,7 +560,7 @@ circuit BasicSimulator::translate(const igraph_t *g, vector<int> & component, in
         for (int q = 0; q < qnum; q++) {
             if (measured_qubits.find(q) != measured_qubits.end()) {
                     if (t < time_list[q].size()) {
-                        gate_unit& gu = time_list[q][t];        
+                        const gate_unit& gu = time_list[q][t];        
                         if (gu.getGateIndex() != I) {
                             string msg = "Qubit ";
                             msg += std::to_string(q);
@@ -534,7 +571,7 @@ circuit BasicSimulator::translate(const igraph_t *g, vector<int> & component, in
                     continue;
             }
             if (t < time_list[q].size()) {
-                gate_unit& gu = time_list[q][t];          
+                const gate_unit& gu = time_list[q][t];          
                 if (gu.getGateIndex() != INVALID_GATE){
                     cunit.push_back(gu); 
                 }
@@ -553,7 +590,47 @@ circuit BasicSimulator::translate(const igraph_t *g, vector<int> & component, in
     return circ;
 }
 
-vector<double> BasicSimulator::simulate(const igraph_t *g, vector<int>& component, int qnum, int cnum, vector<StateType>& state, bool verbose)
+circuit BasicSimulator::translate(const igraph_t *g, vector<int> & component, int qnum, int cnum) 
+{
+    vector<vector<gate_unit>> time_list(qnum, vector<gate_unit>());
+    size_t max_time_slot = build_time_list(g, component, time_list);
+    return assemble_circuit(time_list, max_time_slot, qnum, cnum);
+}
+
+int BasicSimulator::num_threads_of(py::dict config)
+{
+    if (!config.contains("num_threads")) {
+        return -1;
+    }
+    py::object tobj = config["num_threads"];
+    if (tobj.is_none()) {
+        return 0;
+    }
+    return tobj.cast<int>();
+}
+
+vector<double> BasicSimulator::run_circuit(const circuit & circ, int qnum, int num_threads, vector<StateType> & state)
+{
+    // The circuit does not touch any python object, let the other python threads run meanwhile.
+    std::unique_ptr<py::gil_scoped_release> release;
+    if (PyGILState_Check()) {
+        release.reset(new py::gil_scoped_release());
+    }
+
+    if (num_threads >= 0 && qnum > 0 && parallel_state::supports(circ)) {
+        parallel_state ps(qnum, num_threads);
+        ps.execute(circ);
+        state = ps.getStateVector();
+        return ps.getProbabilities();
+    }
+
+    state_manager mgr;
+    mgr.execute_inplace(circ);
+    state = mgr.getStateVector();
+    return mgr.getProbabilities();
+}
+
+vector<double> BasicSimulator::simulate(const igraph_t *g, vector<int>& component, int qnum, int cnum, vector<StateType>& state, bool verbose, int num_threads)
 {
     circuit circ = translate(g, component, qnum, cnum);
     if (verbose) {
@@ -561,12 +638,7 @@ vector<double> BasicSimulator::simulate(const igraph_t *g, vector<int>& componen
         cout << cc << endl;
     }
     
-    state_manager mgr;
-    mgr.execute_inplace(circ);
-    vector<double> ps = mgr.getProbabilities();
-    state = mgr.getStateVector();
-
-    return ps;
+    return run_circuit(circ, qnum, num_threads, state);
 }
 
 /*
@@ -608,4 +680,96 @@ map<string, double> BasicSimulator::pack_probabilities(const vector<double>& pro
     }
     
     return prob_map;
-}
\ No newline at end of file
+}
+
+Result BasicSimulator::pack_result(vector<double> & probabilities, vector<StateType> & states, py::dict config)
+{
+    Result re;
+    int shots = 1024;
+    if (config.contains("shots")) {
+        py::object sobj = config["shots"];
+        shots = sobj.cast<int>();
+    }
+    set<int> bitpos;
+    if (config.contains("mqubits")) {
+        py::list mlist = config["mqubits"];
+        for (auto item: mlist) bitpos.insert(item.cast<int>());
+    }
+    
+    re.probabilities = std::move(pack_probabilities(probabilities, bitpos));
+    re.states = std::move(states);
+    re.shots = shots;
+    return re;
+}
+
+PreparedCircuit BasicSimulator::prepare(py::capsule graph, py::dict config)
+{
+    igraph_t *gptr = (igraph_t *)graph.get_pointer();
+    igraph_vector_t vs_res;
+    igraph_vector_init(&vs_res, 0);
+    igraph_topological_sorting(gptr, &vs_res, IGRAPH_OUT);
+    vector<int> vids = serial_order(gptr, &vs_res);
+    igraph_vector_destroy(&vs_res);
+
+    int qnum = get_numeric_graph_attr(gptr, qubit_num_attr);
+    int cnum = get_numeric_graph_attr(gptr, clbit_num_attr);
+
+    vector<vector<gate_unit>> time_list(qnum, vector<gate_unit>());
+    vector<param_slot> slots;
+    size_t max_time_slot = build_time_list(gptr, vids, time_list, &slots);
+
+    return PreparedCircuit(std::move(time_list), std::move(slots), max_time_slot, qnum, cnum);
+}
+
+PreparedCircuit::PreparedCircuit() : m_max_time_slot(0), m_qnum(0), m_cnum(0) {
+}
+
+PreparedCircuit::PreparedCircuit(vector<vector<gate_unit>> && time_list, vector<param_slot> && slots,
+                                 size_t max_time_slot, int qnum, int cnum)
+    : m_time_list(std::move(time_list)), m_slots(std::move(slots)),
+      m_max_time_slot(max_time_slot), m_qnum(qnum), m_cnum(cnum) {
+}
+
+PreparedCircuit::~PreparedCircuit() {
+}
+
+py::list PreparedCircuit::parameter_paths() const
+{
+    py::list paths;
+    for (const param_slot & slot : m_slots) {
+        py::tuple path(slot.path.size());
+        for (size_t i = 0; i < slot.path.size(); i++) {
+            path[i] = py::int_(slot.path[i]);
+        }
+        paths.append(path);
+    }
+    return paths;
+}
+
+Result PreparedCircuit::execute(py::array_t<double, py::array::c_style | py::array::forcecast> angles, py::dict config)
+{
+    auto buf = angles.unchecked<1>();
+    if ((size_t)buf.shape(0) != m_slots.size()) {
+        throw std::runtime_error("The number of angles does not match the parameterized gates.");
+    }
+
+    for (size_t i = 0; i < m_slots.size(); i++) {
+        const param_slot & slot = m_slots[i];
+        gate_unit & old = m_time_list[slot.qubit][slot.timeslot];
+        gate_unit g(old.getGateName(), slot.qubit, radian_to_angle(buf(i)));
+        if (old.hasCondition()) {
+            g.setCondition(old.getCondition());
+        }
+        old = g;
+    }
+
+    circuit circ = BasicSimulator::assemble_circuit(m_time_list, m_max_time_slot, m_qnum, m_cnum);
+    if (config.contains("print_circuit") && config["print_circuit"].cast<bool>()) {
+        cout << circ.toJSON() << endl;
+    }
+
+    vector<StateType> sv;
+    vector<double> ps = BasicSimulator::run_circuit(circ, m_qnum, BasicSimulator::num_threads_of(config), sv);
+
+    return BasicSimulator::pack_result(ps, sv, config);
+}
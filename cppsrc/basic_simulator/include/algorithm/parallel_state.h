@@ -0,0 +1,75 @@
+/**
+ * Copyright 2023 SpinQ Technology Co., Ltd.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+#ifndef _PARALLEL_STATE_H_
+#define _PARALLEL_STATE_H_
+
+#include "../utilities/circuit.h"
+#include "../utilities/gates.h"
+
+#include <vector>
+#include <complex>
+using namespace std;
+
+/*
+ * One gate prepared for the kernels. The gate acts on the pairs of amplitudes which differ
+ * in the target bit and have all the control bits set.
+ */
+struct kernel_op {
+    bool           diagonal;
+    size_t         target_bit;
+    size_t         control_mask;
+    vector<size_t> zero_bits;   // the target and control bits in ascending order
+    StateType      m[4];
+};
+
+/*
+ * A state vector in one contiguous aligned buffer. The gates are applied with OpenMP,
+ * consecutive gates on the low qubits are applied block by block so that each block
+ * stays in the cache for the whole run of gates.
+ * Qubit 0 is the most significant bit of the amplitude index, the same as state_manager.
+ */
+class parallel_state {
+public:
+    parallel_state(size_t qubit_num, int num_threads);
+    ~parallel_state();
+
+    parallel_state(const parallel_state &) = delete;
+    parallel_state & operator=(const parallel_state &) = delete;
+
+    /*
+     * Only unconditional unitary gates are supported, the circuits with measurements
+     * or conditions should be executed by state_manager.
+     */
+    static bool supports(const circuit & circ);
+
+    void execute(const circuit & circ);
+    vector<StateType> getStateVector() const;
+    vector<double> getProbabilities() const;
+
+private:
+    size_t     m_qubit_num;
+    size_t     m_dim;
+    int        m_num_threads;
+    void      *m_buffer;
+    StateType *m_state;
+
+    bool to_kernel_op(const gate_unit & gate, kernel_op & op) const;
+    void apply(const kernel_op & op);
+    void apply_blocked(const vector<kernel_op> & ops);
+};
+
+#endif // _PARALLEL_STATE_H_
@@ -20,6 +20,7 @@
 #include "model/result.h"
 #include "utilities/circuit.h"
 #include "algorithm/state_manager.h"
+#include "algorithm/parallel_state.h"
 #include "utilities/gates.h"
 #include "util/constants.h"
 using namespace constants;
@@ -27,6 +28,7 @@ using namespace constants;
 #include <Python.h>
 #include <pybind11/embed.h>
 #include <pybind11/pybind11.h>
+#include <pybind11/numpy.h>
 namespace py = pybind11;
 
 #include <cstring>
@@ -47,15 +49,71 @@ extern "C" {
 #include "igraph/igraph.h"
 }
 
+/**
+ * The position of a parameterized gate in the time list, and the vertices from
+ * the top level node down to the callee that generated the gate.
+ */
+struct param_slot
+{
+    size_t qubit;
+    size_t timeslot;
+    vector<int> path;
+};
+
+/**
+ * A circuit translated once from the graph. The angles of the parameterized gates
+ * are replaced on each execution, so the graph is not traversed again.
+ */
+class PreparedCircuit
+{
+public:
+    PreparedCircuit();
+    PreparedCircuit(vector<vector<gate_unit>> && time_list, vector<param_slot> && slots,
+                    size_t max_time_slot, int qnum, int cnum);
+    ~PreparedCircuit();
+
+    size_t parameter_count() const { return m_slots.size(); }
+    py::list parameter_paths() const;
+    Result execute(py::array_t<double, py::array::c_style | py::array::forcecast> angles, py::dict config);
+
+private:
+    vector<vector<gate_unit>> m_time_list;
+    vector<param_slot> m_slots;
+    size_t m_max_time_slot;
+    int m_qnum;
+    int m_cnum;
+};
+
 class BasicSimulator
 {
 public:
     BasicSimulator();
     ~BasicSimulator();
 
+    static map<string, double> pack_probabilities(const vector<double>& probabilities, const set<int>& mqubits);
+    static Result pack_result(vector<double> & probabilities, vector<StateType> & states, py::dict config);
+    static circuit assemble_circuit(const vector<vector<gate_unit>> & time_list, size_t max_time_slot, int qnum, int cnum);
+
+    /**
+     * The number of threads for the parallel kernels, -1 when it is not configured and
+     * 0 to use all the OpenMP threads.
+     */
+    static int num_threads_of(py::dict config);
+
+    /**
+     * Run the circuit with the parallel kernels when the thread number is configured and the
+     * circuit only has unitary gates, otherwise with state_manager.
+     */
+    static vector<double> run_circuit(const circuit & circ, int qnum, int num_threads, vector<StateType> & state);
+
+    /**
+     * Translate the graph once and record the parameterized gates, the returned circuit
+     * can be executed with new angles, which are in the order of `parameter_paths`.
+     */
+    PreparedCircuit prepare(py::capsule graph, py::dict config);
+
     Result execute(py::capsule graph, py::dict config)
     {
-        Result re;
         vector<StateType> sv;
         vector<double> ps;
 
@@ -76,6 +134,8 @@ public:
             verbose = pcobj.cast<bool>();
         }
 
+        int num_threads = num_threads_of(config);
+
         if (parallel) {
             vector<set<int>> complist = decompose(gptr);
         
@@ -97,59 +157,40 @@ public:
 
                 if (qnum > 0) {
                     results.push_back(std::async(launch::async, &BasicSimulator::simulate, this, gptr, std::ref(vids), 
-                                      qnum, cnum, std::ref(sv), verbose));
+                                      qnum, cnum, std::ref(sv), verbose, num_threads));
                 }
             }
             
             //ToDo: combine the parallel results
             ps = results[0].get();
         } else {
-            vector<set<int>> complist = decompose(gptr);
-            vector<int> vids;
-            for (size_t i = 0; i < complist.size(); i++) {
-                for (int j = 0; j < igraph_vector_size(&vs_res); j++) {
-                    int vid = VECTOR(vs_res)[j];
-                    if (complist[i].find(vid) != complist[i].end()) {
-                        vids.push_back(vid);
-                    }
-                }
-            }
+            vector<int> vids = serial_order(gptr, &vs_res);
             int qnum = get_numeric_graph_attr(gptr, qubit_num_attr);
             int cnum = get_numeric_graph_attr(gptr, clbit_num_attr);
 
-            ps = std::move(simulate(gptr, vids, qnum, cnum, sv, verbose));
+            ps = std::move(simulate(gptr, vids, qnum, cnum, sv, verbose, num_threads));
         }
        
         igraph_vector_destroy(&vs_res);
-        
-        int shots = 1024;
-        if (config.contains("shots")) {
-            py::object sobj = config["shots"];
-            shots = sobj.cast<int>();
-        }
-        set<int> bitpos;
-        if (config.contains("mqubits")) {
-            py::list mlist = config["mqubits"];
-            for (auto item: mlist) bitpos.insert(item.cast<int>());
-        }
-        
-        re.probabilities = std::move(pack_probabilities(ps, bitpos));
-        re.states = std::move(sv);
-        re.shots = shots;
-        return re;
+        return pack_result(ps, sv, config);
     }
     
 private:
-    map<string, double> pack_probabilities(const vector<double>& probabilities, const set<int>& mqubits);
     vector<set<int>> decompose(const igraph_t* g);
+    vector<int> serial_order(const igraph_t* g, igraph_vector_t *vs_res);
     size_t append_to_timelist(vector<vector<gate_unit>> & time_list, const char* gate_name, const initializer_list<size_t> & qil, const initializer_list<double> & pil, const condition & cond);
     size_t add_measurement(vector<vector<gate_unit>> & time_list, const vector<size_t> & qubits, const vector<size_t> & clbits);
     size_t add_element(const igraph_t *g, igraph_integer_t vid, unordered_map<int, size_t> & qreg_map, 
-                    unordered_map<int, size_t> & creg_map, vector<vector<gate_unit>> & time_list);
+                    unordered_map<int, size_t> & creg_map, vector<vector<gate_unit>> & time_list, vector<param_slot> *slots);
     size_t expand_caller(const igraph_t *g, const char *gate_name, igraph_vector_t *qubits, igraph_vector_t *params, const condition & cond, 
-                    unordered_map<int, size_t> & qreg_map, unordered_map<int, size_t> & creg_map, vector<vector<gate_unit>> & time_list);
+                    unordered_map<int, size_t> & qreg_map, unordered_map<int, size_t> & creg_map, vector<vector<gate_unit>> & time_list,
+                    vector<param_slot> *slots, vector<int> & path);
+    // The parameterized gates are recorded in slots when it is not null, the state is kept in the arguments
+    // so that the components of a parallel execution can be translated concurrently
+    size_t build_time_list(const igraph_t *g, vector<int> & component, vector<vector<gate_unit>> & time_list,
+                    vector<param_slot> *slots = nullptr);
     circuit translate(const igraph_t *g, vector<int> & component, int qnum, int cnum);
-    vector<double> simulate(const igraph_t *g, vector<int>& component, int qnum, int cnum, vector<StateType>& state, bool verbose);
+    vector<double> simulate(const igraph_t *g, vector<int>& component, int qnum, int cnum, vector<StateType>& state, bool verbose, int num_threads);
 };
 
 
@@ -0,0 +1,274 @@
+/**
+ * Copyright 2023 SpinQ Technology Co., Ltd.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+#include "include/algorithm/parallel_state.h"
+#include <algorithm>
+#include <cstdint>
+#include <cstdlib>
+#include <new>
+#include <stdexcept>
+
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+// 2^14 amplitudes (256KB) per cache block
+static const size_t BLOCK_BITS = 14;
+// the number of amplitude pairs handled by one task
+static const size_t TASK_PAIRS = (size_t)1 << 12;
+// do not start threads for the small states
+static const size_t PARALLEL_MIN_PAIRS = (size_t)1 << 14;
+static const size_t BUFFER_ALIGNMENT = 64;
+
+static inline size_t insert_zero_bits(size_t i, const vector<size_t> & zero_bits)
+{
+    for (size_t b : zero_bits) {
+        size_t low = i & (((size_t)1 << b) - 1);
+        i = ((i >> b) << (b + 1)) | low;
+    }
+    return i;
+}
+
+/*
+ * Apply the gate to the pairs with index in [begin, end). The pair index enumerates the
+ * amplitudes with zeros at the target and control bits.
+ */
+static inline void apply_range(StateType *state, const kernel_op & op, size_t begin, size_t end)
+{
+    const size_t target = (size_t)1 << op.target_bit;
+    if (op.diagonal) {
+        const StateType d0 = op.m[0], d1 = op.m[3];
+        for (size_t i = begin; i < end; ++i) {
+            size_t i0 = insert_zero_bits(i, op.zero_bits) | op.control_mask;
+            state[i0] *= d0;
+            state[i0 | target] *= d1;
+        }
+    } else {
+        const StateType m00 = op.m[0], m01 = op.m[1], m10 = op.m[2], m11 = op.m[3];
+        for (size_t i = begin; i < end; ++i) {
+            size_t i0 = insert_zero_bits(i, op.zero_bits) | op.control_mask;
+            size_t i1 = i0 | target;
+            StateType a0 = state[i0];
+            StateType a1 = state[i1];
+            state[i0] = m00 * a0 + m01 * a1;
+            state[i1] = m10 * a0 + m11 * a1;
+        }
+    }
+}
+
+static inline int resolve_threads(int num_threads)
+{
+#ifdef _OPENMP
+    return num_threads > 0 ? num_threads : omp_get_max_threads();
+#else
+    return 1;
+#endif
+}
+
+parallel_state::parallel_state(size_t qubit_num, int num_threads)
+    : m_qubit_num(qubit_num), m_dim((size_t)1 << qubit_num), m_num_threads(resolve_threads(num_threads))
+{
+    m_buffer = std::malloc(m_dim * sizeof(StateType) + BUFFER_ALIGNMENT);
+    if (m_buffer == nullptr) {
+        throw std::bad_alloc();
+    }
+    uintptr_t addr = ((uintptr_t)m_buffer + BUFFER_ALIGNMENT - 1) & ~(uintptr_t)(BUFFER_ALIGNMENT - 1);
+    m_state = reinterpret_cast<StateType *>(addr);
+
+    const long long dim = (long long)m_dim;
+    const int threads = m_num_threads;
+    #pragma omp parallel for num_threads(threads) schedule(static) if(m_dim >= 2 * PARALLEL_MIN_PAIRS)
+    for (long long i = 0; i < dim; ++i) {
+        new (&m_state[i]) StateType(0.0, 0.0);
+    }
+    m_state[0] = StateType(1.0, 0.0);
+}
+
+parallel_state::~parallel_state()
+{
+    std::free(m_buffer);
+}
+
+bool parallel_state::supports(const circuit & circ)
+{
+    for (const circuit_unit & cu : circ.getCircuit()) {
+        for (const gate_unit & gate : cu.getCircuitUnit()) {
+            if (gate.hasCondition()) {
+                return false;
+            }
+            switch (gate.getGateIndex()) {
+            case I: case H: case X: case Y: case Z:
+            case X90: case Y90: case Z90:
+            case Rx: case Ry: case Rz: case P:
+            case S: case Sd: case T: case Td:
+            case CNOT: case YCON: case ZCON: case CCX:
+                break;
+            default:
+                return false;
+            }
+        }
+    }
+    return true;
+}
+
+/*
+ * The single qubit matrix of the gate, the target matrix for the controlled gates.
+ * The columns are read back from the gate library applied to the basis states, so the
+ * kernels follow the same conventions as state_manager. The library puts qubit 0 at
+ * the lowest bit of its local state, the control bits are set in the basis states.
+ */
+static void gate_matrix(const gate_unit & gate, size_t control_num, StateType m[4])
+{
+    const size_t qubits[3] = {0, 1, 2};
+    const size_t local_num = control_num + 1;
+    const size_t control_mask = ((size_t)1 << control_num) - 1;
+    const size_t target = (size_t)1 << control_num;
+    GATE_INDEX index = gate.getGateIndex();
+    bool rotation = (index == Rx || index == Ry || index == Rz || index == P);
+
+    for (size_t col = 0; col < 2; ++col) {
+        vector<StateType> local((size_t)1 << local_num, StateType(0.0, 0.0));
+        local[control_mask | (col ? target : 0)] = StateType(1.0, 0.0);
+        if (rotation) {
+            gates::executeGate(local, qubits, index, gate.getAngle());
+        } else {
+            gates::executeGate(local, qubits, index);
+        }
+        m[col] = local[control_mask];
+        m[2 + col] = local[control_mask | target];
+    }
+}
+
+bool parallel_state::to_kernel_op(const gate_unit & gate, kernel_op & op) const
+{
+    vector<size_t> controls;
+    size_t target = gate.getQubit();
+
+    switch (gate.getGateIndex()) {
+    case H: case X: case Y: case Z:
+    case X90: case Y90: case Z90:
+    case Rx: case Ry: case Rz: case P:
+    case S: case Sd: case T: case Td:
+        break;
+    case CNOT: case YCON: case ZCON:
+        controls.push_back(gate.getQubit());
+        target = gate.getQubit2();
+        break;
+    case CCX:
+        controls.push_back(gate.getQubit());
+        controls.push_back(gate.getQubit2());
+        target = gate.getQubit3();
+        break;
+    default:
+        return false;
+    }
+
+    gate_matrix(gate, controls.size(), op.m);
+    op.diagonal = (op.m[1] == StateType(0.0, 0.0) && op.m[2] == StateType(0.0, 0.0));
+    op.target_bit = m_qubit_num - 1 - target;
+    op.control_mask = 0;
+    op.zero_bits.assign(1, op.target_bit);
+    for (size_t c : controls) {
+        size_t bit = m_qubit_num - 1 - c;
+        op.control_mask |= (size_t)1 << bit;
+        op.zero_bits.push_back(bit);
+    }
+    std::sort(op.zero_bits.begin(), op.zero_bits.end());
+    return true;
+}
+
+void parallel_state::apply(const kernel_op & op)
+{
+    const size_t pairs = m_dim >> op.zero_bits.size();
+    const long long tasks = (long long)((pairs + TASK_PAIRS - 1) / TASK_PAIRS);
+    const int threads = m_num_threads;
+    StateType *state = m_state;
+
+    #pragma omp parallel for num_threads(threads) schedule(static) if(pairs >= PARALLEL_MIN_PAIRS)
+    for (long long t = 0; t < tasks; ++t) {
+        size_t begin = (size_t)t * TASK_PAIRS;
+        size_t end = std::min(pairs, begin + TASK_PAIRS);
+        apply_range(state, op, begin, end);
+    }
+}
+
+/*
+ * All the gates act on the bits below BLOCK_BITS, so every block of 2^BLOCK_BITS amplitudes
+ * is closed under the gates and the whole run can be applied to one block before the next.
+ */
+void parallel_state::apply_blocked(const vector<kernel_op> & ops)
+{
+    const long long blocks = (long long)(m_dim >> BLOCK_BITS);
+    const int threads = m_num_threads;
+    StateType *state = m_state;
+
+    #pragma omp parallel for num_threads(threads) schedule(static)
+    for (long long b = 0; b < blocks; ++b) {
+        for (const kernel_op & op : ops) {
+            size_t per_block = ((size_t)1 << BLOCK_BITS) >> op.zero_bits.size();
+            apply_range(state, op, (size_t)b * per_block, (size_t)(b + 1) * per_block);
+        }
+    }
+}
+
+void parallel_state::execute(const circuit & circ)
+{
+    vector<kernel_op> run;
+    auto flush = [&]() {
+        if (run.size() == 1) {
+            apply(run[0]);
+        } else if (run.size() > 1) {
+            apply_blocked(run);
+        }
+        run.clear();
+    };
+
+    for (const circuit_unit & cu : circ.getCircuit()) {
+        for (const gate_unit & gate : cu.getCircuitUnit()) {
+            if (gate.getGateIndex() == I) {
+                continue;
+            }
+            kernel_op op;
+            if (!to_kernel_op(gate, op)) {
+                throw std::runtime_error("The gate " + gate.getGateName() + " is not supported by the parallel kernels.");
+            }
+            if (m_qubit_num > BLOCK_BITS && op.zero_bits.back() < BLOCK_BITS) {
+                run.push_back(op);
+            } else {
+                flush();
+                apply(op);
+            }
+        }
+    }
+    flush();
+}
+
+vector<StateType> parallel_state::getStateVector() const
+{
+    return vector<StateType>(m_state, m_state + m_dim);
+}
+
+vector<double> parallel_state::getProbabilities() const
+{
+    vector<double> probs(m_dim);
+    const long long dim = (long long)m_dim;
+    const int threads = m_num_threads;
+    #pragma omp parallel for num_threads(threads) schedule(static) if(m_dim >= 2 * PARALLEL_MIN_PAIRS)
+    for (long long i = 0; i < dim; ++i) {
+        probs[i] = std::norm(m_state[i]);
+    }
+    return probs;
+}
@@ -23,4 +23,6 @@ from .amplitude_estimation import AmplitudeEstimation
 from .iterative_amplitude_estimation import IterativeAmplitudeEstimation
 from .ml_amplitude_estimation import MaximumLikelihoodAmplitudeEstimation
 from .qsvc import QSVC
+from .qknn import QKNN
+from .quantum_kernel import QuantumKernel
 from .coined_quantum_walk import CoinedQuantumWalk
\ No newline at end of file
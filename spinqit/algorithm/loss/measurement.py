@@ -18,6 +18,10 @@ class MeasureOp:
     Args:
         mtype: For now, we have `state`, `prob`, `count` and `expval`(For hamiltonian measurements)
         hamiltonian: Default to None, if `mtype` is `'expval'` the hamiltonian should be given.
+        pauli_mode: How a hamiltonian given as a list of pauli strings is evaluated. `'circuit'` (default)
+            appends the basis change of every pauli string and runs one circuit per term. `'state'` simulates
+            the circuit once and computes all the terms from the state vector, it is only available
+            for the `spinq` and `torch` simulator backends, the other backends raise a ValueError.
 
     Example:
         from spinqit.loss.measurement import MeasureOp
@@ -37,28 +41,37 @@ class MeasureOp:
         print(qlayer())
         # 1.5
     """
-    def __init__(self, mtype, mqubits=None, shots=None, hamiltonian=None):
+    def __init__(self, mtype, mqubits=None, shots=None, hamiltonian=None, pauli_mode='circuit'):
+        if pauli_mode not in ['circuit', 'state']:
+            raise ValueError(
+                f'The pauli_mode should be `circuit` or `state`, but got {pauli_mode}'
+            )
         self.mtype = mtype
         self.hamiltonian = hamiltonian
         self.mqubits = mqubits
         self.shots = shots
+        self.pauli_mode = pauli_mode
 
 
-def expval(hamiltonian):
+def expval(hamiltonian, pauli_mode='circuit'):
     """
     For `matrix` is True, It will generate the sparse matrix for hamiltonian.
+    For a hamiltonian of pauli strings, use `pauli_mode='state'` to evaluate all the terms
+    from one simulation on the `spinq` and `torch` backends.
+    For the large qubit numbers, use `PauliSumOperator(pauli_string_list)` as the hamiltonian, it is applied
+    to the state vector without building the matrix and supports the `adjoint_differentiation` grad_method.
 
     Example:
         hamiltonian = [('X', 1.5)]
 
-        @to_qlayer(measure=expval(hamiltonian, True))
+        @to_qlayer(measure=expval(hamiltonian))
         def build_circuit():
             circuit = Circuit()
             q = circuit.allocateQubits(1)
             circuit << (Ry, [q[0]], np.pi/2)
             return circuit
     """
-    return MeasureOp('expval', hamiltonian=hamiltonian)
+    return MeasureOp('expval', hamiltonian=hamiltonian, pauli_mode=pauli_mode)
 
 
 def probs(mqubits=None):
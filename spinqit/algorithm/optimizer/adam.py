@@ -15,7 +15,6 @@ import numpy as np
 
 from .optimizer import Optimizer
 from .utils import optimizer_timer
-from ...grad import qgrad
 
 
 class ADAM(Optimizer):
@@ -54,9 +53,7 @@ class ADAM(Optimizer):
 
     @optimizer_timer
     def step_and_cost(self, qlayer, params):
-        grad_fn = qgrad(qlayer)
-        derivative = grad_fn(*params)
-        loss = grad_fn.forward        
+        loss, derivative = self.get_training_step(qlayer).value_and_grad(*params)
         for i in range(len(params)):
             self.__mt[i] = self.__beta1 * self.__mt[i] + (1 - self.__beta1) * derivative[i]
             self.__vt[i] = self.__beta2 * self.__vt[i] + (1 - self.__beta2) * derivative[i] * derivative[i]
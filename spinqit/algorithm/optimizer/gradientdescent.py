@@ -14,7 +14,6 @@
 import numpy as np
 from .optimizer import Optimizer
 from .utils import optimizer_timer
-from ...grad import qgrad
 
 
 class GradientDescent(Optimizer):
@@ -45,9 +44,7 @@ class GradientDescent(Optimizer):
 
     @optimizer_timer
     def step_and_cost(self, qlayer, params):
-        grad_fn = qgrad(qlayer)
-        derivative = grad_fn(*params)
-        loss = grad_fn.forward
+        loss, derivative = self.get_training_step(qlayer).value_and_grad(*params)
         for i in range(len(params)):
             params[i] -= derivative[i] * self.__learning_rate
         return loss
@@ -11,6 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from spinqit.grad import TrainingStep
 
 
 class Optimizer:
@@ -37,4 +38,13 @@ class Optimizer:
         """
         Check whether the optimization process has reached the end.
         """
-        return
\ No newline at end of file
+        return
+
+    def get_training_step(self, qlayer):
+        """
+        The TrainingStep of the qlayer, created on the first step and reused while the qlayer is the same.
+        """
+        training_step = getattr(self, '_training_step', None)
+        if training_step is None or training_step.qlayer is not qlayer:
+            training_step = self._training_step = TrainingStep(qlayer)
+        return training_step
@@ -16,104 +16,153 @@ import numpy as np
 
 from .optimizer import Optimizer
 from .utils import optimizer_timer
-from ..loss import probs
-from spinqit.grad._grad import qgrad
-from spinqit.model import Circuit, Instruction
-from spinqit.compiler.ir import IntermediateRepresentation as IR
+from spinqit.grad.adjoint import apply_gate_to_state, param_coefficients, step_matrix
 from spinqit.model.parameter import Parameter
-from spinqit.primitive import PauliBuilder
-from spinqit.utils.function import _topological_sort, requires_grad
-from copy import deepcopy
 
 
-def fubini_tensor(qlayer, *params):
-
-    # def convert_ob(qubit, pstr, eigval, coeff):
-    #     measure = probs(mqubits=qubit)
-    #     if pstr == 'P':
-    #         probabilities = backend.evaluate(qlayer.compile_circuit(temp_circ, 0), config, measure)[0]
-    #     else:
-    #         h_part = PauliBuilder(pstr).to_gate()
-    #         temp_circ << (h_part, qubit)
-    #         probabilities = backend.evaluate(qlayer.compile_circuit(temp_circ, 0), config, measure)[0]
-    #         temp_circ.instructions.pop()
-    #     probabilities = Parameter(probabilities.cpu().detach() if hasattr(probabilities, 'cpu') else probabilities)
-    #     return (coeff * coeff) * (
-    #                 (eigval * eigval @ probabilities) - (eigval @ probabilities) * (eigval @ probabilities))
-
-    def convert_ob(qubit, pstr, eigval, coeff):
-        measure = probs(mqubits=qubit)
-        # zkey = '0' * len(qubit)
-        if pstr == 'P':
-            probabilities = backend.evaluate(qlayer.compile_circuit(temp_circ, 0), config, measure)[0]
-            # probabilities = backend.execute(qlayer.compile_circuit(temp_circ, 0), config).probabilities[0]
-        else:
-            h_part = PauliBuilder(pstr).to_gate()
-            temp_circ << (h_part, qubit)
-            # probabilities = backend.execute(qlayer.compile_circuit(temp_circ, 0), config).raw_probabilities[0]
-            probabilities = backend.evaluate(qlayer.compile_circuit(temp_circ, 0), config, measure)[0]
-            temp_circ.instructions.pop()
-
-        probabilities = Parameter(probabilities.cpu().detach() if hasattr(probabilities, 'cpu') else probabilities)
-        return (coeff * coeff) * (
-                    (eigval * eigval @ probabilities) - (eigval @ probabilities) * (eigval @ probabilities))
-
-    generator = {'Rx': ('X', np.array([1, -1]), -0.5),
-                 'Ry': ('Y', np.array([1, -1]), -0.5),
-                 'Rz': ('Z', np.array([1, -1]), -0.5),
-                 'P': ('P', np.array([0, 1]), 1)}
-
+# The generators K of the trainable gates, the gate is exp(-i x K) up to a global phase.
+GENERATORS = {
+    'Rx': 0.5 * np.array([[0, 1], [1, 0]], dtype=complex),
+    'Ry': 0.5 * np.array([[0, -1j], [1j, 0]], dtype=complex),
+    'Rz': 0.5 * np.array([[1, 0], [0, -1]], dtype=complex),
+    'P': -np.array([[0, 0], [0, 1]], dtype=complex),
+}
+
+
+def _layer_metric(state, layer, qubit_num, approx):
+    """
+    The metric of one layer of trainable gates from the state before the layer,
+    g_ab = <K_a K_b> - <K_a><K_b>, only the variances for the `diag` approximation.
+    """
+    k_states = [apply_gate_to_state(state, generator, qubits, qubit_num) for generator, qubits, _ in layer]
+    means = [np.real(np.vdot(state, k_state)) for k_state in k_states]
+    metric = np.zeros((len(layer), len(layer)))
+    for a in range(len(layer)):
+        for b in range(a, len(layer) if approx == 'block-diag' else a + 1):
+            metric[a, b] = metric[b, a] = np.real(np.vdot(k_states[a], k_states[b])) - means[a] * means[b]
+    return metric
+
+
+def metric_tensor(qlayer, *params, approx='block-diag'):
+    """
+    The Fubini-Study metric tensor of the circuit w.r.t. the flattened params.
+
+    The trainable gates are grouped into layers of gates on different qubits, the metric of a layer is calculated
+    from the state before the layer. The IR is walked once and the prefix state is updated gate by gate,
+    the constant gates which commute with the open layer are applied to the prefix state directly.
+
+    Args:
+        approx (str): `block-diag` keeps the covariances of the gates in the same layer,
+            `diag` only keeps the variances of the gates.
+
+    Returns:
+        A square matrix of the size of all the params.
+    """
+    if approx not in ['diag', 'block-diag']:
+        raise ValueError(
+            f'The approx of the metric tensor should be `diag` or `block-diag`, but got {approx}'
+        )
+    for param in params:
+        if not isinstance(param, Parameter):
+            raise ValueError(
+                f'The fubini_tensor is only support type:`spinqit.Parameter` params, but got {type(param)}'
+            )
     qubit_num = qlayer.qubits_num
     ir = qlayer.ir
     backend = qlayer.backend
-    config = deepcopy(qlayer.config)
-
     backend.check_node(ir, qlayer.place_holder)
     backend.update_param(ir, params)
 
-    # Create a temporary circuit to construct the metric tensor
-    temp_circ = Circuit()
-    temp_circ.allocateQubits(qubit_num)
-    Fubini_study_tensor = []
-    for param in params:
-        if not isinstance(param, Parameter):
+    size = sum(np.size(param) for param in params)
+    tensor = np.zeros((size, size))
+    funcs = ir.dag.vs['func'] if 'func' in ir.dag.vs.attributes() else None
+    vertex_params = ir.dag.vs['params'] if 'params' in ir.dag.vs.attributes() else None
+
+    state = np.zeros([2] * qubit_num, dtype=complex)
+    state[(0,) * qubit_num] = 1
+    layer = []
+    layer_qubits = set()
+    pending = []
+
+    def flush():
+        nonlocal state
+        if layer:
+            jacobian = np.stack([coeff for _, _, coeff in layer])
+            tensor[:] += jacobian.T @ _layer_metric(state, layer, qubit_num, approx) @ jacobian
+        for mat, qubits in pending:
+            state = apply_gate_to_state(state, mat, qubits, qubit_num)
+        layer.clear()
+        layer_qubits.clear()
+        pending.clear()
+
+    for step, node_params in ir.compile_plan().bind(ir.dag):
+        if step.name == 'MEASURE':
+            continue
+        if step.name == 'StateVector':
+            flush()
+            state = np.asarray(node_params[0] if len(node_params) == 1 else node_params, dtype=complex)
+            state = state.reshape([2] * qubit_num)
+            continue
+        mat, node_params = step_matrix(ir, step, node_params)
+        trainable = []
+        if node_params is not None and vertex_params is not None:
+            for j in range(len(node_params)):
+                coeffs = param_coefficients(step, j, funcs, vertex_params[step.vid], params)
+                if coeffs is not None and not all(np.allclose(c, 0) for c in coeffs):
+                    trainable.append(np.concatenate([np.ravel(c) for c in coeffs]))
+        if trainable and (step.name not in GENERATORS or len(trainable) > 1):
             raise ValueError(
-                f'The fubini_tensor is only support type:`spinqit.Parameter` params, but got {type(param)}'
+                f'The metric tensor does not support the trainable gate {step.name}'
             )
-        Fubini_study_tensor.append(np.zeros(shape=param.shape))
 
-    vids = _topological_sort(ir.dag)
-    for i in vids:
-        v = ir.dag.vs[i]
+        if layer_qubits.intersection(step.qubits):
+            flush()
+        if trainable:
+            layer.append((GENERATORS[step.name], step.qubits, trainable[0]))
+            layer_qubits.update(step.qubits)
+            pending.append((mat, step.qubits))
+        else:
+            state = apply_gate_to_state(state, mat, step.qubits, qubit_num)
+    flush()
+    return tensor
 
-        if v['type'] in [0, 1]:
-            label = v['name']
-            if 'params' in v.attributes() and v['params'] is not None and v['func'] is not None:
-                for j, _param in enumerate(v['params']):
-                    if callable(v['func'][j]) and requires_grad(_param):
-                        # The observables corresponding to the generators of the gates in the layer:
-                        from autograd import elementwise_grad as egrad
-                        coeff = egrad(v['func'][j])(params)
-                        val = convert_ob(v['qubits'], *generator[label])
-                        for k in range(len(Fubini_study_tensor)):
-                            Fubini_study_tensor[k] += coeff[k] * coeff[k] * val
 
-            temp_circ.append_instruction(Instruction(IR.get_basis_gate(label), v['qubits'], [], v['params']))
-    return Fubini_study_tensor
+def fubini_tensor(qlayer, *params):
+    """
+    The diagonal of the Fubini-Study metric tensor in the shapes of the params.
+    """
+    diagonal = np.diag(metric_tensor(qlayer, *params, approx='diag')).copy()
+    tensors = []
+    start = 0
+    for param in params:
+        tensors.append(diagonal[start:start + np.size(param)].reshape(np.shape(param)))
+        start += np.size(param)
+    return tensors
 
 
 class QuantumNaturalGradient(Optimizer):
+    """
+    Args:
+        approx (str): The approximation of the metric tensor, `diag` (default) scales every gradient by
+            the variance of its generators, `block-diag` solves with the covariances of the gates in every layer.
+    """
     def __init__(self,
                  maxiter: int = 1000,
                  tolerance: float = 1e-6,
                  learning_rate: float = 0.01,
-                 verbose=True, ):
+                 verbose=True,
+                 approx: str = 'diag', ):
 
         super().__init__()
+        if approx not in ['diag', 'block-diag']:
+            raise ValueError(
+                f'The approx of the metric tensor should be `diag` or `block-diag`, but got {approx}'
+            )
 
         self.__maxiter = maxiter
         self.__tolerance = tolerance
         self.__learning_rate = learning_rate
+        self.__approx = approx
         self._verbose = verbose
         self._step = 1
 
@@ -130,9 +179,18 @@ class QuantumNaturalGradient(Optimizer):
 
     @optimizer_timer
     def step_and_cost(self, qlayer, params):
-        grad_fn = qgrad(qlayer)
-        first_grads = grad_fn(*params)
-        loss = grad_fn.forward
+        loss, first_grads = self.get_training_step(qlayer).value_and_grad(*params)
+        if self.__approx == 'block-diag':
+            tensor = metric_tensor(qlayer, *params, approx='block-diag')
+            flat_grads = np.concatenate([np.ravel(g) for g in first_grads])
+            update = np.linalg.pinv(tensor, hermitian=True) @ flat_grads
+            start = 0
+            for i in range(len(params)):
+                size = np.size(params[i])
+                params[i] -= self.__learning_rate * update[start:start + size].reshape(np.shape(params[i]))
+                start += size
+            return loss
+
         Fubini_study_tensor = fubini_tensor(qlayer, *params, )
 
         for i, _tensor in enumerate(Fubini_study_tensor):
@@ -109,7 +109,7 @@ class QAOA(object):
                 mode (str): The backend mode supports only `spinq` or `torch`.
                 grad_method (str):
                         For `spinq` backend, the grad_method is `param_shift` or `adjoint_differentiation`
-                        For `torch` backend, the grad_method is `backprop`
+                        For `torch` backend, the grad_method is `backprop`, `param_shift` or `adjoint_differentiation`
 
             Return:
                 The optimize step loss list.
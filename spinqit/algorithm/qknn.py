@@ -11,32 +11,154 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-from sklearn import KNeighborsClassifier
+from sklearn.neighbors import KNeighborsClassifier
 from ..backend import check_backend_and_config
 from ..compiler import get_compiler
 from ..model import Circuit
 from ..primitive import SwapTest
+from .quantum_kernel import STATEVECTOR_BACKENDS, statevector_overlaps
 
 class QKNN():
-    def __init__(self, backend_mode: str = 'spinq', **kwargs):
+    '''
+    The k-nearest neighbors classifier with the swap test distance 1 - |<psi_1|psi_2>| of the amplitude encoded samples.
+    The distances between the training samples are kept, so the training samples can be added incrementally,
+    and the classifier searches the neighbors in the precomputed distance matrices.
+    On the `spinq` and `torch` simulators the distances are computed from the encoding states, on the other
+    backends every pair runs a swap test circuit, on `num_workers` threads if it is given.
+    '''
+    def __init__(self, backend_mode: str = 'spinq', n_neighbors: int = 1, num_workers: int = None, **kwargs):
+        if n_neighbors < 1:
+            raise ValueError(
+                f'The n_neighbors should be a positive integer, but got {n_neighbors}'
+            )
         self.backend_mode = backend_mode
         self.backend, self.config = check_backend_and_config(backend_mode, **kwargs)
+        self.n_neighbors = n_neighbors
+        self.num_workers = num_workers
+        self.train_x = None
+        self.train_y = None
+        self.train_distances = None
+        self.__knn = None
+
+    @property
+    def knn(self):
+        return self.__knn
+
+    @staticmethod
+    def encoding_states(X) -> np.ndarray:
+        """
+        The states prepared by the amplitude encoding of the samples, i.e. the normalized vectors.
+        """
+        X = np.atleast_2d(np.asarray(X))
+        return X / np.linalg.norm(X, axis=1, keepdims=True)
 
     def swap_test(self, state1, state2):
+        if self.backend_mode in STATEVECTOR_BACKENDS:
+            # The swap test measures 0 with the probability (1 + |<psi_1|psi_2>|^2) / 2,
+            # on a noiseless simulator the overlap is computed from the encoding states directly
+            fidelity = statevector_overlaps(self.encoding_states(state1), self.encoding_states(state2))[0, 0]
+            return 1 - np.sqrt(fidelity)
         circ = Circuit()
         qubit_num = int(np.log2(len(state1)))
         qreg = circ.allocateQubits(1+2*qubit_num)
-        st_insts = SwapTest(state1, state2, qreg[0], qreg[1:qubit_num], qreg[qubit_num+1:])
+        st_insts = SwapTest(state1, state2, qreg[0], qreg[1:qubit_num+1], qreg[qubit_num+1:]).build()
         circ.extend(st_insts)
         compiler = get_compiler()
         exe = compiler.compile(circ, 0)
         self.config.configure_measure_qubits([0])
         result = self.backend.execute(exe, self.config)
         prob0 = result.probabilities['0']
-        return 1 - np.sqrt(prob0 * 2 - 1)
+        return 1 - np.sqrt(max(prob0 * 2 - 1, 0))
+
+    def distance_matrix(self, X1, X2, symmetric: bool = False) -> np.ndarray:
+        """
+        The swap test distances of every pair of samples in X1 and X2. If symmetric, X1 and X2 are the same
+        samples and only the upper triangle is evaluated.
+        """
+        X1, X2 = np.atleast_2d(np.asarray(X1)), np.atleast_2d(np.asarray(X2))
+        if self.backend_mode in STATEVECTOR_BACKENDS:
+            states_1 = self.encoding_states(X1)
+            fidelities = statevector_overlaps(states_1, states_1 if symmetric else self.encoding_states(X2))
+            distances = 1 - np.sqrt(np.clip(fidelities, 0, 1))
+            if symmetric:
+                np.fill_diagonal(distances, 0.)
+            return distances
+
+        if symmetric:
+            rows, cols = np.triu_indices(len(X1), k=1)
+        else:
+            rows, cols = np.divmod(np.arange(len(X1) * len(X2)), len(X2))
+
+        def evaluate(pair):
+            return self.swap_test(X1[pair[0]], X2[pair[1]])
+
+        pairs = list(zip(rows, cols))
+        if not self.num_workers or self.num_workers == 1:
+            values = [evaluate(pair) for pair in pairs]
+        else:
+            with ThreadPoolExecutor(max_workers=self.num_workers) as pool:
+                values = list(pool.map(evaluate, pairs))
+        distances = np.zeros((len(X1), len(X2)))
+        distances[rows, cols] = values
+        if symmetric:
+            distances[cols, rows] = values
+        return distances
+
+    def fit(self, train_x, train_y):
+        self.train_x = None
+        self.train_y = None
+        self.train_distances = None
+        self.add_training_data(train_x, train_y)
+
+    def add_training_data(self, train_x, train_y):
+        """
+        Add training samples, only the distances from the new samples are evaluated.
+        """
+        train_x, train_y = np.atleast_2d(np.asarray(train_x)), np.atleast_1d(np.asarray(train_y))
+        if len(train_x) != len(train_y):
+            raise ValueError(
+                f'The numbers of training samples and labels are different, {len(train_x)} and {len(train_y)}'
+            )
+        new_distances = self.distance_matrix(train_x, train_x, symmetric=True)
+        if self.train_x is None:
+            self.train_x, self.train_y, self.train_distances = train_x, train_y, new_distances
+        else:
+            cross = self.distance_matrix(train_x, self.train_x)
+            self.train_distances = np.block([[self.train_distances, cross.T], [cross, new_distances]])
+            self.train_x = np.concatenate([self.train_x, train_x])
+            self.train_y = np.concatenate([self.train_y, train_y])
+
+        self.__knn = KNeighborsClassifier(n_neighbors=min(self.n_neighbors, len(self.train_x)), metric='precomputed')
+        self.__knn.fit(self.train_distances, self.train_y)
+
+    def predict(self, test_x, *deprecated_args):
+        """
+        Predict the labels of the test samples with the fitted training samples.
+        The old form `predict(train_x, train_y, test_x)` is deprecated, use `fit_predict` instead.
+        """
+        if deprecated_args:
+            if len(deprecated_args) != 2:
+                raise TypeError(
+                    f'The predict takes the test samples only, but got {1 + len(deprecated_args)} arguments'
+                )
+            warnings.warn(
+                '`QKNN.predict(train_x, train_y, test_x)` is deprecated, '
+                'use `QKNN.fit_predict(train_x, train_y, test_x)` or `fit` and `predict(test_x)` instead.',
+                DeprecationWarning,
+                stacklevel=2,
+            )
+            return self.fit_predict(test_x, *deprecated_args)
+        if self.__knn is None:
+            raise ValueError('The QKNN should be fitted before predicting.')
+        return self.__knn.predict(self.distance_matrix(test_x, self.train_x))
 
-    def predict(self, train_x, train_y, test_x):
-        knn = KNeighborsClassifier(algorithm='auto', metric=self.swap_test, n_neighbors=1, p=2, weights='uniform')
-        knn.fit(train_x, train_y)
-        return knn.predict(test_x)
\ No newline at end of file
+    def fit_predict(self, train_x, train_y, test_x):
+        """
+        Fit the training samples and predict the labels of the test samples.
+        """
+        self.fit(train_x, train_y)
+        return self.predict(test_x)
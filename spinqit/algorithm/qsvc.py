@@ -16,13 +16,19 @@ import numpy as np
 from sklearn import svm
 from spinqit import Circuit, iqp_encoding, invert_instruction
 from spinqit.interface import to_qlayer
-from spinqit.algorithm.loss import MeasureOp, probs
+from spinqit.algorithm.loss import MeasureOp, probs, states
+from spinqit.algorithm.quantum_kernel import QuantumKernel, STATEVECTOR_BACKENDS
 
 class QSVC():
     '''
     Either feature_map or qubit_number must be specified.
+    The kernel matrices are evaluated by QuantumKernel with `batch_size` pairs or samples at a time
+    on `num_workers` threads, see QuantumKernel.
+    With the qubit_num on the `spinq` or `torch` simulator, the fidelity kernel is computed from the encoding
+    states of the samples unless use_statevector is False.
     '''
-    def __init__(self, feature_map: Callable = None, use_projected: bool = False, qubit_num: int = None, measure: MeasureOp = probs(), backend_mode: str = 'spinq', **kwargs):
+    def __init__(self, feature_map: Callable = None, use_projected: bool = False, qubit_num: int = None, measure: MeasureOp = probs(), backend_mode: str = 'spinq', batch_size: int = 1024, num_workers: int = None, use_statevector: bool = True, **kwargs):
+        state_map = None
         if feature_map is not None:
             self.feature_map = feature_map
             if use_projected:
@@ -40,6 +46,10 @@ class QSVC():
             else:
                 self.feature_map = qlayer(self.build_circuit)()
                 self.__qsvm = svm.SVC(kernel=self.quantum_kernel)
+                if use_statevector and backend_mode in STATEVECTOR_BACKENDS \
+                        and measure.mtype == 'prob' and measure.mqubits is None:
+                    state_map = to_qlayer(backend_mode=backend_mode, measure=states(), **kwargs)(self.build_projected_circuit)()
+        self.kernel = QuantumKernel(self.feature_map, use_projected, batch_size, num_workers, state_map)
 
     @property
     def qsvm(self):
@@ -59,7 +69,7 @@ class QSVC():
         return np.exp(-((p_feature_vector_1 - p_feature_vector_2) ** 2).sum())
 
     def projected_quantum_kernel(self, X1, X2):
-        return np.array([[self.projected_kernel_estimator(x1, x2) for x2 in X2] for x1 in X1])
+        return self.kernel.projected_kernel(X1, X2)
 
     def build_circuit(self):
         circ = Circuit()
@@ -80,7 +90,7 @@ class QSVC():
         return probabilities[0]
 
     def quantum_kernel(self, X1, X2):
-        return np.array([[self.quantum_kernel_estimator(x1, x2) for x2 in X2] for x1 in X1])
+        return self.kernel.fidelity_kernel(X1, X2)
 
     def fit(self, X_train, y_train):
         self.__qsvm.fit(X_train, y_train)
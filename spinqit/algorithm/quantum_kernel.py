@@ -0,0 +1,183 @@
+# Copyright 2023 SpinQ Technology Co., Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import numpy as np
+
+from spinqit.interface import QLayer
+
+# The backends which return the exact state vector of a circuit
+STATEVECTOR_BACKENDS = ('spinq', 'torch')
+
+
+def _flatten_outputs(outputs, n: int, dtype=float) -> np.ndarray:
+    """
+    Stack the batched outputs of a feature map into an (n, d) array, the outputs of a list of measures
+    are concatenated for every sample.
+    """
+    if isinstance(outputs, (list, tuple)):
+        return np.concatenate([np.asarray(o, dtype=dtype).reshape(n, -1) for o in outputs], axis=1)
+    return np.asarray(outputs, dtype=dtype).reshape(n, -1)
+
+
+def statevector_overlaps(states_1, states_2) -> np.ndarray:
+    """
+    The fidelities |<psi_1|psi_2>|^2 of every pair of states, computed with one matrix product.
+
+    Args:
+        states_1: The (n1, d) state vectors.
+        states_2: The (n2, d) state vectors.
+
+    Returns:
+        The (n1, n2) fidelities.
+    """
+    return np.abs(np.conj(np.asarray(states_1)) @ np.asarray(states_2).T) ** 2
+
+
+class QuantumKernel(object):
+    """
+    Evaluate the kernel matrices of a quantum feature map for the QSVC.
+
+    The fidelity kernel feature_map(x1, x2) returns the probabilities of U(x2)^dagger U(x1)|0>, and the kernel
+    is the probability of the all-zero state. For the Gram matrix of one data set only the upper triangle is
+    evaluated, the diagonal is 1. On a noiseless simulator the kernel is |<psi(x1)|psi(x2)>|^2, so with a
+    `state_map` x -> |psi(x)> every sample is simulated once and the kernel is the overlaps of the states,
+    instead of a circuit of U(x1) and U(x2) for every pair. The projected kernel feature_map(x) returns the features of one sample,
+    which are cached by the sample, so the training features are simulated once for fitting and predicting.
+
+    The pairs are evaluated chunk by chunk and written into the matrix. A QLayer evaluates a chunk with
+    `QLayer.batch`, i.e. the batched simulation of the `torch` backend or the threads of the `spinq` backend.
+    Other callables are called one by one, or on `num_workers` threads if they are thread safe.
+
+    Args:
+        feature_map (Callable): The QLayer or the function of the feature map.
+        use_projected (bool): Whether to use the projected kernel.
+        batch_size (int): The number of pairs or samples evaluated together. Default to 1024.
+        num_workers (int): The number of threads. Default to the default of `QLayer.batch` for a QLayer,
+            and 1 for other callables.
+        state_map (Callable): The QLayer or the function which returns the encoding state of one sample,
+            e.g. a QLayer of U(x) with the `states()` measure. Only used by the fidelity kernel.
+    """
+    feature_cache_size = 65536
+
+    def __init__(self, feature_map: Callable, use_projected: bool = False, batch_size: int = 1024,
+                 num_workers: int = None, state_map: Callable = None):
+        if batch_size < 1:
+            raise ValueError(
+                f'The batch_size of the quantum kernel should be a positive integer, but got {batch_size}'
+            )
+        self.feature_map = feature_map
+        self.use_projected = use_projected
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.state_map = state_map
+        self._features = OrderedDict()
+        self._states = OrderedDict()
+
+    def __call__(self, X1, X2) -> np.ndarray:
+        if self.use_projected:
+            return self.projected_kernel(X1, X2)
+        return self.fidelity_kernel(X1, X2)
+
+    def _map(self, fn, items) -> list:
+        if not self.num_workers or self.num_workers == 1 or len(items) <= 1:
+            return [fn(item) for item in items]
+        with ThreadPoolExecutor(max_workers=self.num_workers) as pool:
+            return list(pool.map(fn, items))
+
+    def _evaluate_pairs(self, X1, X2) -> np.ndarray:
+        if isinstance(self.feature_map, QLayer):
+            probabilities = self.feature_map.batch(X1, X2, batch_size=self.batch_size, num_workers=self.num_workers)
+            return _flatten_outputs(probabilities, len(X1))[:, 0]
+        return np.array(self._map(lambda pair: np.ravel(self.feature_map(*pair))[0], list(zip(X1, X2))),
+                        dtype=float)
+
+    def fidelity_kernel(self, X1, X2) -> np.ndarray:
+        X1, X2 = np.asarray(X1, dtype=float), np.asarray(X2, dtype=float)
+        symmetric = X1 is X2 or (X1.shape == X2.shape and np.array_equal(X1, X2))
+        if self.state_map is not None:
+            states_1 = self.states(X1)
+            kernel = statevector_overlaps(states_1, states_1 if symmetric else self.states(X2))
+            if symmetric:
+                np.fill_diagonal(kernel, 1.)
+            return kernel
+
+        if symmetric:
+            kernel = np.eye(len(X1))
+            rows, cols = np.triu_indices(len(X1), k=1)
+        else:
+            kernel = np.empty((len(X1), len(X2)))
+            rows, cols = np.divmod(np.arange(len(X1) * len(X2)), len(X2))
+
+        for start in range(0, len(rows), self.batch_size):
+            r, c = rows[start:start + self.batch_size], cols[start:start + self.batch_size]
+            values = self._evaluate_pairs(X1[r], X2[c])
+            kernel[r, c] = values
+            if symmetric:
+                kernel[c, r] = values
+        return kernel
+
+    def _cached_outputs(self, fn, X, cache: OrderedDict, dtype) -> np.ndarray:
+        X = np.asarray(X, dtype=float)
+        keys = [x.tobytes() for x in X]
+        missing = list(OrderedDict.fromkeys(k for k in keys if k not in cache))
+        if missing:
+            index = {k: i for i, k in enumerate(keys)}
+            samples = X[[index[k] for k in missing]]
+            for start in range(0, len(samples), self.batch_size):
+                chunk = samples[start:start + self.batch_size]
+                if isinstance(fn, QLayer):
+                    outputs = fn.batch(chunk, batch_size=self.batch_size, num_workers=self.num_workers)
+                else:
+                    outputs = np.stack([_flatten_outputs(o, 1, dtype)[0] for o in self._map(fn, list(chunk))])
+                for k, f in zip(missing[start:start + self.batch_size], _flatten_outputs(outputs, len(chunk), dtype)):
+                    cache[k] = f
+
+        outputs = np.stack([cache[k] for k in keys])
+        for k in keys:
+            cache.move_to_end(k)
+        while len(cache) > self.feature_cache_size:
+            cache.popitem(last=False)
+        return outputs
+
+    def features(self, X) -> np.ndarray:
+        """
+        The (n, d) features of the samples, only the samples which are not in the cache are simulated.
+        """
+        return self._cached_outputs(self.feature_map, X, self._features, float)
+
+    def states(self, X) -> np.ndarray:
+        """
+        The (n, 2^q) encoding states of the samples from the state_map, cached like the features.
+        """
+        return self._cached_outputs(self.state_map, X, self._states, complex)
+
+    def projected_kernel(self, X1, X2) -> np.ndarray:
+        X1, X2 = np.asarray(X1, dtype=float), np.asarray(X2, dtype=float)
+        symmetric = X1 is X2 or (X1.shape == X2.shape and np.array_equal(X1, X2))
+        features_1 = self.features(X1)
+        features_2 = features_1 if symmetric else self.features(X2)
+        # |f1 - f2|^2 = |f1|^2 + |f2|^2 - 2 f1.f2, without the (n1, n2, d) differences
+        distances = (features_1 ** 2).sum(axis=1)[:, None] + (features_2 ** 2).sum(axis=1)[None, :] \
+            - 2 * features_1 @ features_2.T
+        kernel = np.exp(-np.maximum(distances, 0))
+        if symmetric:
+            np.fill_diagonal(kernel, 1.)
+        return kernel
+
+    def clear_cache(self):
+        self._features.clear()
+        self._states.clear()
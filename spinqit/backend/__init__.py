@@ -18,3 +18,6 @@ from .nmr_backend import NMRConfig
 from .pytorch_backend import TorchSimulatorConfig
 from .qasm_backend import QasmConfig, QiskitQasmResult
 from .spinq_cloud_backend import SpinQCloudConfig
+from .result_cache import ResultCache
+from .sampling import Sampler
+from .task_result_store import TaskResultStore
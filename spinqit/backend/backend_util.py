@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
 from typing import List
 from igraph import Graph
 from spinqit.compiler import IntermediateRepresentation, NodeType
@@ -20,6 +21,39 @@ from spinqit.compiler.translator.gate_converter import decompose_single_qubit_ga
 def get_graph_capsule(graph: Graph):
     return graph.__graph_as_capsule()
 
+def check_once(check_node):
+    """
+    Run the check_node of a backend once for every IR and place_holder. The record is kept on the IR,
+    so it is copied and released with the IR, while functools.lru_cache keeps every IR alive.
+    The check reads the LazyParameter which are replaced by the values later, it can not be shared
+    by the IRs with the same fingerprint.
+    """
+    @functools.wraps(check_node)
+    def wrapper(*args):
+        ir, place_holder = args[-2], args[-1]
+        checked = ir.__dict__.setdefault('_checked_place_holders', set())
+        key = (check_node.__qualname__, place_holder)
+        if key in checked:
+            return
+        check_node(*args)
+        checked.add(key)
+
+    return wrapper
+
+def marginal_probabilities(probabilities, qubit_num: int, mqubits: List = None):
+    """
+    Sum the probabilities of the qubits which are not measured, the measured qubits are kept in ascending order
+    like the results of the simulators. The probabilities can be numpy arrays or torch tensors,
+    with a batch along the leading dimensions.
+    """
+    if mqubits is None:
+        return probabilities
+    lead = list(probabilities.shape[:-1])
+    discard = tuple(len(lead) + q for q in range(qubit_num) if q not in mqubits)
+    if not discard:
+        return probabilities
+    return probabilities.reshape(lead + [2] * qubit_num).sum(discard).reshape(lead + [-1])
+
 def map_results(probabilities: List, qubit_mapping: List) -> List:
     qubit_num = len(qubit_mapping)
     zero_probabilitiess = [0.0] * qubit_num
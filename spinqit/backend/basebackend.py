@@ -12,10 +12,84 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import numpy as onp
+
+from .result_cache import ResultCache
+
+
+def stack_values(values):
+    """
+    Stack the results of a batch along the first axis, the counts are kept as a list of dict.
+    """
+    if any(isinstance(v, dict) for v in values):
+        return list(values)
+    return onp.stack([onp.asarray(v) for v in values])
+
+
+def stack_outputs(values, measure_op):
+    """
+    Stack the results of a batch, a list of the stacked results of every measure_op if measure_op is a list.
+    """
+    if isinstance(measure_op, list):
+        return [stack_values([v[k] for v in values]) for k in range(len(measure_op))]
+    return stack_values(values)
+
+
+def shifted_params(params, vid, index, value):
+    """
+    A copy of the vertex parameters with the parameter `index` of the vertex `vid` replaced by `value`.
+    Only the parameter list of that vertex is copied, the others are shared with `params`.
+    """
+    params = list(params)
+    vertex_params = list(params[vid])
+    vertex_params[index] = value
+    params[vid] = vertex_params
+    return params
+
+
+def from_final_state(measure_op) -> bool:
+    """
+    Whether the output of the measure_op is a function of the final state, i.e. it can be derived
+    from the state of a simulation shared with other measure_ops.
+    """
+    return measure_op.mtype in ('expval', 'prob', 'state') and not isinstance(measure_op.hamiltonian, list)
+
+
 class BaseBackend:
+    result_cache = None
+
     def __init__(self, *args, **kwargs):
         pass
 
+    def enable_result_cache(self, max_bytes: int = 256 * 2 ** 20) -> ResultCache:
+        """
+        Keep the results of the executions in a bounded LRU cache, so executing the same circuit with the same
+        parameters again, e.g. the measurement after the forward pass, does not run the simulation.
+        The hits and misses are counted in `ResultCache.cache_info()`.
+
+        Args:
+            max_bytes (int): The memory budget of the cached results. Default to 256MB.
+        """
+        self.result_cache = ResultCache(max_bytes)
+        return self.result_cache
+
+    def disable_result_cache(self):
+        self.result_cache = None
+
+    def _execute_cached(self, ir, config_key, execute_fn, nbytes_fn):
+        """
+        Execute the IR with `execute_fn()`, or return the cached result of the same IR, parameters and config_key.
+        """
+        cache = self.result_cache
+        key = cache.key(ir, config_key) if cache is not None else None
+        if key is None:
+            return execute_fn()
+        result = cache.get(key)
+        if result is None:
+            result = execute_fn()
+            cache.put(key, result, nbytes_fn(result))
+        return result
+
     def process_params(self, *args, **kwargs):
         raise NotImplementedError
 
@@ -30,7 +104,76 @@ class BaseBackend:
         raise NotImplementedError
 
     def get_value_and_grad_fn(self, *args, **kwargs):
+        """
+        Return a function which maps the circuit parameters to (value, backward_fn).
+        The backward function uses a snapshot of the gate parameters of its forward pass,
+        so it can still be called after the IR is updated with other parameters.
+        """
         raise NotImplementedError
 
     def evaluate(self, *args, **kwargs):
         raise NotImplementedError
+
+    def evaluate_batch(self, ir, config, measure_op, place_holder, params_batch, batch_size=None, num_workers=None):
+        """
+        Evaluate the circuit for every parameter set in the batch, one after another.
+        The backends which can run the parameter sets together override this method.
+
+        Args:
+            params_batch (List): One array for every circuit parameter, stacked along the first axis.
+            batch_size (int): The number of parameter sets simulated together, if the backend supports it.
+            num_workers (int): The number of parameter sets evaluated in parallel, if the backend supports it.
+
+        Returns:
+            The stacked results, a list of the stacked results of every measure_op if measure_op is a list.
+        """
+        self.check_node(ir, place_holder)
+        values = []
+        for i in range(len(params_batch[0])):
+            params = self.process_params([p[i] for p in params_batch])
+            self.update_param(ir, params)
+            value, _ = self.evaluate(ir, config, measure_op)
+            values.append(value)
+        return stack_outputs(values, measure_op)
+
+    def evaluate_many(self, ir, config, measure_ops):
+        """
+        Evaluate a list of measure_ops, one after another.
+        The simulators override this method to derive the outputs from one final state.
+
+        Returns:
+            The list of values in the order of measure_ops, and the result of the last execution.
+        """
+        values = []
+        res = None
+        for measure_op in measure_ops:
+            value, res = self.evaluate(ir, config, measure_op)
+            values.append(value)
+        return values, res
+
+    def evaluate_shifted(self, ir, config, measure_op, shifts, batch_size=None, num_workers=None, params=None):
+        """
+        Evaluate the circuit once for every shifted gate parameter, one after another.
+        The backends which can run the evaluations together override this method.
+        The shifted values are written into a copy of the parameter lists, the parameters of the IR are not modified.
+
+        Args:
+            shifts (List): The tuples (vid, index, value), each one replaces the parameter `index` of the vertex
+                `vid` with `value` for one evaluation. The other parameters keep their values in `params`.
+            batch_size (int): The number of evaluations simulated together, if the backend supports it.
+            num_workers (int): The number of evaluations run in parallel, if the backend supports it.
+            params (List): The parameters of every vertex to shift from, e.g. the snapshot taken in the forward pass.
+                Default to the current parameters of the IR.
+
+        Returns:
+            The list of values in the order of shifts, a list of the values of every measure_op
+            for every shift if measure_op is a list.
+        """
+        if params is None:
+            params = ir.params_snapshot()
+        values = []
+        for vid, index, value in shifts:
+            with ir.bound_params(shifted_params(params, vid, index, value)):
+                result, _ = self.evaluate(ir, config, measure_op)
+            values.append(result)
+        return values
@@ -11,7 +11,12 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import functools
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from copy import deepcopy
 from typing import List
 
@@ -19,15 +24,16 @@ import numpy as onp
 from autoray import numpy as ar
 from scipy import sparse
 
-from .backend_util import get_graph_capsule, _add_pauli_gate
+from .backend_util import get_graph_capsule, _add_pauli_gate, check_once, marginal_probabilities
 from spinqit.compiler import IntermediateRepresentation, NodeType
 from spinqit.model import Instruction
 from spinqit.model import I, H, X, Y, Z, Rx, Ry, Rz, T, Td, S, Sd, P, CX, CY, CZ, SWAP, CCX, U
 from spinqit.spinq_backends import BasicSimulator
 
 from spinqit.model.parameter import Parameter, LazyParameter
-from .basebackend import BaseBackend
-from ..primitive import PauliBuilder, calculate_pauli_expectation, amplitude_encoding
+from .basebackend import BaseBackend, stack_outputs, from_final_state
+from ..primitive import PauliBuilder, calculate_pauli_expectation, calculate_pauli_expectation_from_state, \
+    group_qubit_wise_commuting, amplitude_encoding, PauliSumOperator
 from ..utils.function import requires_grad
 from spinqit.grad import grad_func_spinq
 
@@ -48,15 +54,56 @@ class BasicSimulatorConfig:
     def configure_measure_op(self, measure_op):
         self.metadata['measure_op'] = measure_op
 
+    def configure_num_threads(self, num_threads: int = None):
+        """
+        Run the state vector with the multi-threaded kernels.
+        None uses all the available threads. The circuits with measurements
+        or conditional gates still run on one thread.
+        """
+        if num_threads is not None and num_threads < 1:
+            raise ValueError(
+                f'The num_threads should be a positive integer or None, but got {num_threads}'
+            )
+        self.metadata['num_threads'] = num_threads
+
+    def configure_prepared_circuit(self, enable: bool = True):
+        """
+        Keep the translated native circuit of each IR and only rewrite the gate angles
+        when the same IR is executed again with new parameters.
+        """
+        self.metadata['prepared_circuit'] = enable
+
 
 class BasicSimulatorBackend(BaseBackend):
+    prepared_cache_size = 32
+    assembled_cache_size = 1024
+    worker_cache_size = 8
+    # The config entries which change the result of an execution, the others are not in the result cache key
+    result_config_keys = ('shots', 'mqubits', 'num_threads', 'prepared_circuit', 'parallel')
+    # The smaller circuits are evaluated on one thread by default, the threads cost more than the simulations
+    parallel_min_qubits = 12
+
     def __init__(self):
         super().__init__()
 
         self.simulator = BasicSimulator()
+        self._prepared = OrderedDict()
+        self._prepared_lock = threading.Lock()
+        self._assembled = OrderedDict()
+        self._assembled_lock = threading.Lock()
+        self._worker_irs = OrderedDict()
+        self._worker_lock = threading.Lock()
 
-    @functools.lru_cache
     def assemble(self, ir: IntermediateRepresentation):
+        """
+        Rewrite the gates which the native simulator does not support. The fingerprints of the assembled IRs
+        are recorded, an IR with the same fingerprint is already in the assembled form and is skipped.
+        """
+        with self._assembled_lock:
+            if ir.fingerprint() in self._assembled:
+                self._assembled.move_to_end(ir.fingerprint())
+                return
+        renamed = []
         i = 0
         while i < ir.dag.vcount():
             v = ir.dag.vs[i]
@@ -82,17 +129,26 @@ class BasicSimulatorBackend(BaseBackend):
                     i -= 1
                 elif v['name'] == CX.label:
                     v['name'] = 'CNOT'
+                    renamed.append(v.index)
                 elif v['name'] == CY.label:
                     v['name'] = 'YCON'
+                    renamed.append(v.index)
                 elif v['name'] == CZ.label:
                     v['name'] = 'ZCON'
+                    renamed.append(v.index)
                 elif v['name'] == CCX.label:
                     v['name'] = 'CCX'
+                    renamed.append(v.index)
                 elif v['name'] == 'StateVector':
                     raise ValueError(
                         f'The {self.__class__.__name__} does not support StateVector.'
                     )
             i += 1
+        ir.mark_modified(renamed)
+        with self._assembled_lock:
+            self._assembled[ir.fingerprint()] = True
+            if len(self._assembled) > self.assembled_cache_size:
+                self._assembled.popitem(last=False)
 
     @staticmethod
     def __qubits_and_clbits(v):
@@ -133,48 +189,217 @@ class BasicSimulatorBackend(BaseBackend):
 
     def execute(self, ir: IntermediateRepresentation, config):
         self.assemble(ir)
+        if self.result_cache is None:
+            return self._execute(ir, config)
+        metadata = config.metadata
+        config_key = tuple((k, repr(metadata.get(k))) for k in self.result_config_keys)
+        # A complex amplitude and a probability for every basis state
+        return self._execute_cached(ir, config_key, lambda: self._execute(ir, config),
+                                    lambda result: 24 * 2 ** ir.qnum)
+
+    def _execute(self, ir: IntermediateRepresentation, config):
+        if config.metadata.get('prepared_circuit', False) and hasattr(self.simulator, 'prepare'):
+            return self._execute_prepared(ir, config)
         return self.simulator.execute(get_graph_capsule(ir.dag), config.metadata)
 
+    def _execute_prepared(self, ir: IntermediateRepresentation, config):
+        """
+        Execute the IR with the prepared native circuit. The prepared circuits are kept by the fingerprint
+        of the IR, so the circuit is prepared again when the structure of the IR changes and shared
+        by the IRs with the same structure. The IRs with parameterized gates that cannot
+        be rewritten in place, e.g. the multi-qubit rotations, use the normal execution.
+        """
+        plan = ir.compile_plan()
+        with self._prepared_lock:
+            key = ir.fingerprint()
+            entry = self._prepared.get(key)
+            if entry is None:
+                prepared = self.simulator.prepare(get_graph_capsule(ir.dag), config.metadata)
+                step_index = {step.path: k for k, step in enumerate(plan.steps)}
+                slot_index = []
+                for path in prepared.parameter_paths():
+                    if tuple(path) not in step_index:
+                        slot_index = None
+                        break
+                    slot_index.append(step_index[tuple(path)])
+                if slot_index is not None:
+                    bound = plan.bind(ir.dag)
+                    parameterized = {k for k, (step, params) in enumerate(bound) if params}
+                    if parameterized != set(slot_index):
+                        slot_index = None
+                entry = (prepared if slot_index is not None else None, slot_index)
+                self._prepared[key] = entry
+                if len(self._prepared) > self.prepared_cache_size:
+                    self._prepared.popitem(last=False)
+            else:
+                self._prepared.move_to_end(key)
+
+        prepared, slot_index = entry
+        if prepared is None:
+            return self.simulator.execute(get_graph_capsule(ir.dag), config.metadata)
+        bound = plan.bind(ir.dag)
+        angles = onp.array([float(bound[k][1][0]) for k in slot_index], dtype=float)
+        return prepared.execute(angles, config.metadata)
+
     def get_value_and_grad_fn(self, ir, config, measure_op=None, place_holder=None, grad_method=None):
         def value_and_grad_fn(params):
             params_for_grad = self.process_params(params)
             self.check_node(ir, place_holder)
             self.update_param(ir, params_for_grad)
             val, res = self.evaluate(ir, config, measure_op)
-            backward_fn = grad_func_spinq(deepcopy(ir), params_for_grad, config, self, measure_op, res, grad_method)
+            backward_fn = grad_func_spinq(ir, params_for_grad, config, self, measure_op, res, grad_method)
             return val, backward_fn
 
         return value_and_grad_fn
 
+    def _num_workers(self, ir, num_workers, count):
+        if num_workers is not None:
+            return num_workers
+        if ir.qnum < self.parallel_min_qubits or count < 2:
+            return 1
+        return min(os.cpu_count() or 1, count)
+
+    @contextmanager
+    def _worker_ir(self, ir):
+        """
+        Borrow a copy of the IR for a worker thread, with the current parameters of the IR.
+        The copies are kept by the fingerprint of the IR and reused by the later batches,
+        so the graph is only copied again when the structure of the IR changes.
+        """
+        key = id(ir)
+        fingerprint = ir.fingerprint()
+        with self._worker_lock:
+            entry = self._worker_irs.get(key)
+            if entry is None or entry[0]() is not ir or entry[1] != fingerprint:
+                entry = (weakref.ref(ir), fingerprint, [])
+                self._worker_irs[key] = entry
+                if len(self._worker_irs) > self.worker_cache_size:
+                    self._worker_irs.popitem(last=False)
+            else:
+                self._worker_irs.move_to_end(key)
+            free = entry[2]
+            worker_ir = free.pop() if free else None
+        if worker_ir is None:
+            worker_ir = deepcopy(ir)
+        elif 'params' in ir.dag.vs.attributes():
+            worker_ir.dag.vs['params'] = ir.params_snapshot()
+        try:
+            yield worker_ir
+        finally:
+            with self._worker_lock:
+                free.append(worker_ir)
+
+    def evaluate_batch(self, ir, config, measure_op, place_holder, params_batch, batch_size=None, num_workers=None):
+        """
+        Evaluate the parameter sets with a thread pool, every thread updates its own copy of the IR.
+        The native simulator releases the GIL while it runs the state vector.
+        The circuits with less than `parallel_min_qubits` qubits are evaluated on one thread by default.
+        """
+        self.check_node(ir, place_holder)
+        self.assemble(ir)
+        num_workers = self._num_workers(ir, num_workers, len(params_batch[0]))
+
+        def evaluate_one(i):
+            with self._worker_ir(ir) as worker_ir:
+                params = self.process_params([p[i] for p in params_batch])
+                self.update_param(worker_ir, params)
+                value, _ = self.evaluate(worker_ir, config, measure_op)
+            return value
+
+        if num_workers == 1:
+            values = [evaluate_one(i) for i in range(len(params_batch[0]))]
+        else:
+            with ThreadPoolExecutor(max_workers=num_workers) as pool:
+                values = list(pool.map(evaluate_one, range(len(params_batch[0]))))
+        return stack_outputs(values, measure_op)
+
+    def evaluate_shifted(self, ir, config, measure_op, shifts, batch_size=None, num_workers=None, params=None):
+        """
+        Evaluate the shifted circuits with a thread pool, every thread binds the shifted parameters to its own copy of the IR.
+        The copies are shared with `evaluate_batch`, and the circuits with less than `parallel_min_qubits` qubits
+        are evaluated on one thread by default.
+        """
+        self.assemble(ir)
+        if params is None:
+            params = ir.params_snapshot()
+        num_workers = self._num_workers(ir, num_workers, len(shifts))
+        if num_workers == 1 or len(shifts) <= 1:
+            return super().evaluate_shifted(ir, config, measure_op, shifts, params=params)
+
+        def evaluate_one(shift):
+            with self._worker_ir(ir) as worker_ir:
+                return super(BasicSimulatorBackend, self).evaluate_shifted(worker_ir, config, measure_op, [shift],
+                                                                           params=params)[0]
+
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            return list(pool.map(evaluate_one, shifts))
+
+    @staticmethod
+    def _expectation(hamiltonian, psi):
+        if not isinstance(hamiltonian, (onp.ndarray, sparse.csr_matrix, PauliSumOperator)):
+            raise ValueError(
+                f'The hamiltonian type is wrong. '
+                f'Expected `np.ndarray, sparse.csr_matrix, PauliSumOperator, list`, but got `{type(hamiltonian)}`'
+            )
+        if isinstance(hamiltonian, PauliSumOperator):
+            return hamiltonian.expectation(psi)
+        return onp.real(psi.conj().T @ hamiltonian @ psi)
+
+    def evaluate_many(self, ir, config, measure_ops):
+        """
+        Simulate the circuit once and derive the expectation values, probabilities and states of all
+        the measure_ops from the final state. The other measure_ops are evaluated with their own circuits.
+
+        Returns:
+            The list of values in the order of measure_ops, and the result of the shared simulation.
+        """
+        res = None
+        values = []
+        for measure_op in measure_ops:
+            if not from_final_state(measure_op):
+                values.append(self.evaluate(ir, config, measure_op)[0])
+                continue
+            if res is None:
+                res = self.execute(ir, config)
+                psi = onp.array(res.states)
+            if measure_op.mtype == 'expval':
+                values.append(self._expectation(measure_op.hamiltonian, psi))
+            elif measure_op.mtype == 'prob':
+                mqubits = measure_op.mqubits if measure_op.mqubits is not None else config.metadata.get('mqubits')
+                values.append(marginal_probabilities(onp.abs(psi) ** 2, ir.qnum, mqubits))
+            else:
+                values.append(psi)
+        return values, res
+
     def evaluate(self, ir, config, measure_op):
         if measure_op is None:
             raise ValueError(
                 'The measure_op should not be None.'
             )
+        if isinstance(measure_op, list):
+            return self.evaluate_many(ir, config, measure_op)
         if isinstance(measure_op.hamiltonian, list):
             value = 0.0
             hamiltonian = measure_op.hamiltonian
             mqubits = config.metadata['mqubits'] if 'mqubits' in config.metadata else list(range(ir.qnum))
-            for i, (pstr, coeff) in enumerate(hamiltonian):
-                h_part = PauliBuilder(pstr).to_gate()
+            if measure_op.pauli_mode == 'state':
+                res = self.execute(ir, config)
+                value = calculate_pauli_expectation_from_state(hamiltonian, res.states, mqubits[:len(hamiltonian[0][0])])
+                return value, res
+            for basis, terms in group_qubit_wise_commuting(hamiltonian):
+                h_part = PauliBuilder(basis).to_gate()
                 node_idx = _add_pauli_gate(h_part, mqubits, ir)
                 result = self.execute(ir, config)
                 ir.remove_nodes(node_idx)
-                value += coeff * calculate_pauli_expectation(pstr, result.probabilities)
+                for pstr, coeff in terms:
+                    value += coeff * calculate_pauli_expectation(pstr, result.probabilities)
             return value, None
         else:
             if measure_op.mqubits is not None:
                 config.configure_measure_qubits(measure_op.mqubits)
             res = self.execute(ir, config)
             if measure_op.mtype == 'expval':
-                hamiltonian = measure_op.hamiltonian
-                if not isinstance(hamiltonian, (onp.ndarray, sparse.csr_matrix)):
-                    raise ValueError(
-                        f'The hamiltonian type is wrong. '
-                        f'Expected `np.ndarray, sparse.csr_matrix, list`, but got `{type(hamiltonian)}`'
-                    )
-                psi = onp.array(res.states)
-                value = onp.real(psi.conj().T @ hamiltonian @ psi)
+                value = self._expectation(measure_op.hamiltonian, onp.array(res.states))
             elif measure_op.mtype == 'prob':
                 if 'mqubits' in config.metadata:
                     np_probs = onp.zeros(2 ** (len(config.metadata['mqubits'])))
@@ -220,7 +445,7 @@ class BasicSimulatorBackend(BaseBackend):
             execute_params.append(ar.asarray(param, like='spinq', trainable=requires_grad(param)))
         return execute_params
 
-    @functools.lru_cache
+    @check_once
     def check_node(self, ir, place_holder):
         # self.assemble(ir)
         if place_holder is not None:
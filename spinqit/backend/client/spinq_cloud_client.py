@@ -13,7 +13,10 @@
 # limitations under the License.
 
 from .spinq_session import SpinQSession
+import base64
 import json
+import threading
+import time
 from typing import Optional
 from spinqit.model.exceptions import SpinQCloudUserAuthenticationError
 
@@ -21,8 +24,30 @@ USER_URI_PREFIX = "/user/spinqit"
 PLATFORM_URI_PREFIX = "/platform/spinqit"
 TASK_URI_PREFIX = "/task/user"
 RETRY_COUNT = 3
+# The lifetime assumed for a token without an expiry time, in seconds
+TOKEN_TTL = 1800
+# A token is refreshed this many seconds before it expires
+TOKEN_REFRESH_MARGIN = 60
+
+
+def _token_expiry(token: str) -> Optional[float]:
+    """
+    The `exp` claim of a JWT token, None if the token is not a JWT.
+    """
+    try:
+        payload = token.split('.')[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        return float(claims['exp'])
+    except Exception:
+        return None
+
 
 class SpinQCloudClient():
+    """
+    The client of the SpinQ cloud API. The client logs in on the first request, and logs in again before the
+    token expires. It can be shared by threads, a token which is rejected by the server is refreshed once for
+    all the requests which used it.
+    """
 
     def __init__(self, username, signature, host, session: Optional[SpinQSession] = None):
         """SipinQCloudClient constructor"""
@@ -30,16 +55,41 @@ class SpinQCloudClient():
         self.signature = signature
         self.host = host
         self._session = session if session is not None else SpinQSession()
+        self._token = None
+        self._token_expiry = 0.
+        self._login_lock = threading.Lock()
 
     @property
     def session(self):
         return self._session
 
+    def _valid_token(self) -> Optional[str]:
+        """
+        The current token, logging in first if there is no token or it is about to expire.
+        """
+        token = self._token
+        if token is not None and time.time() < self._token_expiry - TOKEN_REFRESH_MARGIN:
+            return token
+        with self._login_lock:
+            if self._token is None or time.time() >= self._token_expiry - TOKEN_REFRESH_MARGIN:
+                self.login()
+            return self._token
+
+    def _refresh_token(self, rejected_token: Optional[str]):
+        """
+        Log in again after the server rejected `rejected_token`, unless another thread has refreshed it.
+        """
+        with self._login_lock:
+            if self._token == rejected_token:
+                self.login()
+                print("Access token timeout. Automatically refreshed identity.")
+
     def _retry_request(self, rquest_func, retry_count, *args):
+        token = self._valid_token()
         res = rquest_func(*args)
         while res.status_code == 401 and retry_count > 0:
-            self.login()
-            print("Access token timeout. Automatically refreshed identity.")
+            self._refresh_token(token)
+            token = self._token
             res = rquest_func(*args)
             retry_count = retry_count - 1
         return res
@@ -55,6 +105,9 @@ class SpinQCloudClient():
         if res:
             access_token = res_entity["token"]
             self.session.setHeader("token", access_token)
+            expiry = _token_expiry(access_token)
+            self._token_expiry = expiry if expiry is not None else time.time() + TOKEN_TTL
+            self._token = access_token
         else:
             err_msg = "Authentication failed: " + res_entity["msg"] if res_entity.__contains__("msg") and res_entity["msg"] is not None else "Authentication failed"
             raise SpinQCloudUserAuthenticationError(err_msg)
@@ -63,9 +116,12 @@ class SpinQCloudClient():
     Platform API
     '''
 
-    def retrieve_remote_platforms(self):
+    def _retrieve_remote_platforms(self):
         return self._session.get(self.host + PLATFORM_URI_PREFIX + "/getPlatformListV2")
 
+    def retrieve_remote_platforms(self, retry_count: int = RETRY_COUNT):
+        return self._retry_request(self._retrieve_remote_platforms, retry_count)
+
     '''
     Task API
     '''
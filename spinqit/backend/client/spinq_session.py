@@ -16,11 +16,20 @@ from requests import Session, RequestException, Response
 from requests.adapters import HTTPAdapter
 
 class SpinQSession(Session):
-    
-    def __init__(self):
+    """
+    The HTTP session of the SpinQ cloud. The connections are kept alive in a pool of `pool_maxsize`
+    connections per host, which should be at least the number of threads sharing the session.
+    """
+
+    def __init__(self, pool_connections: int = 4, pool_maxsize: int = 16):
         """SipinQSession constructor"""
         super().__init__()
-        self.headers.update({'Content-Type': 'application/json'})
+        self.headers.update({'Content-Type': 'application/json',
+                             'Accept-Encoding': 'gzip, deflate',
+                             'Connection': 'keep-alive'})
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
 
     def setHeader(self, key: str, value: str):
-        self.headers.update({key: value})
\ No newline at end of file
+        self.headers.update({key: value})
@@ -12,18 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from typing import List
-import functools
 import time
 import numpy as onp
-from copy import deepcopy
 from math import pi
 from scipy import sparse
 from autoray import numpy as ar
 
-from .backend_util import get_graph_capsule, _add_pauli_gate
+from .backend_util import get_graph_capsule, _add_pauli_gate, check_once
 from .basebackend import BaseBackend
 from ..utils import requires_grad
-from ..primitive import PauliBuilder, calculate_pauli_expectation, pauli_decompose
+from ..primitive import PauliBuilder, calculate_pauli_expectation, pauli_decompose, group_qubit_wise_commuting, \
+    PauliSumOperator
 from spinqit.compiler import IntermediateRepresentation, NodeType
 from spinqit.model import Instruction
 from spinqit.model import Ry, Rz, Sd, P, CX, CY, CZ, SWAP, CCX, U, MEASURE, StateVector
@@ -152,6 +151,7 @@ class NMRBackend(BaseBackend):
                 elif v['name'] == StateVector.label:
                     raise CircuitOperationValidationError("Current platform does not support " + v['name'] + " gate.")
             i += 1
+        ir.mark_modified()
 
     def execute(self, ir: IntermediateRepresentation, config: NMRConfig):
         self.assemble(ir)
@@ -173,7 +173,7 @@ class NMRBackend(BaseBackend):
             self.check_node(ir, place_holder)
             self.update_param(ir, params_for_grad)
             val, res = self.evaluate(ir, config, measure_op)
-            backward_fn = grad_func_hardware(deepcopy(ir), params_for_grad, config, self, measure_op, res, grad_method)
+            backward_fn = grad_func_hardware(ir, params_for_grad, config, self, measure_op, res, grad_method)
             return val, backward_fn
 
         return value_and_grad_fn
@@ -183,23 +183,31 @@ class NMRBackend(BaseBackend):
             raise ValueError(
                 'The measure_op should not be None.'
             )
+        if measure_op.pauli_mode == 'state':
+            raise ValueError(
+                f'The {self.__class__.__name__} can not evaluate the hamiltonian from the state, '
+                f'use the `circuit` pauli_mode.'
+            )
         if measure_op.mqubits is not None:
             config.configure_measure_qubits(measure_op.mqubits)
         
         if measure_op.mtype == 'expval':
             hamiltonian = measure_op.hamiltonian
-            if isinstance(hamiltonian, (onp.ndarray, sparse.csr_matrix)):
+            if isinstance(hamiltonian, PauliSumOperator):
+                hamiltonian = hamiltonian.pauli_string_list
+            elif isinstance(hamiltonian, (onp.ndarray, sparse.csr_matrix)):
                 if isinstance(hamiltonian, sparse.csr_matrix):
                     hamiltonian = hamiltonian.A
                 hamiltonian = pauli_decompose(hamiltonian)
             value = 0.0
             mqubits = config.metadata['mqubits'] if 'mqubits' in config.metadata else list(range(ir.qnum))
-            for pstr, coeff in hamiltonian:
-                h_part = PauliBuilder(pstr).to_gate()
+            for basis, terms in group_qubit_wise_commuting(hamiltonian):
+                h_part = PauliBuilder(basis).to_gate()
                 node_idx = _add_pauli_gate(h_part, mqubits, ir)
                 result = self.execute(ir, config)
                 ir.remove_nodes(node_idx)
-                value += coeff * calculate_pauli_expectation(pstr, result.probabilities)
+                for pstr, coeff in terms:
+                    value += coeff * calculate_pauli_expectation(pstr, result.probabilities)
             return value, None
         elif measure_op.mtype == 'prob':
             res = self.execute(ir, config)
@@ -242,7 +250,7 @@ class NMRBackend(BaseBackend):
             execute_params.append(ar.asarray(param, like='spinq', trainable=requires_grad(param)))
         return execute_params
 
-    @functools.lru_cache
+    @check_once
     def check_node(self, ir, place_holder):
         # self.assemble(ir)
         if place_holder is not None:
@@ -13,7 +13,8 @@
 # limitations under the License.
 import os
 import functools
-from collections import Counter
+import weakref
+from collections import OrderedDict
 from copy import deepcopy
 from typing import List, Iterable
 
@@ -21,13 +22,16 @@ from autoray import numpy as ar
 import numpy as onp
 from scipy import sparse
 
-from spinqit.backend.backend_util import _add_pauli_gate
+from spinqit.backend.backend_util import _add_pauli_gate, check_once, marginal_probabilities
 from spinqit.primitive.pauli_builder import PauliBuilder
-from .basebackend import BaseBackend
+from spinqit.primitive.pauli_expectation import group_qubit_wise_commuting, PauliSumOperator
+from .basebackend import BaseBackend, from_final_state
+from .sampling import Sampler, to_counts
 from spinqit.grad import grad_func_torch
 from spinqit.model.parameter import LazyParameter, Parameter
-from spinqit.utils.function import _topological_sort, _dfs, requires_grad
+from spinqit.utils.function import requires_grad
 from spinqit.compiler.ir import IntermediateRepresentation as IR
+from spinqit.compiler.optimizer import GateFusion
 try:
     import torch
     dtype = torch.complex64
@@ -43,19 +47,34 @@ def torch_matrix(label, params=None):
     return torch_mat
 
 
+def _angle(x):
+    """
+    A single angle gives one matrix, a batch of angles gives a matrix for each of them.
+    """
+    x = torch.as_tensor(x)
+    if x.numel() == 1:
+        x = x.reshape(())
+    return x[..., None, None]
+
+
 def _P(x):
-    return torch.diag(torch.tensor([1, -1], dtype=dtype) ** (x / torch.pi)).to(device)
+    x = _angle(x)
+    i, z = torch_matrix('I'), torch_matrix('Z')
+    return (0.5 * (i + z) + 0.5 * torch.exp(1j * x) * (i - z)).to(device, dtype)
 
 
 def _Rx(x):
+    x = _angle(x)
     return (torch.cos(x / 2) * torch_matrix('I') - 1j * torch.sin(x / 2) * torch_matrix('X')).to(device, dtype)
 
 
 def _Ry(x):
+    x = _angle(x)
     return (torch.cos(x / 2) * torch_matrix('I') - 1j * torch.sin(x / 2) * torch_matrix('Y')).to(device, dtype)
 
 
 def _Rz(x):
+    x = _angle(x)
     return (torch.cos(x / 2) * torch_matrix('I') - 1j * torch.sin(x / 2) * torch_matrix('Z')).to(device, dtype)
 
 
@@ -73,6 +92,8 @@ class TorchSimulatorConfig:
         self.mqubits = None
         self.shots = None
         self.n_threads = os.cpu_count()//2
+        self.fusion_width = None
+        self.seed = None
 
     def configure_shots(self, shots: int):
         self.shots = shots
@@ -83,6 +104,20 @@ class TorchSimulatorConfig:
     def configure_num_thread(self, n_threads):
         self.n_threads = n_threads
 
+    def configure_gate_fusion(self, max_width: int = 2):
+        """
+        Fuse the consecutive constant gates on at most `max_width` qubits into one unitary
+        before the simulation. The trainable gates are not fused.
+        """
+        self.fusion_width = max_width
+
+    def configure_seed(self, seed: int = None):
+        """
+        Seed the sampling of the counts. None draws the seed from the torch generator,
+        so the counts are reproducible with `torch.manual_seed`.
+        """
+        self.seed = seed
+
     @staticmethod
     def set_device(new_device):
         global device
@@ -131,25 +166,33 @@ class TorchResult:
     def __str__(self):
         return f'Counts :{self.counts}, States :{self.states}, Prob :{self.probabilities}'    
 
+    @property
+    def shots(self) -> int:
+        return 1024 if self.config.shots is None else self.config.shots
+
+    @lazy_property
+    def sampler(self) -> Sampler:
+        seed = self.config.seed
+        if seed is None:
+            seed = torch.randint(0, 2 ** 62, (1,)).item()
+        return Sampler(self.raw_probabilities, seed=seed)
+
+    @lazy_property
+    def histogram(self) -> onp.ndarray:
+        """
+        The counts of the outcomes as an integer array of the (batch,) 2^m outcomes.
+        """
+        return self.sampler.histogram(self.shots)
+
     @lazy_property
     def counts(self):
-        shots = self.config.shots
-        if shots is None:
-            shots = 1024
-        probabilities, batch = self._process_prob(self.config, self.states)
-        probabilities = probabilities.cpu()
-        if not batch:
-            counts = Counter(torch.multinomial(probabilities, shots, True).tolist())
-            return {bin(key)[2:].zfill(int(onp.log2(len(probabilities)))): count
-                    for key, count in sorted(counts.items()) if count != 0}
-        else:
-            _counts = {}
-            for i in range(batch[0]):
-                counts = Counter(torch.multinomial(probabilities[i], shots, True).tolist())
-                _counts[f'batch {i}'] = {
-                    bin(key)[2:].zfill(int(onp.log2(len(probabilities[i])))): count
-                    for key, count in sorted(counts.items()) if count != 0}
-            return _counts
+        return to_counts(self.histogram, self.sampler.width)
+
+    def sample(self, shots: int = None) -> onp.ndarray:
+        """
+        Draw the measured outcomes as integers, with the shape (shots,) or (batch, shots).
+        """
+        return self.sampler.sample(self.shots if shots is None else shots)
 
     @lazy_property
     def probabilities(self):
@@ -218,17 +261,15 @@ class TorchSimulator:
         return self.result
 
     def get_final_state(self, ir, state):
-        vids = _topological_sort(ir.dag)
-        for i in vids:
-            v = ir.dag.vs[i]
-            node_params = v['params'] if 'params' in v.attributes() else []
-            if v['type'] == 0:
-                if v['name'] == 'StateVector':
-                    state = self._state_vector_node(node_params, ir.qnum)
-                else:
-                    state = self._op_node(v['name'], node_params, state, v['qubits'], ir.qnum)
-            elif v['type'] == 1:
-                state = self._caller_node(v['name'], node_params, state, v['qubits'], ir.qnum, ir.dag)
+        plan = ir.compile_plan()
+        for step, node_params in plan.bind(ir.dag):
+            if step.type == 7:
+                gate = torch.from_numpy(IR.get_unitary(ir.dag.vs[step.vid])).to(device, dtype)
+                state = self._apply_gate(state, gate, step.qubits, ir.qnum)
+            elif step.name == 'StateVector':
+                state = self._state_vector_node(node_params, ir.qnum)
+            else:
+                state = self._op_node(step.name, node_params, state, step.qubits, ir.qnum)
         return state
 
     @staticmethod
@@ -255,9 +296,10 @@ class TorchSimulator:
         return state
 
     def _op_node(self, label, params, state, qubits, qubits_num):
-        # The trainable gate used the torch rewrite gate function, otherwise the used the spinqit.gate.matrix and
-        # convert to the torch tensor.
-        if params is not None and any((isinstance(p, torch.Tensor) and p.requires_grad is True) for p in params):
+        # The trainable or batched gate used the torch rewrite gate function, otherwise the used the spinqit.gate.matrix
+        # and convert to the torch tensor.
+        if params is not None and any((isinstance(p, torch.Tensor) and (p.requires_grad is True or p.numel() > 1))
+                                      for p in params) and label.lower() in rotations:
             if isinstance(params, list) and len(params) == 1:
                 params = params[0]
             gate = rotations[label.lower()](params)
@@ -266,36 +308,13 @@ class TorchSimulator:
         state = self._apply_gate(state, gate, qubits, qubits_num)
         return state
 
-    def _caller_node(self, label, params, state, qubits, qubits_num, graph, ):
-        def_node = graph.vs.find(label, type=2)
-
-        topo_sort_list = []
-        visited = set()
-        _dfs(def_node.index, graph, visited, topo_sort_list)
-        topo_sort_list = topo_sort_list[::-1]
-        for node_idx in topo_sort_list:
-            node = graph.vs[node_idx]
-            if node.index != def_node.index:
-                local = [qubits[i] for i in node['qubits']]
-                plambda = None if 'params' not in node.attributes() else node['params']
-                if 'pindex' in node.attributes() and node['pindex'] is not None:
-                    try:
-                        p = [f(*[params[idx] for idx in node['pindex']]) for f in plambda]
-                    except Exception:
-                        p = [f([params[idx] for idx in node['pindex']]) for f in plambda]
-                    callee_params = [] if not plambda else p
-                else:
-                    callee_params = [] if not plambda else [f(params) for f in plambda]
-                if node['type'] == 3:
-                    state = self._op_node(node['name'], callee_params, state, local, qubits_num)
-                elif node['type'] == 1:
-                    state = self._caller_node(node['name'], callee_params, state, local, qubits_num, graph)
-        return state
-
     def _apply_gate(self, state, gate, qubit_idx: List[int], num_qubits: int):
 
         if not isinstance(qubit_idx, Iterable):
             qubit_idx = [qubit_idx]
+        if gate.dim() > 2 and state.dim() < gate.dim() - 1:
+            # The first batched gate broadcasts the state to the batch
+            state = state.expand(list(gate.shape[:-2]) + list(state.shape))
 
         swap_ops = self._get_swap_ops(qubit_idx, num_qubits)
         state = self._apply_gate_fn(state, gate, swap_ops, num_qubits, qubit_idx, )
@@ -365,21 +384,61 @@ def torch_pauli_expectation(pauli_string, probabilities):
             raise ValueError('The input string is not a Pauli string')
 
     f = functools.reduce(torch.kron, mat)
-    if len(probabilities.shape) < 2:
+    batched = len(probabilities.shape) > 1
+    if not batched:
         probabilities = probabilities.unsqueeze(0)
     expect_val = (probabilities * f).sum(dim=1)
-    return expect_val[0]
+    return expect_val if batched else expect_val[0]
+
+
+def _extend_pauli_string(pauli_string: str, qubits: List, qubit_num: int) -> str:
+    """
+    The pauli string on all the qubit_num qubits, the characters act on the first qubits in `qubits`.
+    """
+    chars = ['I'] * qubit_num
+    for ch, q in zip(pauli_string, qubits):
+        chars[q] = ch
+    return ''.join(chars)
 
 
 class TorchSimulatorBackend(BaseBackend):
+    simulation_cache_size = 32
+
     def __init__(self):
         super().__init__()
 
         self.simulator = TorchSimulator()
+        self._simulation_irs = OrderedDict()
+
+    def _simulation_ir(self, ir, config):
+        """
+        The copy of the IR simulated by the functions of `get_value_and_grad_fn`, with the gate fusion applied.
+        The torch interface asks for a new function in every forward pass, so the copy is kept
+        until the structure of the IR or the fusion width changes. The gradients are calculated
+        with the parameters of their own forward pass, the copy can be shared by the functions.
+        """
+        key = id(ir)
+        plan = ir.compile_plan()
+        entry = self._simulation_irs.get(key)
+        if entry is None or entry[0]() is not ir or entry[1] is not plan or entry[2] != config.fusion_width:
+            simulation_ir = deepcopy(ir)
+            if config.fusion_width is not None:
+                GateFusion(config.fusion_width).run(simulation_ir)
+            entry = (weakref.ref(ir), plan, config.fusion_width, simulation_ir)
+            self._simulation_irs[key] = entry
+            if len(self._simulation_irs) > self.simulation_cache_size:
+                self._simulation_irs.popitem(last=False)
+        else:
+            self._simulation_irs.move_to_end(key)
+        return entry[3]
 
     def execute(self, ir, config):
-        result = self.simulator(ir, config)
-        return result
+        # The results with the graph of the backprop are not cached
+        if self.result_cache is None or torch.is_grad_enabled():
+            return self.simulator(ir, config)
+        config_key = (repr(config.mqubits), config.shots, config.seed, str(device), str(dtype))
+        return self._execute_cached(ir, config_key, lambda: self.simulator(ir, config),
+                                    lambda result: 2 * result.states.element_size() * result.states.numel())
 
     def get_value_and_grad_fn(self, ir, config, measure_op=None, place_holder=None, grad_method=None):
         if not IMPORTED:
@@ -387,63 +446,177 @@ class TorchSimulatorBackend(BaseBackend):
                 'The torch has not been installed, use other backend or try to install torch.'
             )
         self.check_node(ir, place_holder)
-        ir = deepcopy(ir)
+        ir = self._simulation_ir(ir, config)
 
         def value_and_grad_fn(params):
+            # The gate parameters keep requires_grad so that the trainable gates can be found,
+            # only the backprop records the graph of the simulation.
+            with torch.enable_grad():
+                params_for_grad = self.process_params(params)
+                self.update_param(ir, params_for_grad)
             if grad_method == 'backprop':
                 execute_grad_mode = torch.enable_grad
             else:
                 execute_grad_mode = torch.no_grad
             with execute_grad_mode():
-                params_for_grad = self.process_params(params)
-                self.update_param(ir, params_for_grad)
-                val, _ = self.evaluate(ir, config, measure_op)
-                backward_fn = grad_func_torch(ir, params_for_grad, config, self, measure_op, val, grad_method)
+                val, res = self.evaluate(ir, config, measure_op)
+                backward_fn = grad_func_torch(ir, params_for_grad, config, self, measure_op, val, grad_method, res)
+            if isinstance(val, list):
+                return [v.cpu().detach().numpy() if hasattr(v, 'cpu') else v for v in val], backward_fn
             return val.cpu().detach().numpy() if hasattr(val, 'cpu') else val, backward_fn
 
         return value_and_grad_fn
 
+    def evaluate_batch(self, ir, config, measure_op, place_holder, params_batch, batch_size=None, num_workers=None):
+        """
+        Simulate the parameter sets together with a batch dimension in the state, the outputs of a list of
+        measure_ops are derived from the same batched state as in `evaluate_many`. The batches run on the simulation copy of the IR, whose parameters are put back afterwards,
+        so the IR is neither copied nor fused again for every batch.
+        """
+        if not IMPORTED:
+            raise ImportError(
+                'The torch has not been installed, use other backend or try to install torch.'
+            )
+        self.check_node(ir, place_holder)
+        ir = self._simulation_ir(ir, config)
+        measure_ops = measure_op if isinstance(measure_op, list) else [measure_op]
+        with ir.bound_params(ir.params_snapshot()):
+            if any(op.mtype == 'count' for op in measure_ops):
+                return super().evaluate_batch(ir, config, measure_op, place_holder, params_batch)
+
+            total = len(params_batch[0])
+            batch_size = batch_size or total
+            values = [[] for _ in measure_ops]
+            with torch.no_grad():
+                for start in range(0, total, batch_size):
+                    chunk = [[p[i] for p in params_batch] for i in range(start, min(start + batch_size, total))]
+                    size = len(chunk)
+                    self._update_param_batch(ir, chunk)
+                    value, _ = self.evaluate(ir, config, measure_op)
+                    for k, (op, v) in enumerate(zip(measure_ops, value if isinstance(measure_op, list) else [value])):
+                        v = torch.as_tensor(v)
+                        if op.mtype == 'expval' and v.dim() == 0 or op.mtype in ['prob', 'state'] and v.dim() == 1:
+                            # No gate depends on the parameters
+                            v = v.expand([size] + list(v.shape))
+                        values[k].append(v.cpu().numpy())
+        outputs = [onp.concatenate(v) for v in values]
+        return outputs if isinstance(measure_op, list) else outputs[0]
+
+    def evaluate_shifted(self, ir, config, measure_op, shifts, batch_size=None, num_workers=None, params=None):
+        """
+        Simulate the shifted circuits together, the shifted gate parameters get a batch dimension
+        and the other gates are shared by the whole batch.
+        """
+        if params is None:
+            params = ir.params_snapshot()
+        measure_ops = measure_op if isinstance(measure_op, list) else [measure_op]
+        if any(op.mtype == 'count' for op in measure_ops):
+            return super().evaluate_shifted(ir, config, measure_op, shifts, params=params)
+        batch_size = batch_size or len(shifts)
+        values = []
+        with torch.no_grad():
+            for start in range(0, len(shifts), batch_size):
+                chunk = shifts[start:start + batch_size]
+                # The batched parameters are written into a copy of the parameter lists
+                buffer = list(params)
+                batched = set()
+                for k, (vid, index, value) in enumerate(chunk):
+                    if (vid, index) not in batched:
+                        if all(v != vid for v, _ in batched):
+                            buffer[vid] = list(buffer[vid])
+                        base = torch.as_tensor(buffer[vid][index]).reshape(())
+                        buffer[vid][index] = base.expand(len(chunk)).clone()
+                        batched.add((vid, index))
+                    buffer[vid][index][k] = torch.as_tensor(value).reshape(())
+                with ir.bound_params(buffer):
+                    value, _ = self.evaluate(ir, config, measure_op)
+                if len(chunk) == 1:
+                    values.append(value)
+                elif isinstance(measure_op, list):
+                    values.extend(list(v) for v in zip(*[torch.as_tensor(v).unbind(0) for v in value]))
+                else:
+                    values.extend(torch.as_tensor(value).unbind(0))
+        return values
+
+    def _expectation(self, hamiltonian, state):
+        if not isinstance(hamiltonian, (onp.ndarray, sparse.csr_matrix, PauliSumOperator)):
+            raise ValueError(
+                f'The hamiltonian type is wrong. '
+                f'Expected `np.ndarray, sparse.csr_matrix, PauliSumOperator, list`, but got `{type(hamiltonian)}`'
+            )
+        if isinstance(hamiltonian, PauliSumOperator):
+            return hamiltonian.expectation(state)
+        if isinstance(hamiltonian, onp.ndarray):
+            hamiltonian = torch.as_tensor(hamiltonian, dtype, device)
+        elif isinstance(hamiltonian, sparse.csr_matrix):
+            hamiltonian = self._scipy_sparse_mat_to_torch_sparse_tensor(hamiltonian)
+        else:
+            hamiltonian = hamiltonian.to(device, dtype)
+        b = state.conj()
+        if len(state.shape) > 1:
+            k = hamiltonian @ state.T
+            return torch.real((b * k.T).sum(dim=-1))
+        k = hamiltonian @ state
+        return torch.real(b @ k)
+
+    def evaluate_many(self, ir, config, measure_ops):
+        """
+        Simulate the circuit once and derive the expectation values, probabilities and states of all
+        the measure_ops from the final state, so the backprop runs one backward pass through the simulation.
+        The other measure_ops are evaluated with their own circuits.
+
+        Returns:
+            The list of values in the order of measure_ops, and the result of the shared simulation.
+        """
+        res = None
+        values = []
+        for measure_op in measure_ops:
+            if not from_final_state(measure_op):
+                values.append(self.evaluate(ir, config, measure_op)[0])
+                continue
+            if res is None:
+                res = self.execute(ir, config)
+            if measure_op.mtype == 'expval':
+                values.append(self._expectation(measure_op.hamiltonian, res.states))
+            elif measure_op.mtype == 'prob':
+                mqubits = measure_op.mqubits if measure_op.mqubits is not None else config.mqubits
+                values.append(marginal_probabilities(torch.abs(res.states) ** 2, ir.qnum, mqubits))
+            else:
+                values.append(res.states)
+        return values, res
+
     def evaluate(self, ir, config, measure_op):
         if measure_op is None:
             raise ValueError(
                 'The measure_op should not be None.'
             )
+        if isinstance(measure_op, list):
+            return self.evaluate_many(ir, config, measure_op)
         if isinstance(measure_op.hamiltonian, list):
             value = 0.0
             hamiltonian = measure_op.hamiltonian
             mqubits = config.mqubits if config.mqubits is not None else list(range(ir.qnum))
-            for i, (pstr, coeff) in enumerate(hamiltonian):
-                h_part = PauliBuilder(pstr).to_gate()
+            if measure_op.pauli_mode == 'state':
+                # The pauli strings are extended to all the qubits, so the terms are applied to the final state
+                # in the autograd graph and for every state in a batch
+                res = self.execute(ir, config)
+                operator = PauliSumOperator([(_extend_pauli_string(pstr, mqubits, ir.qnum), coeff)
+                                             for pstr, coeff in hamiltonian])
+                return operator.expectation(res.states), res
+            for basis, terms in group_qubit_wise_commuting(hamiltonian):
+                h_part = PauliBuilder(basis).to_gate()
                 node_idx = _add_pauli_gate(h_part, mqubits, ir)
                 result = self.execute(ir, config)
                 ir.remove_nodes(node_idx)
-                value += coeff * torch_pauli_expectation(pstr, result.raw_probabilities)
+                for pstr, coeff in terms:
+                    value += coeff * torch_pauli_expectation(pstr, result.raw_probabilities)
             return value, None
         else:
             if measure_op.mqubits is not None:
                 config.configure_measure_qubits(measure_op.mqubits)
             res = self.execute(ir, config)
             if measure_op.mtype == 'expval':
-                hamiltonian = measure_op.hamiltonian
-                if not isinstance(hamiltonian, (onp.ndarray, sparse.csr_matrix)):
-                    raise ValueError(
-                        f'The hamiltonian type is wrong. '
-                        f'Expected `np.ndarray, sparse.csr_matrix, list`, but got `{type(hamiltonian)}`'
-                    )
-                if isinstance(hamiltonian, onp.ndarray):
-                    hamiltonian = torch.as_tensor(hamiltonian, dtype, device)
-                elif isinstance(hamiltonian, sparse.csr_matrix):
-                    hamiltonian = self._scipy_sparse_mat_to_torch_sparse_tensor(hamiltonian)
-                else:
-                    hamiltonian = hamiltonian.to(device, dtype)
-                state = res.states
-                b = state.conj()
-                if len(state.shape) > 1:
-                    k = hamiltonian @ state.T
-                    value = torch.real(torch.diagonal(b @ k))
-                else:
-                    k = hamiltonian @ state
-                    value = torch.real(b @ k)
+                value = self._expectation(measure_op.hamiltonian, res.states)
             elif measure_op.mtype == 'prob':
                 value = res.raw_probabilities
             elif measure_op.mtype == 'count':
@@ -475,6 +648,23 @@ class TorchSimulatorBackend(BaseBackend):
 
                     v['params'] = _params
 
+    @staticmethod
+    def _update_param_batch(ir, params_sets):
+        """
+        Evaluate the parameter functions for every parameter set, and stack the values
+        along the first dimension which is the batch dimension of the gates.
+        """
+        for v in ir.dag.vs:
+            if v['type'] in [0, 1] and 'func' in v.attributes() and v['func']:
+                _params = []
+                for f in v['func']:
+                    if callable(f):
+                        _p = torch.as_tensor(onp.stack([onp.asarray(f(params)).squeeze() for params in params_sets]))
+                    else:
+                        _p = torch.as_tensor(f)
+                    _params.append(_p)
+                v['params'] = _params
+
     @staticmethod
     def process_params(new_params):
         """
@@ -488,7 +678,7 @@ class TorchSimulatorBackend(BaseBackend):
         return execute_params
 
     @staticmethod
-    @functools.lru_cache
+    @check_once
     def check_node(ir, place_holder):
         if place_holder is not None:
             for v in ir.dag.vs:
@@ -11,9 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import functools
 from collections import defaultdict
-from copy import deepcopy
 
 import numpy as onp
 from scipy import sparse
@@ -21,9 +19,9 @@ from scipy import sparse
 from spinqit import CP
 from spinqit.compiler.ir import NodeType
 
-from .backend_util import _add_pauli_gate
+from .backend_util import _add_pauli_gate, check_once
 from ..model.parameter import LazyParameter
-from ..primitive import PauliBuilder, calculate_pauli_expectation
+from ..primitive import PauliBuilder, calculate_pauli_expectation, group_qubit_wise_commuting, PauliSumOperator
 from ..utils.function import _flatten, requires_grad
 from autoray import numpy as ar
 from spinqit.grad import grad_func_spinq
@@ -121,7 +119,7 @@ class QasmBackend:
             execute_params.append(ar.asarray(param, like='spinq', trainable=requires_grad(param)))
         return execute_params
 
-    @functools.lru_cache
+    @check_once
     def check_node(self, ir, place_holder):
 
         if place_holder is not None:
@@ -143,7 +141,7 @@ class QasmBackend:
             self.check_node(ir, place_holder)
             self.update_param(ir, params_for_grad)
             val, res = self.evaluate(ir, config, measure_op)
-            backward_fn = grad_func_spinq(deepcopy(ir), params_for_grad, config, self, measure_op, res, grad_method)
+            backward_fn = grad_func_spinq(ir, params_for_grad, config, self, measure_op, res, grad_method)
             return val, backward_fn
 
         return value_and_grad_fn
@@ -153,16 +151,22 @@ class QasmBackend:
             raise ValueError(
                 'The measure_op should not be None.'
             )
+        if measure_op.pauli_mode == 'state':
+            raise ValueError(
+                f'The {self.__class__.__name__} can not evaluate the hamiltonian from the state, '
+                f'use the `circuit` pauli_mode.'
+            )
         if isinstance(measure_op.hamiltonian, list):
             value = 0.0
             hamiltonian = measure_op.hamiltonian
             mqubits = config.mqubits if config.mqubits is not None else list(range(ir.qnum))
-            for i, (pstr, coeff) in enumerate(hamiltonian):
-                h_part = PauliBuilder(pstr).to_gate()
+            for basis, terms in group_qubit_wise_commuting(hamiltonian):
+                h_part = PauliBuilder(basis).to_gate()
                 node_idx = _add_pauli_gate(h_part, mqubits, ir)
                 result = self.execute(ir, config)
                 ir.remove_nodes(node_idx)
-                value += coeff * calculate_pauli_expectation(pstr, result.probabilities)
+                for pstr, coeff in terms:
+                    value += coeff * calculate_pauli_expectation(pstr, result.probabilities)
             return value, None
         else:
             if measure_op.mqubits is not None:
@@ -170,13 +174,16 @@ class QasmBackend:
             res = self.execute(ir, config)
             if measure_op.mtype == 'expval':
                 hamiltonian = measure_op.hamiltonian
-                if not isinstance(hamiltonian, (onp.ndarray, sparse.csr_matrix)):
+                if not isinstance(hamiltonian, (onp.ndarray, sparse.csr_matrix, PauliSumOperator)):
                     raise ValueError(
                         f'The hamiltonian type is wrong. '
-                        f'Expected `np.ndarray, sparse.csr_matrix, list`, but got `{type(hamiltonian)}`'
+                        f'Expected `np.ndarray, sparse.csr_matrix, PauliSumOperator, list`, but got `{type(hamiltonian)}`'
                     )
                 psi = onp.array(res.states)
-                value = onp.real(psi.conj() @ hamiltonian @ psi)
+                if isinstance(hamiltonian, PauliSumOperator):
+                    value = hamiltonian.expectation(psi)
+                else:
+                    value = onp.real(psi.conj() @ hamiltonian @ psi)
             elif measure_op.mtype == 'prob':
                 if 'mqubits' in config.metadata:
                     np_probs = onp.zeros(2 ** (len(config.metadata['mqubits'])))
@@ -304,7 +311,15 @@ class QasmBackend:
                         visited.add(idx)
 
                     qasm_content += '}\n'
-            elif v['type'] == NodeType.op.value:
+            visited.add(i)
+
+        # The gates are written in the topological order of the dag,
+        # the vertex indices are not ordered after the optimization passes substitute nodes.
+        for i in ir.compile_plan().top_level:
+            v = ir.dag.vs[i]
+            if i in ir.include_gate:
+                continue
+            if v['type'] == NodeType.op.value:
                 conbits = [creg_dict[i][0] for i in ir.get_conbits(i)]
                 if 'cmp' in v.attributes() and v['cmp'] is not None:
                     relation = comparator_map[v['cmp']]
@@ -337,7 +352,6 @@ class QasmBackend:
                     qasm_content += f'{gate} {",".join(qubits)};\n'
                 else:
                     qasm_content += f'{gate}({",".join(map(str, param))}) {",".join(qubits)};\n'
-            visited.add(i)
         return qasm_content
 
     @staticmethod
@@ -0,0 +1,122 @@
+# Copyright 2023 SpinQ Technology Co., Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+from typing import Optional
+
+import numpy as onp
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'max_bytes', 'nbytes', 'entries'])
+
+def _param_bytes(value) -> Optional[bytes]:
+    if hasattr(value, 'detach'):
+        value = value.detach().cpu().numpy()
+    try:
+        array = onp.asarray(value)
+    except Exception:
+        return None
+    if array.dtype == object:
+        return None
+    return str(array.dtype).encode() + str(array.shape).encode() + onp.ascontiguousarray(array).tobytes()
+
+
+def params_digest(ir) -> Optional[bytes]:
+    """
+    The hash of the parameter values of the op and caller nodes, None if a value can not be hashed.
+    """
+    g = ir.dag
+    if 'params' not in g.vs.attributes():
+        return b''
+    h = hashlib.blake2b(digest_size=16)
+    for vid, (vtype, params) in enumerate(zip(g.vs['type'], g.vs['params'])):
+        if vtype not in (0, 1) or params is None:
+            continue
+        h.update(vid.to_bytes(8, 'little'))
+        for p in params:
+            data = _param_bytes(p)
+            if data is None:
+                return None
+            h.update(data)
+    return h.digest()
+
+
+class ResultCache:
+    """
+    A bounded LRU cache of the execution results of a backend, keyed by the fingerprint of the IR,
+    the values of the gate parameters and the configuration of the execution.
+    The states have 2^n amplitudes, so the cache is bounded by the estimated size of the results in bytes,
+    the least recently used results are dropped first.
+
+    The cached result is returned as it is, e.g. the `counts` sampled for a result are the same for every hit.
+
+    Args:
+        max_bytes (int): The memory budget of the cached results. Default to 256MB.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 2 ** 20):
+        if max_bytes < 0:
+            raise ValueError(
+                f'The max_bytes of the result cache should not be negative, but got {max_bytes}'
+            )
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(ir, config_key) -> Optional[tuple]:
+        """
+        The key of the IR with its current parameters, None if the parameters can not be hashed.
+        The IRs built separately for the same circuit share the key.
+        """
+        digest = params_digest(ir)
+        if digest is None:
+            return None
+        return ir.fingerprint(), digest, config_key
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, result, nbytes: int):
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (result, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, dropped) = self._entries.popitem(last=False)
+                self.nbytes -= dropped
+
+    def cache_info(self) -> CacheInfo:
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.max_bytes, self.nbytes, len(self._entries))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
@@ -0,0 +1,135 @@
+# Copyright 2023 SpinQ Technology Co., Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import Dict, List, Tuple
+
+import numpy as onp
+
+from .backend_util import marginal_probabilities
+
+# The number of shots drawn at once, bounds the memory of the temporary arrays
+SAMPLE_CHUNK = 2 ** 22
+
+
+def alias_table(probabilities) -> Tuple[onp.ndarray, onp.ndarray]:
+    """
+    Build the alias table of Walker's alias method, so every draw is one uniform index and one comparison.
+
+    The table is the same as the one of Vose's algorithm with the small and large outcomes in index order,
+    but it is computed with cumulative sums instead of a loop: the deficits 1 - n * p of the small outcomes
+    are laid on a line, and taken from the surpluses n * p - 1 of the large outcomes laid on the same line.
+    A small outcome is aliased to the large outcome where its deficit starts. A large outcome whose surplus
+    ends inside the deficit of a small outcome gives the rest of that deficit as well, and is aliased to
+    the next large outcome.
+
+    Returns:
+        The acceptance probability and the alias of every outcome.
+    """
+    p = onp.asarray(probabilities, dtype=float)
+    n = len(p)
+    q = p / p.sum() * n
+    accept = onp.ones(n)
+    alias = onp.arange(n)
+    small = onp.flatnonzero(q < 1)
+    large = onp.flatnonzero(q >= 1)
+    if len(small) == 0 or len(large) == 0:
+        return accept, alias
+
+    deficits = onp.cumsum(1 - q[small])
+    surpluses = onp.cumsum(q[large] - 1)
+    starts = deficits - (1 - q[small])
+    donors = onp.minimum(onp.searchsorted(surpluses, starts, side='right'), len(large) - 1)
+    accept[small] = q[small]
+    alias[small] = large[donors]
+
+    inside = onp.searchsorted(deficits, surpluses[:-1], side='right')
+    inside = onp.minimum(inside, len(small) - 1)
+    # The surplus of the large outcome k ends strictly inside the deficit of the small outcome `inside[k]`
+    crossed = onp.flatnonzero((starts[inside] < surpluses[:-1]) & (surpluses[:-1] < deficits[inside]))
+    accept[large[crossed]] = 1 - (deficits[inside[crossed]] - surpluses[crossed])
+    alias[large[crossed]] = large[crossed + 1]
+    onp.clip(accept, 0., 1., out=accept)
+    return accept, alias
+
+
+class Sampler:
+    """
+    Draw the measurement outcomes of a probability distribution, or of a batch of them along the leading axis.
+    The outcomes are the integer indices of the probabilities, the bit strings are only made by `to_counts`.
+
+    The draws of `sample` use the alias method, every shot costs O(1) after an O(n) setup.
+    The `histogram` draws the counts of all the outcomes together from the multinomial distribution,
+    without the individual shots.
+
+    Args:
+        probabilities: The probabilities of the 2^n outcomes, numpy array or torch tensor.
+        mqubits (List): The qubits to measure, the other qubits are summed out before sampling.
+            The measured qubits are in ascending order in the outcomes.
+        seed: The seed or the numpy Generator. Default to a new Generator.
+    """
+
+    def __init__(self, probabilities, mqubits: List = None, seed=None):
+        if hasattr(probabilities, 'detach'):
+            probabilities = probabilities.detach().cpu().numpy()
+        probabilities = onp.asarray(probabilities, dtype=float)
+        qubit_num = int(onp.log2(probabilities.shape[-1]))
+        probabilities = marginal_probabilities(probabilities, qubit_num, mqubits)
+        self.probabilities = onp.clip(probabilities, 0., None)
+        self.width = int(onp.log2(self.probabilities.shape[-1]))
+        self.batched = self.probabilities.ndim > 1
+        self.rng = seed if isinstance(seed, onp.random.Generator) else onp.random.default_rng(seed)
+        self._tables = None
+
+    def _rows(self):
+        return self.probabilities if self.batched else self.probabilities[None]
+
+    def sample(self, shots: int) -> onp.ndarray:
+        """
+        The outcomes of `shots` measurements, with the shape (shots,) or (batch, shots).
+        """
+        if self._tables is None:
+            self._tables = [alias_table(row) for row in self._rows()]
+        n = self.probabilities.shape[-1]
+        samples = onp.empty((len(self._tables), shots), dtype=onp.int64)
+        for b, (accept, alias) in enumerate(self._tables):
+            for start in range(0, shots, SAMPLE_CHUNK):
+                size = min(SAMPLE_CHUNK, shots - start)
+                index = self.rng.integers(0, n, size=size)
+                keep = self.rng.random(size) < accept[index]
+                samples[b, start:start + size] = onp.where(keep, index, alias[index])
+        return samples if self.batched else samples[0]
+
+    def histogram(self, shots: int) -> onp.ndarray:
+        """
+        The number of times every outcome is measured in `shots` measurements, with the shape of the probabilities.
+        """
+        rows = self._rows()
+        counts = self.rng.multinomial(shots, rows / rows.sum(axis=-1, keepdims=True))
+        return counts if self.batched else counts[0]
+
+    def counts(self, shots: int):
+        """
+        The counts as a dict of bit strings, see `to_counts`.
+        """
+        return to_counts(self.histogram(shots), self.width)
+
+
+def to_counts(histogram, width: int) -> Dict:
+    """
+    The dict of bit strings of the measured outcomes in ascending order, only the outcomes which are measured
+    are converted. For a batch of histograms, a dict of them for every `batch i`.
+    """
+    histogram = onp.asarray(histogram)
+    if histogram.ndim > 1:
+        return {f'batch {i}': to_counts(row, width) for i, row in enumerate(histogram)}
+    return {format(int(k), f'0{width}b'): int(histogram[k]) for k in onp.flatnonzero(histogram)}
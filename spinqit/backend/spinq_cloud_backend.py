@@ -11,15 +11,17 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from typing import Dict, List, Optional, Union
+from typing import Dict, List, Optional, Sequence, Union
+import asyncio
 import base64
-import functools
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
 import numpy as onp
 from math import pi
 from datetime import datetime, timedelta
 import json
-from copy import deepcopy
 from autoray import numpy as ar
 from scipy import sparse
 from Crypto.Hash import SHA256
@@ -36,9 +38,11 @@ from spinqit.model import Ry, Rz, P, T, Td, S, Sd, CP, SWAP, CCX, U, MEASURE, St
 from spinqit.model import Instruction
 from spinqit.compiler.ir import NodeType, IntermediateRepresentation
 from spinqit.grad import grad_func_hardware
-from .backend_util import get_graph_capsule, _add_pauli_gate
+from .backend_util import get_graph_capsule, _add_pauli_gate, check_once
 from .layout import generate_direct_layout, collect_gate_qubits
-from ..primitive import PauliBuilder, calculate_pauli_expectation, pauli_decompose
+from .task_result_store import TaskResultStore
+from ..primitive import PauliBuilder, calculate_pauli_expectation, pauli_decompose, group_qubit_wise_commuting, \
+    PauliSumOperator
 from ..utils.function import requires_grad
 
 class SpinQCloudConfig:
@@ -57,6 +61,11 @@ class SpinQCloudConfig:
         self.metadata['calc_matrix'] = calc_matrix
     def configure_process_now(self, process_now: bool):
         self.metadata['process_now'] = process_now
+    def configure_result_store(self, use_store: bool):
+        """
+        Whether to reuse the stored result of the same task, False to always run the task for fresh samples.
+        """
+        self.metadata['use_result_store'] = use_store
 
     def configure_measured_qubits(self, mqubits: Union[List, range]):
         if isinstance(mqubits, range):
@@ -99,6 +108,16 @@ class SpinQCloudResult:
 
 class SpinQCloudBackend:
     MAX_RETRIES = 3
+    # The result polling starts with POLL_INTERVAL seconds, and backs off by POLL_BACKOFF up to MAX_POLL_INTERVAL
+    POLL_INTERVAL = 0.5
+    POLL_BACKOFF = 2
+    MAX_POLL_INTERVAL = 5
+    MAX_CONCURRENCY = 8
+    # The status of a task whose result is reused from the result store, it is not submitted again
+    STORED_STATUS = 304
+    result_store = None
+    # The seconds the platform list is cached for
+    PLATFORM_TTL = 300
 
     def __init__(self, username: str, keyfile: str, host:str):
         message = username.encode(encoding="utf-8")
@@ -114,14 +133,34 @@ class SpinQCloudBackend:
         signature = base64.b64encode(sign)
         signature = str(signature, encoding = "utf-8")
         self._api_client = SpinQCloudClient(username, signature, host)
-        self._platforms = []
+        self._platforms = None
+        self._platforms_time = 0.
+        self._platforms_lock = threading.Lock()
+        self._store_keys = {}
         # self.__qubit_mapping = None
-        self._login()
-        self.refresh_remote_platforms()
+        # The client logs in on the first request, and the platforms are retrieved when they are used
 
     def _login(self):
         self._api_client.login()
 
+    def enable_result_store(self, path: str = None, ttl: float = None, max_entries: int = 4096) -> TaskResultStore:
+        """
+        Keep the results of the tasks on disk, so a task with the same request as a stored one is not submitted
+        again. Use `SpinQCloudConfig.configure_result_store(False)` to run a task for fresh samples.
+
+        Args:
+            path (str): The database file. Default to `~/.spinqit/task_results.sqlite`.
+            ttl (float): The seconds a result is valid for. Default to keep the results until they are evicted.
+            max_entries (int): The maximal number of results. Default to 4096.
+        """
+        # The stored results of other hosts and accounts are not reused
+        scope = f'{self._api_client.username}@{self._api_client.host}'
+        self.result_store = TaskResultStore(path, ttl, max_entries, scope)
+        return self.result_store
+
+    def disable_result_store(self):
+        self.result_store = None
+
     def filterOutUnused(self, ir: IntermediateRepresentation):
         '''
         Return a subgraph of the origin graph with no unused definitions
@@ -157,6 +196,7 @@ class SpinQCloudBackend:
             unused_sub_idx_set.update(sub_idx_list)
         
         ir.dag.delete_vertices(unused_sub_idx_set)
+        ir.mark_modified()
 
     def assemble(self, platform_code: str, ir: IntermediateRepresentation):
 
@@ -254,12 +294,13 @@ class SpinQCloudBackend:
                 elif v['name'] == StateVector.label:
                     raise CircuitOperationValidationError("Current platform does not support " + v['name'] + " gate.")
             i += 1
+        ir.mark_modified()
 
     def refresh_remote_platforms(self):
-        res = self._platforms = self._api_client.retrieve_remote_platforms()
+        res = self._api_client.retrieve_remote_platforms()
         if res:
             res_entity = json.loads(res.content)
-            self._platforms = []
+            platforms = []
             for p in res_entity["items"]:
                 gate_list = []
                 for gname in p["supportGateName"]:
@@ -274,24 +315,35 @@ class SpinQCloudBackend:
                         for v in vlist:
                             coupling_map.append((int(k)-1, int(v)-1))
                 simu = p["simu"] if "simu" in p else False    
-                self._platforms.append(Platform(p["pcode"], p["pname"], p["maxBitNum"], p["countOnlineMachine"], gate_list, coupling_map, simu, active_qubits))
+                platforms.append(Platform(p["pcode"], p["pname"], p["maxBitNum"], p["countOnlineMachine"], gate_list, coupling_map, simu, active_qubits))
+            self._platforms = platforms
+            self._platforms_time = time.time()
         else:
             raise SpinQCloudServerError("Error occurs when retrieving platforms on cloud.")
 
     @property
     def platforms(self):
+        """
+        The platforms of the cloud, retrieved on the first use and again when they are older than PLATFORM_TTL seconds.
+        """
+        if self._platforms is None or time.time() - self._platforms_time > self.PLATFORM_TTL:
+            with self._platforms_lock:
+                if self._platforms is None or time.time() - self._platforms_time > self.PLATFORM_TTL:
+                    self.refresh_remote_platforms()
         return self._platforms
 
     def get_platform_list(self) -> Platform:
-        if len(self._platforms) == 0:
+        platforms = self.platforms
+        if len(platforms) == 0:
             raise NotFoundError("No platform is available.")
         else:
-            return [p.code for p in self._platforms]
+            return [p.code for p in platforms]
         
     def get_platform(self, code: str) -> Platform:
-        if len(self._platforms) == 0:
+        platforms = self.platforms
+        if len(platforms) == 0:
             raise NotFoundError("No platform is available.")
-        for p in self._platforms:
+        for p in platforms:
             if p.code == code: return p
         raise NotFoundError(f'Platform "{code}" not found or access denied. Check if the platform exists and you have the permission.')
 
@@ -342,13 +394,22 @@ class SpinQCloudBackend:
             if log_to_phy is not None:
                 log_to_phy = {k+1: v+1 for k, v in log_to_phy.items()}
             newTask = Task(name, platform_code, ir.dag['qnum'], ir.dag['cnum'], circuit, log_to_phy, calc_matrix, shots, process_now, description, False, None, "spinqit", measured_qubits, self._api_client)
+            request = newTask.to_request()
             if debug:
-                print(json.dumps(newTask.to_request()))
+                print(json.dumps(request))
             else:
-                res = self._api_client.create_task(newTask.to_request())
+                # A task which opts out of the store still replaces the stored result with the fresh one
+                store_key = self.result_store.key(request) if self.result_store is not None else None
+                if store_key is not None and config.metadata.get('use_result_store', True):
+                    stored = self.result_store.get(store_key)
+                    if stored is not None:
+                        return SpinQCloudBackend.STORED_STATUS, 'The result is reused from the result store.', stored.task_code
+                res = self._api_client.create_task(request)
                 res_entity = json.loads(res.content)
                 if res:
                     task_code = res_entity["task"]["tcode"] if "task" in res_entity and "tcode" in res_entity["task"] else None
+                    if store_key is not None and task_code is not None:
+                        self._store_keys[task_code] = store_key
                     return res_entity['status'], res_entity['msg'], task_code
                 elif res.status_code == 412 or res.status_code == 406 or res.status_code == 424:
                     return res_entity['status'], res_entity['msg'], None
@@ -380,14 +441,10 @@ class SpinQCloudBackend:
         else:
             raise SpinQCloudServerError(f'Get task failed: status code = {res_entity["status"]}. Message = {res_entity["msg"]}')
             
-    def execute(self, ir, config: SpinQCloudConfig):
-        '''
-        We do not process density matrix for now. This execute method is synchronous and there must be a result.
-        '''
+    def _submit_with_retries(self, ir, config: SpinQCloudConfig):
         for i in range(SpinQCloudBackend.MAX_RETRIES):
             try:
-                status, msg, task_code = self.submit_task(ir, config)
-                break
+                return self.submit_task(ir, config)
             except NotFoundError as e:
                 raise e   
             except RequestPreconditionFailedError as e:
@@ -403,53 +460,236 @@ class SpinQCloudBackend:
                     time.sleep(3)
                 else:
                     raise SpinQCloudServerError('Max retries exceeded. Execution failed.')        
+
+    @staticmethod
+    def _running_task_code(status, msg, task_code):
+        """
+        The task code of a submitted task which is being processed, None if it is only saved on the cloud.
+        """
         if status == 200 or status == 202:
             print(f'Task {task_code} has been submitted successfully. Please wait for processing.')
-            result = self.get_task_result(task_code)
-            return result
+            return task_code
+        elif status == SpinQCloudBackend.STORED_STATUS:
+            print(f'Task {task_code} has the same request, its stored result is reused.')
+            return task_code
         elif status == 226:
             print(f'Task {task_code} has been submitted and saved successfully, but no machine online now. Please try again to execute it later.')
         elif status == 206:
             print(f'Task {task_code} has been submitted and saved successfully, but no available machine fits its topology. Please try again to execute it later.')
         else:
             raise SpinQCloudServerError(f'Task submission failed: status code = {status}. Message = {msg}')
+        return None
 
-    def get_task_result(self, task_code: str, filter_str:str = None, hanging:bool = True, timeout:Optional[int] = None):
+    def execute(self, ir, config: SpinQCloudConfig):
+        '''
+        We do not process density matrix for now. This execute method is synchronous and there must be a result.
+        '''
+        task_code = self._running_task_code(*self._submit_with_retries(ir, config))
+        if task_code is not None:
+            return self.get_task_result(task_code)
+
+    def _next_poll_interval(self, interval: float) -> float:
+        return min(interval * self.POLL_BACKOFF, self.MAX_POLL_INTERVAL)
+
+    def _task_result_from_entity(self, task_code: str, res_entity, filter_str: str = None):
+        result = SpinQCloudResult(task_code, None, None)
+        if res_entity["taskStatus"] == 'F':
+            errMsg = res_entity["taskErrMsg"] if "taskErrMsg" in res_entity else None
+            print(f'Task {task_code} failed, error message: {errMsg}.')
+            self._store_keys.pop(task_code, None)
+            return
+        if "module" in res_entity["run"] and res_entity["run"]["module"] is not None:
+            result._prob = res_entity["run"]["module"]
+        if "count" in res_entity["run"] and res_entity["run"]["count"] is not None:
+            result._counts = res_entity["run"]["count"]
+        if "shots" in res_entity and res_entity["shots"] is not None:
+            result._shots = res_entity["shots"]
+        else:
+            result._shots = 1024
+        # A filtered result is not the whole result of the task
+        store_key = self._store_keys.pop(task_code, None) if filter_str is None else None
+        if self.result_store is not None and store_key is not None:
+            self.result_store.put(store_key, task_code, result._counts, result._prob, result._shots)
+        return result
+
+    def _stored_result(self, task_code: str, filter_str: str = None, use_store: bool = True):
+        if self.result_store is None or not use_store or filter_str is not None:
+            return None
+        stored = self.result_store.get_by_task_code(task_code)
+        if stored is None:
+            return None
+        result = SpinQCloudResult(task_code, None, None)
+        result._counts, result._prob, result._shots = stored.counts, stored.probabilities, stored.shots
+        return result
+
+    def get_task_result(self, task_code: str, filter_str:str = None, hanging:bool = True, timeout:Optional[int] = None,
+                        use_store: bool = True):
+        try:
+            return self._poll_task_result(task_code, filter_str, hanging, timeout, use_store)
+        except (SpinQCloudUserAuthenticationError, TaskStatusError, RequestTimeoutError) as eo:
+            raise eo
+        except Exception as eo :
+            raise Exception(str(eo))
+
+    def _poll_task_result(self, task_code: str, filter_str: str = None, hanging: bool = True,
+                          timeout: Optional[int] = None, use_store: bool = True):
+        """
+        Poll the result of a task until it is finished, the errors of the task are raised with their own types.
+        """
+        result = self._stored_result(task_code, filter_str, use_store)
+        if result is not None:
+            return result
         start_time = datetime.now()
         if timeout is not None:
             end_time = start_time + timedelta(seconds=timeout)
-        count = 0
+        interval = self.POLL_INTERVAL
         while (timeout is None or datetime.now() < end_time):
-            count = count + 1
             try:
                 res_entity = self._get_task_result(task_code, filter_str)
-                result = SpinQCloudResult(task_code, None, None)
-                if res_entity["taskStatus"] == 'F':
-                    errMsg = res_entity["taskErrMsg"] if "taskErrMsg" in res_entity else None
-                    print(f'Task {task_code} failed, error message: {errMsg}.')
-                    return
-                else:
-                    if "module" in res_entity["run"] and res_entity["run"]["module"] is not None:
-                        result._prob = res_entity["run"]["module"]
-                    if "count" in res_entity["run"] and res_entity["run"]["count"] is not None:
-                        result._counts = res_entity["run"]["count"]
-                    if "shots" in res_entity and res_entity["shots"] is not None:
-                        result._shots = res_entity["shots"]
-                    else:
-                        result._shots = 1024
-                    return result
-            except SpinQCloudUserAuthenticationError as eo:
-                raise eo
+                return self._task_result_from_entity(task_code, res_entity, filter_str)
             except TaskStatusError as eo:
                 if hanging:
-                    time.sleep(5)
+                    time.sleep(interval)
+                    interval = self._next_poll_interval(interval)
                     continue
                 else:
                     raise eo
-            except Exception as eo :
-                raise Exception(str(eo))
         raise RequestTimeoutError("Find result timeout.")
 
+    @staticmethod
+    def _config_list(irs: Sequence, configs) -> List[SpinQCloudConfig]:
+        if isinstance(configs, SpinQCloudConfig):
+            return [configs] * len(irs)
+        if len(configs) != len(irs):
+            raise ValueError(
+                f'The numbers of circuits and configs are different, {len(irs)} and {len(configs)}'
+            )
+        return list(configs)
+
+    @staticmethod
+    def _in_event_loop() -> bool:
+        try:
+            asyncio.get_running_loop()
+            return True
+        except RuntimeError:
+            return False
+
+    async def submit_many_async(self, irs: Sequence[IntermediateRepresentation],
+                                configs: Union[SpinQCloudConfig, Sequence[SpinQCloudConfig]],
+                                max_concurrency: int = None) -> List[Optional[str]]:
+        """
+        Submit the tasks of many circuits concurrently, at most `max_concurrency` requests are sent at once
+        over the session of the client.
+
+        Args:
+            irs: The IRs of the circuits, every IR is assembled for the platform in place.
+            configs: The config of every circuit, or one config for all of them.
+            max_concurrency: The maximal number of outstanding requests. Default to MAX_CONCURRENCY.
+
+        Returns:
+            The task codes in the order of the circuits, None for a task which is saved but not processed.
+        """
+        configs = self._config_list(irs, configs)
+        max_concurrency = max_concurrency or self.MAX_CONCURRENCY
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            submissions = [loop.run_in_executor(executor, self._submit_with_retries, ir, config)
+                           for ir, config in zip(irs, configs)]
+            return [self._running_task_code(*submission) for submission in await asyncio.gather(*submissions)]
+
+    async def gather_results_async(self, task_codes: Sequence[Optional[str]], filter_str: str = None,
+                                   timeout: Optional[int] = None,
+                                   max_concurrency: int = None) -> List:
+        """
+        Wait for the results of many tasks. Every task is polled with an exponential backoff from POLL_INTERVAL
+        to MAX_POLL_INTERVAL seconds, the waiting tasks do not hold a thread, and at most `max_concurrency`
+        requests are sent at once. A failed task does not stop the other tasks, its error is returned
+        in its place, e.g. SpinQCloudServerError for a task failed on the platform or RequestTimeoutError.
+
+        Args:
+            task_codes: The task codes, e.g. from `submit_many_async`.
+            filter_str: The filter of the results.
+            timeout: The seconds to wait for every task. Default to wait until the task is finished.
+            max_concurrency: The maximal number of outstanding requests. Default to MAX_CONCURRENCY.
+
+        Returns:
+            The results in the order of the task codes, the error for a failed task, and None for a None task code.
+        """
+        max_concurrency = max_concurrency or self.MAX_CONCURRENCY
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def wait_result(task_code):
+            if task_code is None:
+                return None
+            result = self._stored_result(task_code, filter_str)
+            if result is not None:
+                return result
+            end_time = None if timeout is None else loop.time() + timeout
+            interval = self.POLL_INTERVAL
+            while end_time is None or loop.time() < end_time:
+                async with semaphore:
+                    try:
+                        res_entity = await loop.run_in_executor(executor, self._get_task_result, task_code, filter_str)
+                        return self._task_result_from_entity(task_code, res_entity, filter_str)
+                    except TaskStatusError:
+                        pass
+                await asyncio.sleep(interval)
+                interval = self._next_poll_interval(interval)
+            raise RequestTimeoutError("Find result timeout.")
+
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            results = await asyncio.gather(*[wait_result(task_code) for task_code in task_codes],
+                                           return_exceptions=True)
+        for result in results:
+            # The cancellation and the interruption are not errors of the tasks
+            if isinstance(result, BaseException) and not isinstance(result, Exception):
+                raise result
+        return list(results)
+
+    def submit_many(self, irs: Sequence[IntermediateRepresentation],
+                    configs: Union[SpinQCloudConfig, Sequence[SpinQCloudConfig]],
+                    max_concurrency: int = None) -> List[Optional[str]]:
+        """
+        The synchronous `submit_many_async`. In a running event loop, e.g. a notebook, the tasks are submitted
+        on `max_concurrency` threads instead.
+        """
+        if not self._in_event_loop():
+            return asyncio.run(self.submit_many_async(irs, configs, max_concurrency))
+        configs = self._config_list(irs, configs)
+        with ThreadPoolExecutor(max_workers=max_concurrency or self.MAX_CONCURRENCY) as executor:
+            submissions = list(executor.map(self._submit_with_retries, irs, configs))
+        return [self._running_task_code(*submission) for submission in submissions]
+
+    def gather_results(self, task_codes: Sequence[Optional[str]], filter_str: str = None,
+                       timeout: Optional[int] = None, max_concurrency: int = None) -> List:
+        """
+        The synchronous `gather_results_async`. In a running event loop, e.g. a notebook, every task is polled
+        on `max_concurrency` threads instead, with the same results and errors.
+        """
+        if not self._in_event_loop():
+            return asyncio.run(self.gather_results_async(task_codes, filter_str, timeout, max_concurrency))
+
+        def wait_result(task_code):
+            if task_code is None:
+                return None
+            try:
+                return self._poll_task_result(task_code, filter_str, timeout=timeout)
+            except Exception as eo:
+                return eo
+
+        with ThreadPoolExecutor(max_workers=max_concurrency or self.MAX_CONCURRENCY) as executor:
+            return list(executor.map(wait_result, task_codes))
+
+    def execute_many(self, irs: Sequence[IntermediateRepresentation],
+                     configs: Union[SpinQCloudConfig, Sequence[SpinQCloudConfig]],
+                     max_concurrency: int = None) -> List:
+        """
+        Execute many circuits with all the tasks outstanding together, instead of one `execute` after another.
+        The results are the same as `gather_results`, with the error of every failed task in its place.
+        """
+        return self.gather_results(self.submit_many(irs, configs, max_concurrency), max_concurrency=max_concurrency)
+
     def _get_task_result(self, task_code: str, filter_str:str = None):
         res = self._api_client.task_result(task_code, filter_str)
         res_entity = json.loads(res.content)
@@ -475,7 +715,7 @@ class SpinQCloudBackend:
             self.check_node(ir, place_holder)
             self.update_param(ir, params_for_grad)
             val, res = self.evaluate(ir, config, measure_op)
-            backward_fn = grad_func_hardware(deepcopy(ir), params_for_grad, config, self, measure_op, res, grad_method)
+            backward_fn = grad_func_hardware(ir, params_for_grad, config, self, measure_op, res, grad_method)
             return val, backward_fn
 
         return value_and_grad_fn
@@ -498,23 +738,38 @@ class SpinQCloudBackend:
             raise ValueError(
                 'The measure_op should not be None.'
             )
+        if measure_op.pauli_mode == 'state':
+            raise ValueError(
+                f'The {self.__class__.__name__} can not evaluate the hamiltonian from the state, '
+                f'use the `circuit` pauli_mode.'
+            )
         if measure_op.mqubits is not None:
             config.configure_measure_qubits(measure_op.mqubits)
 
         if measure_op.mtype == 'expval':
             hamiltonian = measure_op.hamiltonian
-            if isinstance(hamiltonian, (onp.ndarray, sparse.csr_matrix)):
+            if isinstance(hamiltonian, PauliSumOperator):
+                hamiltonian = hamiltonian.pauli_string_list
+            elif isinstance(hamiltonian, (onp.ndarray, sparse.csr_matrix)):
                 if isinstance(hamiltonian, sparse.csr_matrix):
                     hamiltonian = hamiltonian.A
                 hamiltonian = pauli_decompose(hamiltonian)
             value = 0.0
             mqubits = config.metadata['mqubits'] if 'mqubits' in config.metadata else list(range(ir.qnum))
-            for pstr, coeff in hamiltonian:
-                h_part = PauliBuilder(pstr).to_gate()
-                node_idx = _add_pauli_gate(h_part, mqubits, ir)
-                result = self.execute(ir, config)                
-                ir.remove_nodes(node_idx)
-                value += coeff * calculate_pauli_expectation(pstr, result.probabilities)
+            # Every group is a separate task, and all of them are outstanding on the cloud together
+            groups = list(group_qubit_wise_commuting(hamiltonian))
+            group_irs = []
+            for basis, _ in groups:
+                group_ir = deepcopy(ir)
+                _add_pauli_gate(PauliBuilder(basis).to_gate(), mqubits, group_ir)
+                group_irs.append(group_ir)
+            results = self.execute_many(group_irs, config)
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+            for (_, terms), result in zip(groups, results):
+                for pstr, coeff in terms:
+                    value += coeff * calculate_pauli_expectation(pstr, result.probabilities)
             return value, None
         elif measure_op.mtype == 'prob':
             res = self.execute(ir, config)
@@ -557,7 +812,7 @@ class SpinQCloudBackend:
             execute_params.append(ar.asarray(param, like='spinq', trainable=requires_grad(param)))
         return execute_params
 
-    @functools.lru_cache
+    @check_once
     def check_node(self, ir, place_holder):
         # self.assemble(ir)
         if place_holder is not None:
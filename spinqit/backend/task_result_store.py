@@ -0,0 +1,143 @@
+# Copyright 2023 SpinQ Technology Co., Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from contextlib import closing
+from typing import Dict, Optional
+
+StoredResult = namedtuple('StoredResult', ['task_code', 'counts', 'probabilities', 'shots'])
+
+# The fields of a task request which do not change the result of the task
+VOLATILE_FIELDS = ('tname', 'description', 'proceedNow')
+
+DEFAULT_STORE_PATH = os.path.join(os.path.expanduser('~'), '.spinqit', 'task_results.sqlite')
+
+
+class TaskResultStore:
+    """
+    An on-disk store of the results of the cloud tasks, keyed by the hash of the task request without the
+    volatile fields, so a circuit which is submitted again with the same shots and platform reuses the result
+    instead of waiting in the queue again. The results are kept in a SQLite database which can be shared by
+    processes, and by the clients of several hosts and users with their own scopes.
+
+    Args:
+        path (str): The database file. Default to `~/.spinqit/task_results.sqlite`.
+        ttl (float): The seconds a result is valid for. Default to keep the results until they are evicted.
+        max_entries (int): The maximal number of results, the least recently used results are dropped first.
+        scope (str): The cloud host and user of the results, e.g. `user@host`. The results stored
+            with other scopes are not visible, the same task on another cloud or account is submitted again.
+    """
+
+    def __init__(self, path: str = None, ttl: float = None, max_entries: int = 4096, scope: str = ''):
+        if max_entries < 1:
+            raise ValueError(
+                f'The max_entries of the task result store should be a positive integer, but got {max_entries}'
+            )
+        self.path = path or DEFAULT_STORE_PATH
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.scope = scope
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS task_results (key TEXT PRIMARY KEY, scope TEXT, task_code TEXT, '
+                         'shots INTEGER, counts TEXT, prob TEXT, created REAL, accessed REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS task_results_task_code ON task_results (scope, task_code)')
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        return _Transaction(conn)
+
+    def key(self, request: Dict) -> str:
+        """
+        The hash of a task request from `Task.to_request()` in the scope of the store, without the volatile fields.
+        """
+        content = {k: v for k, v in request.items() if k not in VOLATILE_FIELDS}
+        data = json.dumps({'scope': self.scope, 'request': content}, sort_keys=True, separators=(',', ':'),
+                          default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def _get(self, column: str, value: str) -> Optional[StoredResult]:
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute(f'SELECT key, task_code, counts, prob, shots, created FROM task_results '
+                               f'WHERE {column} = ? AND scope = ?', (value, self.scope)).fetchone()
+            if row is None:
+                return None
+            key, task_code, counts, prob, shots, created = row
+            if self.ttl is not None and now - created > self.ttl:
+                conn.execute('DELETE FROM task_results WHERE key = ?', (key,))
+                return None
+            conn.execute('UPDATE task_results SET accessed = ? WHERE key = ?', (now, key))
+        return StoredResult(task_code, _loads(counts), _loads(prob), shots)
+
+    def get(self, key: str) -> Optional[StoredResult]:
+        return self._get('key', key)
+
+    def get_by_task_code(self, task_code: str) -> Optional[StoredResult]:
+        return self._get('task_code', task_code)
+
+    def put(self, key: str, task_code: str, counts: Optional[Dict], probabilities: Optional[Dict], shots: int):
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO task_results VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                         (key, self.scope, task_code, shots, _dumps(counts), _dumps(probabilities), now, now))
+            self._evict(conn, now)
+
+    def _evict(self, conn, now: float):
+        if self.ttl is not None:
+            conn.execute('DELETE FROM task_results WHERE created < ?', (now - self.ttl,))
+        conn.execute('DELETE FROM task_results WHERE key NOT IN '
+                     '(SELECT key FROM task_results ORDER BY accessed DESC LIMIT ?)', (self.max_entries,))
+
+    def __len__(self):
+        with self._lock, self._connect() as conn:
+            return conn.execute('SELECT COUNT(*) FROM task_results WHERE scope = ?', (self.scope,)).fetchone()[0]
+
+    def clear(self):
+        with self._lock, self._connect() as conn:
+            conn.execute('DELETE FROM task_results WHERE scope = ?', (self.scope,))
+
+
+class _Transaction:
+    """
+    Commit the statements of a connection together and close it.
+    """
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def __enter__(self) -> sqlite3.Connection:
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        with closing(self.conn):
+            if exc_type is None:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+
+
+def _dumps(value) -> Optional[str]:
+    return None if value is None else json.dumps(value, separators=(',', ':'))
+
+
+def _loads(value: Optional[str]):
+    return None if value is None else json.loads(value)
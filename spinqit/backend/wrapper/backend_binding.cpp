@@ -28,7 +28,13 @@ PYBIND11_MODULE(spinq_backends, m) {
     
     py::class_<BasicSimulator>(m, "BasicSimulator")
     .def(py::init<>())
-    .def("execute", &BasicSimulator::execute);
+    .def("execute", &BasicSimulator::execute)
+    .def("prepare", &BasicSimulator::prepare);
+
+    py::class_<PreparedCircuit>(m, "PreparedCircuit")
+    .def("execute", &PreparedCircuit::execute)
+    .def("parameter_paths", &PreparedCircuit::parameter_paths)
+    .def_property_readonly("parameter_count", &PreparedCircuit::parameter_count);
     // .def("print_circuit", &BasicSimulator::printCircuit);
 
     py::class_<Nmr>(m, "NMR")
@@ -0,0 +1,155 @@
+# Copyright 2023 SpinQ Technology Co., Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+from spinqit.utils.function import _topological_sort, _dfs
+
+
+class PlanStep(NamedTuple):
+    """
+    One gate of the flattened circuit.
+
+    Attributes:
+        vid: The top level vertex which supplies the parameters of the step.
+        type: The node type of the top level vertex (op, caller or unitary).
+        name: The gate label.
+        qubits: The global qubits the gate acts on.
+        resolver: Maps the parameters of the top level vertex to the parameters of this gate.
+            It is None when the gate uses the vertex parameters directly.
+        path: The vertices from the top level vertex down to the callee, `(vid,)` for the op nodes.
+    """
+    vid: int
+    type: int
+    name: str
+    qubits: List[int]
+    resolver: Optional[Callable]
+    path: Tuple[int, ...]
+
+
+def _callee_resolver(plambda, pindex):
+    """
+    Bind the parameter functions of a callee node, with the same rules as the native simulator.
+    A function without arguments is a constant, an index -1 passes the whole parameter list,
+    otherwise the function takes `co_argcount` parameters picked by `pindex`.
+    """
+    if not plambda:
+        return lambda params: []
+
+    bindings = []
+    start = 0
+    for f in plambda:
+        if not callable(f):
+            bindings.append((lambda value=f: value, None))
+            continue
+        arg_count = f.__code__.co_argcount
+        if arg_count == 0:
+            bindings.append((f, None))
+            continue
+        index = list(pindex[start:start + arg_count]) if pindex else [-1]
+        bindings.append((f, -1 if index[0] == -1 else index))
+        start += arg_count
+
+    def resolve(params):
+        values = []
+        for f, index in bindings:
+            if index is None:
+                values.append(f())
+            elif index == -1:
+                values.append(f(params))
+            else:
+                values.append(f(*[params[i] for i in index]))
+        return values
+
+    return resolve
+
+
+def _compose(outer, inner):
+    if outer is None:
+        return inner
+    return lambda params: inner(outer(params))
+
+
+class ExecutionPlan:
+    """
+    A flat list of the gates in an IR, in topological order with the caller nodes inlined.
+    The plan only depends on the structure of the graph, the parameters are read from the graph
+    when the plan is bound, so one plan can be reused while the parameters are updated.
+    Use `IntermediateRepresentation.compile_plan` to get the cached plan of an IR.
+    """
+
+    def __init__(self, graph):
+        self.vcount = graph.vcount()
+        self.ecount = graph.ecount()
+        self.top_level = []
+        self.steps = []
+
+        names = graph.vs['name'] if self.vcount > 0 else []
+        types = graph.vs['type'] if self.vcount > 0 else []
+        qubits = graph.vs['qubits'] if self.vcount > 0 else []
+        attributes = graph.vs.attributes()
+        plambdas = graph.vs['params'] if 'params' in attributes else [None] * self.vcount
+        pindexes = graph.vs['pindex'] if 'pindex' in attributes else [None] * self.vcount
+
+        definitions = {}
+        for vid in _topological_sort(graph):
+            vtype = types[vid]
+            if vtype == 0 or vtype == 7:
+                self.top_level.append(vid)
+                self.steps.append(PlanStep(vid, vtype, names[vid], qubits[vid], None, (vid,)))
+            elif vtype == 1:
+                self.top_level.append(vid)
+                self._inline(graph, definitions, names, types, qubits, plambdas, pindexes,
+                             vid, names[vid], qubits[vid], None, (vid,))
+
+    def _inline(self, graph, definitions, names, types, qubits, plambdas, pindexes,
+                vid, label, global_qubits, resolver, path):
+        if label not in definitions:
+            def_node = graph.vs.find(label, type=2)
+            topo_sort_list = []
+            _dfs(def_node.index, graph, set(), topo_sort_list)
+            definitions[label] = [n for n in topo_sort_list[::-1] if n != def_node.index]
+
+        for node in definitions[label]:
+            local = [global_qubits[i] for i in qubits[node]]
+            node_resolver = _compose(resolver, _callee_resolver(plambdas[node], pindexes[node]))
+            if types[node] == 3:
+                self.steps.append(PlanStep(vid, 1, names[node], local, node_resolver, path + (node,)))
+            elif types[node] == 1:
+                self._inline(graph, definitions, names, types, qubits, plambdas, pindexes,
+                             vid, names[node], local, node_resolver, path + (node,))
+
+    def is_valid(self, graph) -> bool:
+        return graph.vcount() == self.vcount and graph.ecount() == self.ecount
+
+    def bind(self, graph, params=None):
+        """
+        Resolve the current parameters of every step.
+
+        Args:
+            params: The parameters of every vertex, e.g. from `IntermediateRepresentation.params_snapshot`.
+                Default to the parameters in the graph.
+
+        Returns:
+            A list of (step, params) in execution order, params is None for the gates without parameters.
+        """
+        if params is None:
+            params = graph.vs['params'] if 'params' in graph.vs.attributes() else [None] * self.vcount
+        bound = []
+        for step in self.steps:
+            p = params[step.vid]
+            if step.resolver is not None:
+                p = step.resolver(p if p is not None else [])
+            bound.append((step, p))
+        return bound
+
@@ -12,10 +12,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+from contextlib import contextmanager
 from typing import List, Callable
 from igraph import *
 from spinqit.model import I, H, X, Y, Z, Rx, Ry, Rz, T, Td, S, Sd, P, CX, CY, CZ, SWAP, CCX, U, MEASURE, StateVector
 from spinqit.model import Instruction, Gate
+from .execution_plan import ExecutionPlan
 import enum
 import numpy as np
 
@@ -37,6 +40,42 @@ class Comparator(enum.Enum):
     LE = 4
     GE = 5
 
+# The vertex attributes which describe the circuit, the parameter values are not a part of the structure
+_STRUCTURE_ATTRIBUTES = ('type', 'name', 'qubits', 'clbits', 'def', 'pindex', 'cmp', 'constant',
+                         'matrix', 'ctrl_num', 'inverse')
+
+
+def _hash_value(h, value, depth=0):
+    """
+    Feed a vertex attribute into the hash. The functions are hashed by their code, defaults and closure,
+    so the same lambda created for two circuits has the same hash.
+    """
+    if depth > 8:
+        # Deeply nested or recursive values are identified by the object
+        h.update(b'I' + str(id(value)).encode())
+    elif value is None:
+        h.update(b'N')
+    elif isinstance(value, np.ndarray):
+        h.update(b'A' + str(value.dtype).encode() + str(value.shape).encode())
+        h.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, (list, tuple)):
+        h.update(b'L' + str(len(value)).encode())
+        for v in value:
+            _hash_value(h, v, depth + 1)
+    elif callable(value) and hasattr(value, '__code__'):
+        code = value.__code__
+        h.update(b'F' + code.co_code + repr((code.co_consts, code.co_names, code.co_argcount)).encode())
+        _hash_value(h, value.__defaults__, depth + 1)
+        for cell in value.__closure__ or ():
+            try:
+                contents = cell.cell_contents
+            except ValueError:
+                contents = None
+            _hash_value(h, contents, depth + 1)
+    else:
+        h.update(b'V' + type(value).__name__.encode() + repr(value).encode())
+
+
 class IntermediateRepresentation():
     basis_set = {I, H, X, Y, Z, Rx, Ry, Rz, T, Td, S, Sd, P, CX, CY, CZ, SWAP, CCX, MEASURE, StateVector}
     label_set = {g.label for g in basis_set}
@@ -74,6 +113,9 @@ class IntermediateRepresentation():
         self.edges = []
         self.edge_attributes = {}
         self.include_gate = set()
+        self._plan = None
+        self._fingerprint = None
+        self._vertex_digests = []
 
     @staticmethod
     def get_comparator(sym: str):
@@ -93,6 +135,8 @@ class IntermediateRepresentation():
             raise ValueError("Unknown comparator " + sym)
 
     def add_init_nodes(self, start: int, cnt: int, type: NodeType):
+        self._plan = None
+        self._fingerprint = None
         vcount = self.dag.vcount()
         self.dag.add_vertices(cnt + 1)
 
@@ -122,6 +166,8 @@ class IntermediateRepresentation():
         pass
 
     def add_op_node(self, gatename: str, params: List, qubits: List, clbits: List) -> int:
+        self._plan = None
+        self._fingerprint = None
         self.dag.add_vertices(1)
         index = self.dag.vcount() - 1
         self.dag.vs[index]['type'] = NodeType.op.value
@@ -147,6 +193,8 @@ class IntermediateRepresentation():
         return index
 
     def add_def_node(self, gatename: str, param_num: int, qubit_num: int, clbit_num: int):
+        self._plan = None
+        self._fingerprint = None
         self.dag.add_vertices(1)
         index = self.dag.vcount() - 1
         self.dag.vs[index]['type'] = NodeType.definition.value
@@ -165,6 +213,8 @@ class IntermediateRepresentation():
 
     def add_callee_node(self, gatename: str, params: List[Callable], qubits: List[int], 
                         clbits: List[int], param_idx: List[int], is_caller: bool = False, expression=None) -> int:
+        self._plan = None
+        self._fingerprint = None
         self.dag.add_vertices(1)
         index = self.dag.vcount() - 1
         if is_caller:
@@ -199,6 +249,8 @@ class IntermediateRepresentation():
         '''
         A caller node may also be one callee node for another caller node, in which case, the node is added by add_callee_node.
         '''
+        self._plan = None
+        self._fingerprint = None
         self.dag.add_vertices(1)
         index = self.dag.vcount() - 1
         self.dag.vs[index]['type'] = NodeType.caller.value
@@ -225,11 +277,14 @@ class IntermediateRepresentation():
         return index
 
     def add_caller_matrix(self, node_index: int, matrix: np.ndarray, control_bits: int = 0, inverse: bool = False):
+        self.mark_modified([node_index])
         self.dag.vs[node_index]['matrix'] = matrix
         self.dag.vs[node_index]['ctrl_num'] = control_bits
         self.dag.vs[node_index]['inverse'] = inverse
 
     def add_unitary_node(self, gatename: str, matrix: np.ndarray, qubits: List[int], ctrl_num: int, inverse: bool) -> int:
+        self._plan = None
+        self._fingerprint = None
         self.dag.add_vertices(1)
         index = self.dag.vcount() - 1
         self.dag.vs[index]['type'] = NodeType.unitary.value
@@ -245,11 +300,62 @@ class IntermediateRepresentation():
             self.leaves[f'q{i}'] = index
         return index 
 
+    def substitute_unitary_node(self, nodes: List[int], gatename: str, matrix: np.ndarray, qubits: List[int]) -> int:
+        """
+        Substitute a convex set of unconditional nodes with one unitary node on `qubits`.
+        Like substitute_nodes, the old nodes should be removed by the caller.
+        """
+        self._plan = None
+        self.mark_modified()
+        node_set = set(nodes)
+        in_map = {}
+        out_map = {}
+        for vindex in nodes:
+            for e in self.dag.vs[vindex].in_edges():
+                if 'qubit' in e.attributes() and e['qubit'] is not None and e.source not in node_set:
+                    in_map[e['qubit']] = e.source
+            for e in self.dag.vs[vindex].out_edges():
+                if 'qubit' in e.attributes() and e['qubit'] is not None and e.target not in node_set:
+                    out_map[e['qubit']] = e.target
+
+        self.dag.add_vertices(1)
+        index = self.dag.vcount() - 1
+        self.dag.vs[index]['type'] = NodeType.unitary.value
+        self.dag.vs[index]['name'] = gatename
+        self.dag.vs[index]['qubits'] = qubits
+        self.dag.vs[index]['ctrl_num'] = 0
+        self.dag.vs[index]['inverse'] = False
+        self.dag.vs[index]['matrix'] = matrix
+        for q in qubits:
+            edge = self.dag.add_edge(in_map[q], index)
+            edge['qubit'] = q
+            if q in out_map:
+                edge = self.dag.add_edge(index, out_map[q])
+                edge['qubit'] = q
+        return index
+
+    @staticmethod
+    def get_unitary(vertex) -> np.ndarray:
+        """
+        The full matrix of a unitary node on all its qubits, the control qubits come first.
+        """
+        matrix = np.asarray(vertex['matrix'])
+        if vertex['inverse']:
+            matrix = matrix.conj().T
+        ctrl_num = vertex['ctrl_num'] or 0
+        if ctrl_num > 0:
+            dim = len(matrix)
+            full = np.eye(dim * 2 ** ctrl_num, dtype=complex)
+            full[-dim:, -dim:] = matrix
+            matrix = full
+        return matrix
+
     def add_node_condition(self, node: int, clbits: List, cmp: str, val: int):
         '''
         Only use this function when creating the IR dag.
         Otherwise, the vertices in leaves may change.
         '''
+        self.mark_modified([node])
         for i in clbits:
             leaf = self.leaves[f'c{i}']
             self.edges.append((leaf, node))
@@ -262,6 +368,8 @@ class IntermediateRepresentation():
         """
         Insert instructions into positions specified by gate ids.
         """
+        self._plan = None
+        self.mark_modified()
         local_leaves = {}
         path_ends = {}
         for inst, physical_qubits in instructions:
@@ -306,6 +414,8 @@ class IntermediateRepresentation():
         Substitute only 1q or 2q paths. The in_map and out_map have the same size.
         This function does not remove nodes directly because igraph will change vids after deletion.
         """
+        self._plan = None
+        self.mark_modified()
         node_set = set(nodes)
         in_map = {}
         in_conbit_map = {}
@@ -417,6 +527,8 @@ class IntermediateRepresentation():
         return True
 
     def remove_nodes(self, nodes: List[int], keep_edge: bool =False):
+        self._plan = None
+        self.mark_modified()
         if nodes is None or len(nodes) == 0:
             return
         if keep_edge:
@@ -446,11 +558,124 @@ class IntermediateRepresentation():
 
         self.dag.delete_vertices(nodes)
 
+    def compile_plan(self) -> ExecutionPlan:
+        """
+        Get the execution plan of the dag, a flat gate list with the caller nodes inlined.
+        The plan is cached and only rebuilt when the dag changes,
+        the parameters are read from the dag when the plan is bound.
+        """
+        plan = getattr(self, '_plan', None)
+        if plan is None or not plan.is_valid(self.dag):
+            plan = ExecutionPlan(self.dag)
+            self._plan = plan
+        return plan
+
+    def mark_modified(self, nodes: List[int] = None):
+        """
+        Mark the vertices whose attributes are edited in place, e.g. the gates renamed by a backend,
+        so the fingerprint and the execution plan are computed again for them.
+        All the vertices are marked when nodes is None.
+        """
+        self._plan = None
+        self._fingerprint = None
+        digests = getattr(self, '_vertex_digests', None)
+        if nodes is None or digests is None:
+            self._vertex_digests = []
+            return
+        for v in nodes:
+            if v < len(digests):
+                digests[v] = None
+
+    def _vertex_digest(self, vid: int) -> bytes:
+        v = self.dag.vs[vid]
+        attributes = v.attributes()
+        h = hashlib.blake2b(digest_size=16)
+        for name in _STRUCTURE_ATTRIBUTES:
+            h.update(name.encode())
+            _hash_value(h, attributes.get(name))
+        params = attributes.get('params')
+        if v['type'] in (NodeType.op.value, NodeType.caller.value):
+            # Only the slots, the values are bound when the circuit is executed
+            h.update(b'P' + str(None if params is None else len(params)).encode())
+        else:
+            # The number of parameters of a definition, the functions of a callee
+            _hash_value(h, params)
+        return h.digest()
+
+    def fingerprint(self) -> str:
+        """
+        The content hash of the circuit: the gates, qubits, clbits, parameter slots, conditions and the wires.
+        The parameter values are not included, the IRs which only differ in the values have the same fingerprint.
+        The digests of the vertices are kept, so adding gates only hashes the new vertices,
+        the in-place edits of the vertex attributes should be marked with `mark_modified`.
+        """
+        fingerprint = getattr(self, '_fingerprint', None)
+        if fingerprint is not None:
+            return fingerprint
+
+        digests = getattr(self, '_vertex_digests', None)
+        if digests is None:
+            digests = self._vertex_digests = []
+        vcount = self.dag.vcount()
+        del digests[vcount:]
+        for vid in range(vcount):
+            if vid >= len(digests):
+                digests.append(self._vertex_digest(vid))
+            elif digests[vid] is None:
+                digests[vid] = self._vertex_digest(vid)
+
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f'{self.qnum},{self.cnum},{vcount}'.encode())
+        h.update(b''.join(digests))
+        if self.dag.ecount() > 0:
+            edges = self.dag.get_edgelist()
+            edge_attributes = {name: self.dag.es[name] for name in ('qubit', 'clbit', 'conbit')
+                               if name in self.dag.es.attributes()}
+        else:
+            # The dag has not been built yet
+            edges = self.edges
+            edge_attributes = {name: [self.edge_attributes.get(i, {}).get(name) for i in range(len(edges))]
+                               for name in ('qubit', 'clbit', 'conbit')}
+        h.update(np.asarray(edges, dtype=np.int64).tobytes())
+        for name, values in sorted(edge_attributes.items()):
+            h.update(name.encode())
+            h.update(np.asarray([-1 if x is None else x for x in values], dtype=np.int64).tobytes())
+        self._fingerprint = h.hexdigest()
+        return self._fingerprint
+
+    def params_snapshot(self) -> List:
+        """
+        The gate parameters of every vertex at this moment. The backends give a vertex a new parameter list
+        when the parameters are updated, so the snapshot only copies the references and is not changed
+        by the later updates.
+        """
+        if 'params' not in self.dag.vs.attributes():
+            return [None] * self.dag.vcount()
+        return self.dag.vs['params']
+
+    @contextmanager
+    def bound_params(self, params: List):
+        """
+        Execute the dag with the parameter lists in `params`, e.g. a snapshot with some shifted values,
+        and put the parameter lists of the dag back afterwards. The lists themselves are not modified.
+        """
+        if params is None:
+            yield self
+            return
+        origin = self.params_snapshot()
+        self.dag.vs['params'] = params
+        try:
+            yield self
+        finally:
+            self.dag.vs['params'] = origin
+
     def build_dag(self):
         """
         Add all the edges to the graph in one batch.
         Adding edges one by one in igraph is very slow.
         """
+        self._plan = None
+        self._fingerprint = None
         self.dag["qnum"] = self.qnum
         self.dag["cnum"] = self.cnum
         self.dag.add_edges(self.edges)
@@ -12,4 +12,5 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from .pass_manager import PassManager
\ No newline at end of file
+from .pass_manager import PassManager
+from .gate_fusion import GateFusion
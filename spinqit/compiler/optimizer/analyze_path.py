@@ -12,9 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from igraph import Vertex, Graph
 from ..ir import NodeType
-from .util import get_qubits, get_paths
+from .util import get_paths
+from .wire_view import WireView
 from spinqit.model import I, H, X, Y, Z, Rx, Ry, Rz, T, Td, S, Sd, P, CX, CY, CZ, SWAP, CCX
 
 X_series = {X.label, Rx.label}
@@ -23,7 +23,7 @@ Z_series = {Z.label, Rz.label, T.label, Td.label, S.label, Sd.label, P.label}
 CU_series = {CX.label, CY.label, CCX.label}
 SWAP_Series = {CZ.label, SWAP.label}
 
-def is_commutative(cur: Vertex, pre: Vertex):
+def is_commutative(cur, pre):
     if cur['name'] in X_series and pre['name'] in X_series:
         return True
     elif cur['name'] in Y_series and pre['name'] in Y_series:
@@ -53,18 +53,18 @@ def is_commutative(cur: Vertex, pre: Vertex):
     else:
         return False
 
-def cancellation_filter(v: int, g: Graph):
-    if 'cmp' in g.vs[v].attributes() and g.vs[v]['cmp'] is not None:
+def cancellation_filter(v: int, view: WireView):
+    if view.cmp[v] is not None:
         return False
-    prev = g.predecessors(g.vs[v])
+    prev = view.predecessors(v)
     if len(prev) == 0:
         return False
    
-    cur_type = g.vs[v]['type']
+    cur_type = view.type[v]
     type_flag = cur_type == NodeType.op.value or cur_type == NodeType.callee.value
     prev_flag = True
     for p in prev:
-        pre_type = g.vs[p]['type']
+        pre_type = view.type[p]
         if cur_type == pre_type:
             prev_flag = False
     if type_flag and prev_flag:
@@ -73,7 +73,7 @@ def cancellation_filter(v: int, g: Graph):
     if len(set(prev)) != 1:
         return False
 
-    return is_commutative(g.vs[v], g.vs[prev[0]])
+    return is_commutative(view.node(v), view.node(prev[0]))
 
-def analyze(g: Graph):
-    return get_paths(g, cancellation_filter)
\ No newline at end of file
+def analyze(view: WireView):
+    return get_paths(view, cancellation_filter)
\ No newline at end of file
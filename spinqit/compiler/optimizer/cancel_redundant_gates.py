@@ -16,6 +16,7 @@ from typing import List
 from math import pi
 from ..ir import *
 from .analyze_path import analyze, X_series, Y_series, Z_series
+from .wire_view import WireView
 from spinqit.model import Instruction
 from spinqit.model import X, Y, Z, T, Td, S, Sd, Rx, Ry, Rz
 
@@ -23,10 +24,10 @@ class CancelRedundantGates():
     def __init__(self) -> None:
         pass
 
-    def cancel_rotation_gates(self, path: List[int], ir: IntermediateRepresentation):
+    def cancel_rotation_gates(self, path: List[int], view: WireView):
         total_angle = 0
         for node in path:
-            name = ir.dag.vs[node]['name']
+            name = view.name[node]
             if name in [X.label, Y.label, Z.label]:
                 total_angle += pi
             elif name == T.label:
@@ -38,13 +39,12 @@ class CancelRedundantGates():
             elif name == Sd.label:
                 total_angle -= pi/2
             else:
-                total_angle += ir.dag.vs[node]['params'][0]
+                total_angle += view.params[node][0]
         total_angle = total_angle % (4*pi)
-        edges = ir.dag.vs[path[0]].in_edges()
-        qarg = edges[0]['qubit']
+        qarg = view.wire_qubits(path[0])[0]
 
-        ptype = ir.dag.vs[path[0]]['type']
-        gname = ir.dag.vs[path[0]]['name']
+        ptype = view.type[path[0]]
+        gname = view.name[path[0]]
         if gname in X_series:
             gate = Rx
         elif gname in Y_series:
@@ -53,34 +53,21 @@ class CancelRedundantGates():
             gate = Rz
 
         inst = Instruction(gate, [qarg], [], total_angle)
-        ir.substitute_nodes(path, [inst], ptype)
+        view.substitute(path, [inst], ptype)
 
     def cancel_same_gates(self, paths: List[List], index: int):
         if len(paths[index]) % 2 == 1:
             paths[index] = paths[index][1:]
 
     def run(self, ir: IntermediateRepresentation):
-        path_list = analyze(ir.dag)
-        keep_edge = []
+        view = WireView(ir)
+        path_list = analyze(view)
         for i in range(len(path_list)):
             if len(path_list[i]) > 1:
-                ptype = ir.dag.vs[path_list[i][0]]['name']
+                ptype = view.name[path_list[i][0]]
                 if ptype in X_series or ptype in Y_series or ptype in Z_series:
-                    self.cancel_rotation_gates(path_list[i], ir)
-                    keep_edge.append(False)
+                    self.cancel_rotation_gates(path_list[i], view)
                 else:
                     self.cancel_same_gates(path_list, i)
-                    keep_edge.append(True)
-                    
-        i = 0
-        keep_list = []
-        non_keep_list = []
-        for path in path_list:
-            if len(path) > 1:
-                if keep_edge[i]:
-                    keep_list.extend(path)
-                else:
-                    non_keep_list.extend(path)
-                i += 1
-        ir.remove_nodes(keep_list, True)
-        ir.remove_nodes(non_keep_list, False)
+                    view.remove(path_list[i])
+        view.commit()
@@ -12,20 +12,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from igraph import Graph
 from numpy import *
 from ..ir import NodeType, IntermediateRepresentation
 from ..decomposer import decompose_zyz
 from .util import get_paths, get_matrix
+from .wire_view import WireView
 from spinqit.model import Instruction, Ry, Rz
 
-def single_qubit_filter(v: int, g: Graph):
-    if 'cmp' in g.vs[v].attributes() and g.vs[v]['cmp'] is not None:
+def single_qubit_filter(v: int, view: WireView):
+    if view.cmp[v] is not None:
         return False
-    type = g.vs[v]['type']
+    type = view.type[v]
     tflag = (type == NodeType.op.value or type == NodeType.callee.value)
-    edges = g.vs[v].in_edges()
-    eflag = (len(edges) == 1 and 'qubit' in edges[0].attributes()) and edges[0]['qubit'] is not None
+    keys = view.in_keys[v]
+    eflag = len(keys) == 1 and keys[0][0] == 'qubit'
     return tflag and eflag
 
 class CollapseSingleQubitGates(object):
@@ -33,33 +33,27 @@ class CollapseSingleQubitGates(object):
         pass
 
     def run(self, ir: IntermediateRepresentation):
-        paths = get_paths(ir.dag, single_qubit_filter)
+        view = WireView(ir)
+        paths = get_paths(view, single_qubit_filter)
         for path in paths:
             if len(path) > 3:
-                node = ir.dag.vs[path[0]]
-                if 'params' in node.attributes() and node['params'] is not None:
-                        op_matrix = get_matrix(node['name'], node['params'])
+                node = path[0]
+                if view.params[node] is not None:
+                        op_matrix = get_matrix(view.name[node], view.params[node])
                 else:
-                    op_matrix = get_matrix(node['name'])
+                    op_matrix = get_matrix(view.name[node])
                 
-                for index in path[1:]:
-                    node = ir.dag.vs[index]
-                    if 'params' in node.attributes() and node['params'] is not None:
-                        op_matrix = get_matrix(node['name'], node['params']).dot(op_matrix)
+                for node in path[1:]:
+                    if view.params[node] is not None:
+                        op_matrix = get_matrix(view.name[node], view.params[node]).dot(op_matrix)
                     else:
-                        op_matrix = get_matrix(node['name']).dot(op_matrix)
+                        op_matrix = get_matrix(view.name[node]).dot(op_matrix)
                 alpha, beta, gamma, phase = decompose_zyz(op_matrix)
-                qedges = ir.dag.vs[path[0]].in_edges()
-                qubit = qedges[0]['qubit']
+                qubit = view.wire_qubits(path[0])[0]
                 inst_list = []
                 inst_list.append(Instruction(Rz, [qubit], [], alpha))
                 inst_list.append(Instruction(Ry, [qubit], [], beta))
                 inst_list.append(Instruction(Rz, [qubit], [], gamma))
-                ir.substitute_nodes(path, inst_list, ir.dag.vs[path[0]]['type'])
-
-        to_remove = []
-        for path in paths:
-            if len(path) > 3:
-                to_remove.extend(path) 
-        ir.remove_nodes(to_remove, False)
+                view.substitute(path, inst_list, view.type[path[0]])
+        view.commit()
 
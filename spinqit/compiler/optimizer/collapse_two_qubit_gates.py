@@ -13,23 +13,23 @@
 # limitations under the License.
 
 from spinqit.compiler.decomposer.magic_basis_decomposer import decompose_two_qubit_gate
-from igraph import Graph
 from ..decomposer import decompose_two_qubit_gate
 from ..ir import IntermediateRepresentation, NodeType
-from .util import get_paths, get_matrix, get_qubits
+from .util import get_paths, get_matrix
+from .wire_view import WireView
 
-def two_qubit_filter(v: int, g: Graph):
-    if 'cmp' in g.vs[v].attributes() and g.vs[v]['cmp'] is not None:
+def two_qubit_filter(v: int, view: WireView):
+    if view.cmp[v] is not None:
         return False
-    type = g.vs[v]['type']
+    type = view.type[v]
     tflag = (type == NodeType.op.value or type == NodeType.callee.value)
-    edges = g.vs[v].in_edges()
-    eflag = (len(edges) == 2) 
+    predecessors = view.predecessors(v)
+    eflag = (len(predecessors) == 2) 
     if eflag:
-        if 'qubit' in edges[0].attributes() and edges[0].source == edges[1].source:
+        if predecessors[0] == predecessors[1]:
             eflag = True
         else:
-            successors = g.successors(v)
+            successors = view.successors(v)
             if len(successors) != 2 or successors[0] != successors[1]:
                 eflag = False
     return tflag and eflag
@@ -39,27 +39,21 @@ class CollapseTwoQubitGates(object):
         pass
 
     def run(self, ir: IntermediateRepresentation):
-        paths = get_paths(ir.dag, two_qubit_filter)
+        view = WireView(ir)
+        paths = get_paths(view, two_qubit_filter)
         for path in paths:
             if len(path) > 6:
-                node = ir.dag.vs[path[0]]
-                qargs = node['qubits']
-                op_matrix = get_matrix(node['name'], [0])
+                qargs = view.qubits[path[0]]
+                op_matrix = get_matrix(view.name[path[0]], [0])
                 first_qubit = qargs[0] if qargs[0] < qargs[1] else qargs[1]
 
                 for index in path[1:]:
-                    node = ir.dag.vs[index]
-                    qubits = node['qubits']
+                    qubits = view.qubits[index]
                     if first_qubit == qubits[0]:
-                        op_matrix = get_matrix(node['name'], [0]).dot(op_matrix)
+                        op_matrix = get_matrix(view.name[index], [0]).dot(op_matrix)
                     else:
-                        op_matrix = get_matrix(node['name'], [1]).dot(op_matrix)
+                        op_matrix = get_matrix(view.name[index], [1]).dot(op_matrix)
 
                 inst_list = decompose_two_qubit_gate(op_matrix, qargs[0], qargs[1])
-                ir.substitute_nodes(path, inst_list, ir.dag.vs[path[0]]['type'])
-
-        to_remove = []
-        for path in paths:
-            if len(path) > 6:
-                to_remove.extend(path)
-        ir.remove_nodes(to_remove, False)
\ No newline at end of file
+                view.substitute(path, inst_list, view.type[path[0]])
+        view.commit()
\ No newline at end of file
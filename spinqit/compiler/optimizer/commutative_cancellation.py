@@ -0,0 +1,173 @@
+# Copyright 2023 SpinQ Technology Co., Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from collections import defaultdict
+from math import isclose, pi
+from numbers import Number
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+from spinqit.model import Instruction
+from spinqit.model import X, Y, Z, T, Td, S, Sd, P, Rx, Ry, Rz
+from ..ir import IntermediateRepresentation, NodeType
+from .wire_view import WireView
+
+_PAULIS = {'X': np.array([[0, 1], [1, 0]]), 'Y': np.array([[0, -1j], [1j, 0]]), 'Z': np.array([[1, 0], [0, -1]])}
+
+# The rotation gates on every axis, with the rotation angle of the fixed gates
+ROTATIONS = {
+    'X': (Rx, {X.label: pi, Rx.label: None}),
+    'Y': (Ry, {Y.label: pi, Ry.label: None}),
+    'Z': (Rz, {Z.label: pi, S.label: pi / 2, Sd.label: -pi / 2, T.label: pi / 4, Td.label: -pi / 4,
+               P.label: None, Rz.label: None}),
+}
+
+
+def _embed(pauli: np.ndarray, position: int, qubit_num: int) -> np.ndarray:
+    matrix = np.eye(1)
+    for i in range(qubit_num):
+        matrix = np.kron(matrix, pauli if i == position else np.eye(2))
+    return matrix
+
+
+def commutation_table(basis_set: Iterable = IntermediateRepresentation.basis_set) -> Tuple[Dict, set]:
+    """
+    Compute the Pauli basis every basis gate commutes with on each of its qubits, from the gate matrices.
+    Two gates commute on a wire when they have the same basis there, e.g. CX is ('Z', 'X'), so two CX gates
+    commute with the Z rotations on their control and the X rotations on their target. A qubit the gate does
+    not change has the basis 'I', and None if the gate does not commute with any Pauli on the qubit.
+    The rotation gates are checked with several angles.
+
+    Returns:
+        The bases of every gate label, and the labels of the self-inverse gates.
+    """
+    rotation_labels = {label for _, labels in ROTATIONS.values() for label in labels}
+    table = {}
+    self_inverse = set()
+    for gate in basis_set:
+        if gate.matrix is None:
+            continue
+        samples = [gate.get_matrix(a) for a in (0.37, 1.91, -2.6)] if gate.label in rotation_labels \
+            else [gate.get_matrix()]
+        qubit_num = int(np.log2(len(samples[0])))
+        bases = []
+        for position in range(qubit_num):
+            commuting = [name for name, pauli in _PAULIS.items()
+                         if all(np.allclose(m @ _embed(pauli, position, qubit_num),
+                                            _embed(pauli, position, qubit_num) @ m) for m in samples)]
+            bases.append('I' if len(commuting) > 1 else (commuting[0] if commuting else None))
+        table[gate.label] = tuple(bases)
+        if len(samples) == 1 and np.allclose(samples[0] @ samples[0], np.eye(len(samples[0]))):
+            self_inverse.add(gate.label)
+    return table, self_inverse
+
+
+COMMUTATION_TABLE, SELF_INVERSE_GATES = commutation_table()
+
+
+class CommutativeCancellation(object):
+    """
+    Cancel and merge the gates which are separated by the gates they commute with.
+
+    Every qubit wire is split into commutation sets, the runs of gates with the same basis on the wire in
+    the commutation table. The gates in a set commute with each other on the wire, so a gate can be moved next
+    to any other gate in its sets. Two self-inverse gates on the same qubits in the same set of every wire
+    cancel, e.g. two CX gates with Z rotations on the control between them, and the rotations about the axis
+    of a set are merged into one rotation, e.g. the Rz gates across CX controls.
+    Only the op nodes without conditions are changed, the other nodes end the sets on their wires.
+    """
+
+    def __init__(self) -> None:
+        pass
+
+    @staticmethod
+    def _basis(view: WireView, v: int, qubit: int) -> Optional[str]:
+        if view.type[v] != NodeType.op.value or view.cmp[v] is not None:
+            return None
+        bases = COMMUTATION_TABLE.get(view.name[v])
+        qubits = view.qubits[v]
+        if bases is None or qubits is None or len(bases) != len(qubits):
+            return None
+        return bases[qubits.index(qubit)]
+
+    def commutation_sets(self, view: WireView) -> Dict[Tuple[int, int], Tuple[int, Optional[str]]]:
+        """
+        The commutation set of every node on every qubit wire, as (set id, basis) keyed by (node, qubit).
+        """
+        sets = {}
+        wire_sets = {}
+        count = 0
+        for v in view.order():
+            for key in view.in_keys[v]:
+                if key[0] != 'qubit':
+                    continue
+                source = view.in_links[v][key][0]
+                current = wire_sets.get((source, key[1]))
+                basis = self._basis(view, v, key[1])
+                if basis == 'I' and current is not None:
+                    pass
+                elif current is None or basis is None or basis != current[1]:
+                    current = (count, basis)
+                    count += 1
+                wire_sets[(v, key[1])] = current
+                sets[(v, key[1])] = current
+        return sets
+
+    def run(self, ir: IntermediateRepresentation):
+        view = WireView(ir)
+        sets = self.commutation_sets(view)
+        cancellations = defaultdict(list)
+        rotations = defaultdict(list)
+        for v in view.order():
+            if view.type[v] != NodeType.op.value or view.cmp[v] is not None:
+                continue
+            name, qubits = view.name[v], view.qubits[v]
+            if not qubits or any((v, q) not in sets for q in qubits):
+                continue
+            set_ids = tuple(sets[(v, q)][0] for q in qubits)
+            basis = sets[(v, qubits[0])][1]
+            if len(qubits) == 1 and basis in ROTATIONS and name in ROTATIONS[basis][1]:
+                rotations[set_ids[0]].append(v)
+            elif name in SELF_INVERSE_GATES and all(sets[(v, q)][1] is not None for q in qubits):
+                cancellations[(name, tuple(qubits), set_ids)].append(v)
+
+        for nodes in cancellations.values():
+            if len(nodes) > 1:
+                view.remove(nodes[len(nodes) % 2:])
+
+        for nodes in rotations.values():
+            if len(nodes) > 1:
+                self.merge_rotations(view, nodes, sets[(nodes[0], view.qubits[nodes[0]][0])][1])
+        view.commit()
+
+    @staticmethod
+    def merge_rotations(view: WireView, nodes, basis: str):
+        gate, angles = ROTATIONS[basis]
+        total_angle = 0
+        for v in nodes:
+            angle = angles[view.name[v]]
+            if angle is None:
+                params = view.params[v]
+                if params is None or len(params) != 1 or not isinstance(params[0], Number):
+                    return
+                angle = params[0]
+            total_angle += angle
+        total_angle = total_angle % (4 * pi)
+
+        view.remove(nodes[1:])
+        if isclose(total_angle, 0, abs_tol=1e-12) or isclose(total_angle, 4 * pi, abs_tol=1e-12):
+            view.remove(nodes[:1])
+        else:
+            qubit = view.qubits[nodes[0]][0]
+            view.substitute(nodes[:1], [Instruction(gate, [qubit], [], total_angle)], view.type[nodes[0]])
@@ -0,0 +1,127 @@
+# Copyright 2023 SpinQ Technology Co., Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import List
+import numpy as np
+from igraph import Graph
+from ..ir import NodeType, IntermediateRepresentation
+from .util import get_matrix
+from spinqit.model.parameter import LazyParameter
+from spinqit.utils.function import requires_grad
+
+FUSED_GATE_LABEL = 'FUSED'
+
+
+def fusion_filter(v: int, g: Graph):
+    """
+    Only the op nodes with a constant matrix can be fused,
+    the trainable gates are kept so that their gradients can still be calculated.
+    """
+    node = g.vs[v]
+    if node['type'] != NodeType.op.value:
+        return False
+    if 'cmp' in node.attributes() and node['cmp'] is not None:
+        return False
+    if 'func' in node.attributes() and node['func'] is not None and any(callable(f) for f in node['func']):
+        return False
+    params = node['params'] if 'params' in node.attributes() else None
+    if params is not None and any(isinstance(p, LazyParameter) or requires_grad(p) for p in params):
+        return False
+    return get_matrix(node['name'], params) is not None
+
+
+def apply_matrix(unitary: np.ndarray, matrix: np.ndarray, positions: List[int], width: int) -> np.ndarray:
+    """
+    Left multiply the unitary of `width` qubits by a gate matrix acting on the qubits at `positions`.
+    """
+    k = len(positions)
+    u = unitary.reshape([2] * width + [-1])
+    g = matrix.reshape([2] * (2 * k))
+    u = np.tensordot(g, u, axes=(list(range(k, 2 * k)), positions))
+    u = np.moveaxis(u, list(range(k)), positions)
+    return u.reshape(2 ** width, 2 ** width)
+
+
+class GateFusion(object):
+    """
+    Merge the consecutive constant gates on at most `max_width` qubits into dense unitary nodes,
+    so the state vector simulators apply one matrix instead of every gate.
+    The blocks are grown greedily in topological order, a gate joins the open blocks on its qubits
+    when the merged block is not wider than `max_width`, otherwise these blocks are closed.
+    """
+    def __init__(self, max_width: int = 2) -> None:
+        if max_width < 1:
+            raise ValueError(
+                f'The max_width of gate fusion should be a positive integer, but got {max_width}'
+            )
+        self.max_width = max_width
+
+    def run(self, ir: IntermediateRepresentation):
+        g = ir.dag
+        open_blocks = {}
+        blocks = []
+
+        def close(qubits):
+            for q in qubits:
+                block = open_blocks.get(q)
+                if block is None:
+                    continue
+                for bq in block['qubits']:
+                    del open_blocks[bq]
+                if len(block['nodes']) > 1:
+                    blocks.append(block)
+
+        for v in g.topological_sorting():
+            node = g.vs[v]
+            if node['type'] not in (NodeType.op.value, NodeType.caller.value, NodeType.unitary.value):
+                continue
+            qubits = list(node['qubits'])
+            if not fusion_filter(v, g) or len(qubits) > self.max_width:
+                close(qubits)
+                continue
+
+            touched = []
+            for q in qubits:
+                block = open_blocks.get(q)
+                if block is not None and all(block is not b for b in touched):
+                    touched.append(block)
+            merged_qubits = []
+            for block in touched:
+                merged_qubits.extend(block['qubits'])
+            merged_qubits.extend(q for q in qubits if q not in merged_qubits)
+
+            if len(merged_qubits) <= self.max_width:
+                merged = {'qubits': merged_qubits, 'nodes': []}
+                for block in touched:
+                    merged['nodes'].extend(block['nodes'])
+            else:
+                close(qubits)
+                merged = {'qubits': list(qubits), 'nodes': []}
+            merged['nodes'].append(v)
+            for q in merged['qubits']:
+                open_blocks[q] = merged
+        close(list(open_blocks.keys()))
+
+        to_remove = []
+        for block in blocks:
+            width = len(block['qubits'])
+            unitary = np.eye(2 ** width, dtype=complex)
+            for v in block['nodes']:
+                node = g.vs[v]
+                params = node['params'] if 'params' in node.attributes() else None
+                positions = [block['qubits'].index(q) for q in node['qubits']]
+                unitary = apply_matrix(unitary, get_matrix(node['name'], params), positions, width)
+            ir.substitute_unitary_node(block['nodes'], FUSED_GATE_LABEL, unitary, block['qubits'])
+            to_remove.extend(block['nodes'])
+        ir.remove_nodes(to_remove, False)
@@ -16,6 +16,7 @@ from ..ir import IntermediateRepresentation
 from .cancel_redundant_gates import CancelRedundantGates
 from .collapse_single_qubit_gates import CollapseSingleQubitGates
 from .collapse_two_qubit_gates import CollapseTwoQubitGates
+from .commutative_cancellation import CommutativeCancellation
 from .quantum_basis_state_optimization import ConstantsStateOptimization
 from .quantum_pure_state_optimization import PureStateOnU
 
@@ -27,10 +28,12 @@ class PassManager(object):
             self.passes.append(CollapseSingleQubitGates())
         elif level == 2:
             self.passes.append(CancelRedundantGates())
+            self.passes.append(CommutativeCancellation())
             self.passes.append(CollapseSingleQubitGates())
             self.passes.append(CollapseTwoQubitGates())
         elif level == 3:
             self.passes.append(CancelRedundantGates())
+            self.passes.append(CommutativeCancellation())
             self.passes.append(ConstantsStateOptimization())
             self.passes.append(PureStateOnU())
             self.passes.append(CollapseSingleQubitGates())
@@ -13,31 +13,32 @@
 # limitations under the License.
 
 from typing import List, Callable
-from igraph import Graph, Vertex
+from igraph import Vertex
 from ..ir import IntermediateRepresentation
+from .wire_view import WireView
 
-def get_paths(graph: Graph, filter: Callable) -> List:
-    """ Collect all the paths consist of valid vertices.
-        Return one path every time because the vertex index may be modified.
+def get_paths(view: WireView, filter: Callable) -> List:
+    """ Collect all the paths consist of valid vertices, filter(v, view) checks a vertex.
+        The node ids of the view are stable, so the paths can be edited one by one before the view is committed.
     """
     result = []
     if filter is None:
         return result
 
     visited = set()
-    vs = graph.topological_sorting()
+    vs = view.order()
     for vertex in vs:
-        if not filter(vertex, graph) or vertex in visited:
+        if not filter(vertex, view) or vertex in visited:
             continue
         visited.add(vertex)
         path = [vertex]
-        slist = graph.successors(vertex)
+        slist = view.successors(vertex)
         
-        while len(set(slist))==1 and filter(slist[0], graph) and not slist[0] in visited:
+        while len(set(slist))==1 and filter(slist[0], view) and not slist[0] in visited:
             cur = slist[0]
             path.append(cur)
             visited.add(cur)
-            slist = graph.successors(cur)
+            slist = view.successors(cur)
 
         if len(path) > 0:
             result.append(path)
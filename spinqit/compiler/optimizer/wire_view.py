@@ -0,0 +1,271 @@
+# Copyright 2023 SpinQ Technology Co., Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from ..ir import IntermediateRepresentation
+
+# The edge attributes which carry a bit, an edge is keyed by (attribute, bit) on its wire
+WIRE_ATTRIBUTES = ('qubit', 'clbit', 'conbit')
+
+
+class WireView:
+    """
+    An index-based view of an IR for the optimizer passes.
+
+    Every qubit and classical bit is a doubly linked list of the nodes on its wire, so the neighbours of a node
+    are dict lookups. The node ids are stable while a pass runs: the removed nodes are tombstoned, and the new
+    nodes get the ids after the vertices of the graph. The topological order is computed once, and the new
+    nodes are placed between their neighbours. The graph is only edited in `commit`, with one call of
+    add_vertices, add_edges, delete_edges and delete_vertices, because igraph rebuilds its indices for every
+    call and editing the nodes one by one makes the passes quadratic in the circuit size.
+
+    The view should not be used after `commit`, the vertex ids of the graph are renumbered by the deletion.
+    """
+
+    def __init__(self, ir: IntermediateRepresentation):
+        self.ir = ir
+        g = ir.dag
+        n = g.vcount()
+        self._vcount = n
+        attributes = g.vs.attributes()
+        self.type = list(g.vs['type']) if n > 0 else []
+        self.name = list(g.vs['name']) if n > 0 else []
+        self.qubits = list(g.vs['qubits']) if 'qubits' in attributes else [None] * n
+        self.params = list(g.vs['params']) if 'params' in attributes else [None] * n
+        self.cmp = list(g.vs['cmp']) if 'cmp' in attributes else [None] * n
+        self.constant = list(g.vs['constant']) if 'constant' in attributes else [None] * n
+        self.alive = [True] * n
+
+        # in_links[v][key] = (source, attribute), out_links[v][key] = target, in_keys[v] the keys in edge order
+        self.in_links: List[Dict[Tuple, Tuple[int, str]]] = [{} for _ in range(n)]
+        self.out_links: List[Dict[Tuple, int]] = [{} for _ in range(n)]
+        self.in_keys: List[List[Tuple]] = [[] for _ in range(n)]
+        self._in_eids: List[List[int]] = [[] for _ in range(n)]
+        self._rewired = set()
+
+        edge_attributes = g.es.attributes()
+        values = [g.es[a] if a in edge_attributes else None for a in WIRE_ATTRIBUTES]
+        for eid, (source, target) in enumerate(g.get_edgelist()):
+            for attribute, bits in zip(WIRE_ATTRIBUTES, values):
+                if bits is not None and bits[eid] is not None:
+                    key = (attribute, bits[eid])
+                    self.in_links[target][key] = (source, attribute)
+                    self.out_links[source][key] = target
+                    self.in_keys[target].append(key)
+                    self._in_eids[target].append(eid)
+                    break
+
+        self.position = [0.] * n
+        for i, v in enumerate(g.topological_sorting() if n > 0 else []):
+            self.position[v] = float(i)
+        self._order_valid = True
+
+    def node(self, v: int) -> Dict:
+        """
+        The attributes of a node which the passes read, like an igraph Vertex.
+        """
+        return {'type': self.type[v], 'name': self.name[v], 'qubits': self.qubits[v], 'params': self.params[v],
+                'cmp': self.cmp[v], 'constant': self.constant[v]}
+
+    def predecessors(self, v: int) -> List[int]:
+        return [self.in_links[v][key][0] for key in self.in_keys[v]]
+
+    def successors(self, v: int) -> List[int]:
+        return list(self.out_links[v].values())
+
+    def wire_qubits(self, v: int) -> List[int]:
+        """
+        The qubits of the in edges of a node in edge order, like `util.get_qubits`.
+        """
+        return [key[1] for key in self.in_keys[v] if key[0] == 'qubit']
+
+    def order(self) -> List[int]:
+        """
+        The live nodes in topological order.
+        """
+        if not self._order_valid:
+            self._sort()
+        live = [v for v in range(len(self.alive)) if self.alive[v]]
+        live.sort(key=self.position.__getitem__)
+        return live
+
+    def _sort(self):
+        """
+        Compute the positions again with Kahn's algorithm on the wires, when the new nodes do not fit
+        between their neighbours. The nodes without wires keep their relative order first.
+        """
+        indegree = [len(self.in_keys[v]) if self.alive[v] else 0 for v in range(len(self.alive))]
+        queue = deque(sorted((v for v in range(len(self.alive)) if self.alive[v] and indegree[v] == 0),
+                             key=self.position.__getitem__))
+        i = 0
+        while queue:
+            v = queue.popleft()
+            self.position[v] = float(i)
+            i += 1
+            for target in self.out_links[v].values():
+                indegree[target] -= 1
+                if indegree[target] == 0:
+                    queue.append(target)
+        self._order_valid = True
+
+    def _add_node(self, type: int, name: str, qubits: List, params: Optional[List]) -> int:
+        v = len(self.alive)
+        self.type.append(type)
+        self.name.append(name)
+        self.qubits.append(qubits)
+        self.params.append(params if params is not None and len(params) > 0 else None)
+        self.cmp.append(None)
+        self.constant.append(None)
+        self.alive.append(True)
+        self.in_links.append({})
+        self.out_links.append({})
+        self.in_keys.append([])
+        self._in_eids.append([])
+        self.position.append(0.)
+        return v
+
+    def _link(self, source: int, target: int, key: Tuple, attribute: str):
+        if key not in self.in_links[target]:
+            self.in_keys[target].append(key)
+        self.in_links[target][key] = (source, attribute)
+        self.out_links[source][key] = target
+        self._rewired.add(target)
+
+    def _tombstone(self, v: int):
+        self.alive[v] = False
+        self.in_links[v] = {}
+        self.out_links[v] = {}
+        self.in_keys[v] = []
+
+    def _place(self, new_nodes: List[int], sources: List[int], targets: List[int]):
+        low = max((self.position[s] for s in sources), default=-1.)
+        high = min((self.position[t] for t in targets), default=low + len(new_nodes) + 1.)
+        step = (high - low) / (len(new_nodes) + 1)
+        if not self._order_valid or step <= 0 or low + step == low:
+            self._order_valid = False
+            return
+        for k, v in enumerate(new_nodes):
+            self.position[v] = low + (k + 1) * step
+
+    def substitute(self, nodes: List[int], ins_list: List, type: int) -> List[int]:
+        """
+        Replace a path of nodes with the instructions, like `IntermediateRepresentation.substitute_nodes`,
+        and tombstone the nodes of the path.
+        """
+        node_set = set(nodes)
+        in_map = {}
+        for v in nodes:
+            for key in self.in_keys[v]:
+                source, attribute = self.in_links[v][key]
+                if source not in node_set:
+                    in_map[key] = source
+        out_map = {}
+        for v in nodes[::-1]:
+            for key, target in self.out_links[v].items():
+                if target not in node_set:
+                    out_map[key] = (target, self.in_links[target][key][1])
+        outside = dict(in_map)
+        sources = list(in_map.values())
+        targets = [t for t, _ in out_map.values()]
+        condition = self._same_condition(nodes)
+
+        new_nodes = []
+        for inst in ins_list:
+            index = self._add_node(type, inst.get_op(), inst.qubits, inst.params)
+            new_nodes.append(index)
+            for i in inst.qubits:
+                key = ('qubit', i)
+                self._link(in_map[key], index, key, 'qubit')
+                in_map[key] = index
+            if condition is not None:
+                self.cmp[index], self.constant[index] = condition
+                for key in sorted(k for k in in_map if k[0] == 'conbit'):
+                    self._link(in_map[key], index, key, 'conbit')
+                    in_map[key] = index
+
+        for key, (target, attribute) in out_map.items():
+            if key[0] == 'qubit' or (key[0] == 'conbit' and condition is not None):
+                self._link(in_map[key], target, key, attribute)
+        # The wires which end in the path, or are not connected through the new nodes
+        for key, source in outside.items():
+            if self.out_links[source].get(key) in node_set:
+                del self.out_links[source][key]
+        for v in nodes:
+            self._tombstone(v)
+        self._place(new_nodes, sources, targets)
+        return new_nodes
+
+    def _same_condition(self, nodes: List[int]) -> Optional[Tuple]:
+        first = nodes[0]
+        if self.cmp[first] is None:
+            return None
+        conbits = [key for key in self.in_keys[first] if key[0] == 'conbit']
+        for v in nodes[1:]:
+            if (self.cmp[v], self.constant[v]) != (self.cmp[first], self.constant[first]):
+                return None
+            if [key for key in self.in_keys[v] if key[0] == 'conbit'] != conbits:
+                return None
+        return self.cmp[first], self.constant[first]
+
+    def remove(self, nodes: List[int]):
+        """
+        Remove the nodes and connect their neighbours on every wire, like `remove_nodes` with keep_edge.
+        """
+        for v in nodes:
+            if not self.alive[v]:
+                continue
+            for key in self.in_keys[v]:
+                source, _ = self.in_links[v][key]
+                target = self.out_links[v].get(key)
+                if target is None:
+                    del self.out_links[source][key]
+                else:
+                    self._link(source, target, key, self.in_links[target][key][1])
+            self._tombstone(v)
+
+    def commit(self):
+        """
+        Apply the new nodes, the rewired edges and the removed nodes to the graph of the IR.
+        """
+        g = self.ir.dag
+        n = self._vcount
+        added = range(n, len(self.alive))
+        if len(added) > 0:
+            g.add_vertices(len(added))
+            new_vs = g.vs[n:]
+            new_vs['type'] = self.type[n:]
+            new_vs['name'] = self.name[n:]
+            new_vs['qubits'] = self.qubits[n:]
+            for attribute, values in (('params', self.params), ('cmp', self.cmp), ('constant', self.constant)):
+                if any(value is not None for value in values[n:]):
+                    new_vs[attribute] = values[n:]
+
+        rewired = sorted(v for v in self._rewired if self.alive[v])
+        g.delete_edges([eid for v in rewired if v < n for eid in self._in_eids[v]])
+        edges = []
+        edge_values = {attribute: [] for attribute in WIRE_ATTRIBUTES}
+        for v in rewired:
+            for key in self.in_keys[v]:
+                source, attribute = self.in_links[v][key]
+                edges.append((source, v))
+                for a in WIRE_ATTRIBUTES:
+                    edge_values[a].append(key[1] if a == attribute else None)
+        if edges:
+            present = g.es.attributes()
+            g.add_edges(edges, attributes={a: values for a, values in edge_values.items()
+                                           if a in present or any(value is not None for value in values)})
+
+        g.delete_vertices([v for v in range(len(self.alive)) if not self.alive[v]])
+        self.ir.mark_modified()
@@ -16,6 +16,9 @@ import autograd.numpy as anp
 from autograd.extend import vspace
 from autograd.wrap_util import unary_to_nary
 from autograd import elementwise_grad
+import numpy as np
+
+from spinqit.model.parameter import Parameter
 
 
 class qgrad:
@@ -40,3 +43,56 @@ class qgrad:
         if vspace(ans).iscomplex:
             return elementwise_grad(lambda x: anp.real(fun(x)))(x), ans
         return vjp(vspace(ans).ones()), ans
+
+
+class TrainingStep:
+    """
+    The value and gradients of a QLayer, prepared once and reused by every step of an optimization.
+
+    `qgrad` traces the QLayer with autograd and asks the backend for a new gradient function on every call.
+    The TrainingStep keeps the gradient function of the backend and calls the backward function right after
+    the forward pass, so a step only updates the parameters, executes the circuit and runs the grad_method.
+
+    Args:
+        qlayer (QLayer): The QLayer with one measure_op. The QLayer with a list of measure_op is still evaluated
+            with `qgrad`.
+
+    Example:
+        step = TrainingStep(qlayer)
+        loss, grads = step.value_and_grad(*params)
+    """
+
+    def __init__(self, qlayer):
+        self.qlayer = qlayer
+        if isinstance(qlayer.measure_op, list):
+            self._value_and_grad_fn = None
+        else:
+            self._value_and_grad_fn = qlayer.backend.get_value_and_grad_fn(qlayer.ir,
+                                                                           qlayer.config,
+                                                                           qlayer.measure_op,
+                                                                           qlayer.place_holder,
+                                                                           qlayer.grad_method)
+
+    def value_and_grad(self, *params):
+        """
+        Returns:
+            The loss and the tuple of gradients w.r.t. every parameter, the same as `qgrad.forward` and `qgrad`.
+        """
+        if self._value_and_grad_fn is None:
+            grad_fn = qgrad(self.qlayer)
+            grads = grad_fn(*params)
+            return grad_fn.forward, grads
+
+        if len(params) != len(self.qlayer.place_holder):
+            raise ValueError(
+                f'The length of circuits parameter is wrong. '
+                f'Expected {len(self.qlayer.place_holder)}, but got {len(params)}.'
+            )
+        loss, backward_fn = self._value_and_grad_fn(params)
+        if isinstance(loss, dict):
+            raise ValueError(
+                'The `count` measurement is not differentiable.'
+            )
+        dy = np.ones_like(loss, dtype=float)
+        grads = backward_fn(dy) if callable(backward_fn) else backward_fn * dy
+        return Parameter(loss), tuple(Parameter(g) for g in grads)
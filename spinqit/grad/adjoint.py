@@ -0,0 +1,180 @@
+# Copyright 2023 SpinQ Technology Co., Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import warnings
+from typing import Iterable, List
+
+import numpy as np
+from autograd import elementwise_grad as egrad
+
+from spinqit.compiler.ir import IntermediateRepresentation as IR
+from spinqit.utils.function import requires_grad
+
+# The frequencies of the gate parameters, every entry of the gate matrix is a trigonometric
+# polynomial of this frequency in the parameter.
+GATE_FREQUENCIES = {
+    'Rx': (0.5,),
+    'Ry': (0.5,),
+    'Rz': (0.5,),
+    'P': (1.,),
+    'U': (0.5, 1., 1.),
+}
+
+
+def _value(p):
+    return p.item() if hasattr(p, 'item') else p
+
+
+def step_matrix(ir, step, node_params):
+    """
+    The matrix of a plan step and its parameters as python numbers, the parameters are None for
+    the gates without parameters and for the unitary nodes.
+    """
+    if step.type == 7:
+        return IR.get_unitary(ir.dag.vs[step.vid]), None
+    node_params = [_value(p) for p in node_params] if node_params else None
+    gate = IR.get_basis_gate(step.name)
+    mat = gate.get_matrix(node_params) if node_params else gate.get_matrix()
+    return mat, node_params
+
+
+def apply_gate_to_state(state: np.ndarray, gate: np.ndarray,
+                        qubit_idx: List[int], num_qubits: int) -> np.ndarray:
+    """
+    Apply a gate to a state of shape [2] * num_qubits, the qubit 0 is the first axis.
+    """
+    if not isinstance(qubit_idx, Iterable):
+        qubit_idx = [qubit_idx]
+
+    shape = [2] * (len(qubit_idx) * 2)
+    mat = np.reshape(gate, shape)
+    axes = (np.arange(-len(qubit_idx), 0), qubit_idx)
+    tdot = np.tensordot(mat, state, axes)
+
+    unused_idxs = [idx for idx in range(num_qubits) if idx not in qubit_idx]
+    perm = list(qubit_idx) + unused_idxs
+    inv_perm = np.argsort(perm)  # argsort gives inverse permutation
+    return np.transpose(tdot, inv_perm)
+
+
+def probability_weights(dy, qubit_num, mqubits=None) -> np.ndarray:
+    """
+    The diagonal of the observable sum_i dy_i P_i, where P_i projects on the outcome i of the measured qubits
+    in ascending order. The vector-Jacobian product of the probabilities is the gradient of its expectation value.
+    """
+    dy = np.asarray(dy).real.reshape(-1)
+    if mqubits is None:
+        return dy
+    shape = [2 if q in mqubits else 1 for q in range(qubit_num)]
+    return np.broadcast_to(dy.reshape(shape), [2] * qubit_num).reshape(-1)
+
+
+def derivative_matrix(label, params, j):
+    """
+    The derivative of the gate matrix w.r.t. its j-th parameter.
+    For a parameter of frequency w, dM/dx = w / 2 * (M(x + pi / (2w)) - M(x - pi / (2w))) is exact.
+    """
+    if label not in GATE_FREQUENCIES:
+        raise ValueError(
+            f'The gate {label} is not supported by the `adjoint_differentiation` grad_method'
+        )
+    frequency = GATE_FREQUENCIES[label][j]
+    shift = np.pi / (2 * frequency)
+    gate = IR.get_basis_gate(label)
+    plus = list(params)
+    plus[j] = plus[j] + shift
+    minus = list(params)
+    minus[j] = minus[j] - shift
+    return frequency / 2 * (gate.get_matrix(plus) - gate.get_matrix(minus))
+
+
+def param_coefficients(step, j, funcs, vertex_params, total_params):
+    """
+    The derivatives of the j-th parameter of a plan step w.r.t. the total parameters.
+    The parameters of the gates inlined from a caller node are the callee functions of the caller
+    parameters, the chain rule is applied through both of them.
+
+    Returns:
+        A list like total_params, or None if the parameter is not trainable.
+    """
+    if funcs is None or not funcs[step.vid]:
+        return None
+    vertex_funcs = funcs[step.vid]
+    if step.resolver is None:
+        f = vertex_funcs[j]
+        if not callable(f) or not requires_grad(vertex_params[j]):
+            return None
+        return egrad(f)(total_params)
+
+    if not any(callable(f) and requires_grad(p) for f, p in zip(vertex_funcs, vertex_params)):
+        return None
+
+    def gate_param(x):
+        values = [f(x) if callable(f) else f for f in vertex_funcs]
+        return step.resolver(values)[j]
+
+    with warnings.catch_warnings():
+        # The callee parameters which do not depend on the caller parameters have zero gradients
+        warnings.simplefilter('ignore')
+        return egrad(gate_param)(total_params)
+
+
+def adjoint_backward(ir, ket, bra, coeff_params, dy, apply_gate, inner, params=None):
+    """
+    Run the circuit backward from the final state, and accumulate the gradients of the expectation value
+    <psi|H|psi> gate by gate. Only two states are kept besides the one being differentiated.
+
+    Args:
+        ir: The IR which has been executed.
+        ket: The final state |psi>.
+        bra: H|psi>.
+        coeff_params: The total parameters, used to calculate the coefficients with autograd.
+        dy: The gradient of the loss w.r.t. the expectation value.
+        apply_gate: apply_gate(state, matrix, qubits) applies a numpy matrix to the state.
+        inner: inner(bra, ket) returns the real part of <bra|ket>.
+        params: The parameters of every vertex in the forward pass, default to the current parameters of the IR.
+
+    Returns:
+        The list of gradients w.r.t. coeff_params.
+    """
+    grads = [np.zeros_like(param, dtype=float) for param in coeff_params]
+    if not dy.shape:
+        dy = dy.reshape(-1)
+
+    plan = ir.compile_plan()
+    funcs = ir.dag.vs['func'] if 'func' in ir.dag.vs.attributes() else None
+    if params is None and 'params' in ir.dag.vs.attributes():
+        params = ir.params_snapshot()
+    vertex_params = params
+
+    for step, node_params in reversed(plan.bind(ir.dag, params)):
+        if step.name == 'StateVector':
+            # The gates before the initial state do not change the final state
+            break
+        mat, node_params = step_matrix(ir, step, node_params)
+        # apply the dagger gate to the ket
+        ket = apply_gate(ket, mat.conj().T, step.qubits)
+
+        if node_params is not None and vertex_params is not None:
+            for j in range(len(node_params)):
+                coeffs = param_coefficients(step, j, funcs, vertex_params[step.vid], coeff_params)
+                if coeffs is None or all(np.allclose(c, 0) for c in coeffs):
+                    continue
+                d_mat = derivative_matrix(step.name, node_params, j)
+                g = np.asarray(2 * inner(bra, apply_gate(ket, d_mat, step.qubits))).reshape(-1)
+                for key, coeff in enumerate(coeffs):
+                    grads[key] += coeff * np.tensordot(g, dy.real, axes=[[0], [0]])
+
+        # apply the dagger gate to the bra
+        bra = apply_gate(bra, mat.conj().T, step.qubits)
+    return grads
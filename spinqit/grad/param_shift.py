@@ -15,47 +15,88 @@
 import numpy as np
 from autograd import elementwise_grad as egrad
 from spinqit.utils.function import requires_grad
+from spinqit.backend.basebackend import BaseBackend
+
+def shifted_parameters(ir, shift, params=None):
+    """
+    Enumerate the trainable gate parameters and their shifted values.
+
+    Args:
+        params: The parameters of every vertex, default to the current parameters of the IR.
+
+    Returns:
+        funcs: The parameter function of every trainable gate parameter.
+        shifts: The tuples (vid, index, value) for `BaseBackend.evaluate_shifted`,
+            the parameter shifted by +shift and -shift for every function in order.
+    """
+    if params is None:
+        params = ir.params_snapshot()
+    funcs = []
+    shifts = []
+    if 'func' not in ir.dag.vs.attributes():
+        return funcs, shifts
+    for vid, func in enumerate(ir.dag.vs['func']):
+        if func is not None:
+            for i, param in enumerate(params[vid]):
+                if callable(func[i]) and requires_grad(param):
+                    funcs.append(func[i])
+                    shifts.append((vid, i, param + shift))
+                    shifts.append((vid, i, param - shift))
+    return funcs, shifts
+
+
+def evaluate_shifted(backend, ir, config, measure_op, shifts, params=None):
+    """
+    Evaluate all the shifted circuits with the backend, the backends without `evaluate_shifted`
+    evaluate them one after another.
+    """
+    if hasattr(backend, 'evaluate_shifted'):
+        return backend.evaluate_shifted(ir, config, measure_op, shifts, params=params)
+    return BaseBackend.evaluate_shifted(backend, ir, config, measure_op, shifts, params=params)
+
 
 def parameter_shift(ir, params, config, backend, measure_op):
+    # The gate parameters of the forward pass, the IR may be updated again before the backward pass.
+    snapshot = ir.params_snapshot()
 
     def backward_fn(dy):
-        if measure_op.mtype == 'state':
-            raise ValueError('The `param_shift` grad method does not support measurement of state')
-        if measure_op.mtype == 'count':
-            raise ValueError('The measurement of count does not support gradients calculated')
-
-        if not dy.shape:
-            dy = dy.reshape(-1)
+        measure_ops, dys = (measure_op, dy) if isinstance(measure_op, list) else ([measure_op], [dy])
+        for op in measure_ops:
+            if op.mtype == 'state':
+                raise ValueError('The `param_shift` grad method does not support measurement of state')
+            if op.mtype == 'count':
+                raise ValueError('The measurement of count does not support gradients calculated')
+        dys = [np.asarray(d).reshape(-1) if not np.shape(d) else np.asarray(d) for d in dys]
 
         grads = []
         for param in params:
             grads.append(np.zeros_like(param, dtype=param.dtype))
 
         r = 0.5
-        for v in ir.dag.vs:
-            if 'func' in v.attributes() and v['func'] is not None:
-                func = v['func']
-                origin_param = [x for x in v['params']]
-                for i in range(len(origin_param)):
-                    if callable(func[i]) and requires_grad(origin_param[i]):
-                        coeffs = egrad(func[i])(params)
-                        v['params'][i] = origin_param[i] + np.pi / (4 * r)
-                        value1, _ = backend.evaluate(ir, config, measure_op)
-                        v['params'][i] = origin_param[i] - np.pi / (4 * r)
-                        value2, _ = backend.evaluate(ir, config, measure_op)
-                        v['params'][i] = origin_param[i]
-                        g = (value1 - value2)
-                        if np.allclose(g, 0):
-                            continue
-                        if not g.shape:
-                            g = g.reshape(-1)
-
-                        for idx, coeff in enumerate(coeffs):
-                            if np.allclose(coeff, 0):
-                                continue
-                            grads[idx] += r * coeff * (
-                                np.tensordot(g.real, dy.real, axes=[[0], [0]])
-                            )
+        # All the shifted circuits are independent, they are dispatched to the backend together.
+        # Every shifted circuit gives the values of all the measure_ops.
+        funcs, shifts = shifted_parameters(ir, np.pi / (4 * r), snapshot)
+        values = evaluate_shifted(backend, ir, config, measure_op, shifts, snapshot)
+        if not isinstance(measure_op, list):
+            values = [[v] for v in values]
+        for k, func in enumerate(funcs):
+            vjp = None
+            for plus, minus, d in zip(values[2 * k], values[2 * k + 1], dys):
+                g = np.asarray(plus - minus)
+                if np.allclose(g, 0):
+                    continue
+                if not g.shape:
+                    g = g.reshape(-1)
+                term = np.tensordot(g.real, d.real, axes=[[0], [0]])
+                vjp = term if vjp is None else vjp + term
+            if vjp is None:
+                continue
+
+            coeffs = egrad(func)(params)
+            for idx, coeff in enumerate(coeffs):
+                if np.allclose(coeff, 0):
+                    continue
+                grads[idx] += r * coeff * vjp
         return grads
 
-    return backward_fn
\ No newline at end of file
+    return backward_fn
@@ -17,13 +17,17 @@ try:
     IMPORTED = True
 except ImportError:
     IMPORTED = False
+import numpy as onp
 from autograd import elementwise_grad as egrad
+from scipy import sparse
 
 from spinqit import Parameter
-from spinqit.utils.function import requires_grad
+from spinqit.primitive.pauli_expectation import PauliSumOperator
+from .adjoint import adjoint_backward, probability_weights
+from .param_shift import shifted_parameters
 
 
-def grad_func(ir, params, config, backend, measure_op, res, grad_method):
+def grad_func(ir, params, config, backend, measure_op, res, grad_method, result=None):
     if not IMPORTED:
         raise ImportError(
             'torch has not install, use `pip install torch`'
@@ -32,6 +36,8 @@ def grad_func(ir, params, config, backend, measure_op, res, grad_method):
         backward_fn = backprop(res, params, measure_op)
     elif grad_method == 'param_shift':
         backward_fn = parameter_shift(ir, params, config, backend, measure_op)
+    elif grad_method == 'adjoint_differentiation':
+        backward_fn = adjoint_differentiation(ir, params, config, backend, measure_op, result)
     else:
         def backward_fn(*args):
             raise ValueError(
@@ -43,11 +49,15 @@ def grad_func(ir, params, config, backend, measure_op, res, grad_method):
 def backprop(val, params_for_grad, measure_op):
 
     def backward_fn(dy):
-        if measure_op.mtype in ['count']:
+        measure_ops, vals, dys = (measure_op, val, dy) if isinstance(measure_op, list) \
+            else ([measure_op], [val], [dy])
+        if any(op.mtype in ['count'] for op in measure_ops):
             raise ValueError('The measurement of count does not support gradients calculated')
 
-        dy = torch.as_tensor(dy)
-        val.backward(dy)
+        # One backward pass through the simulation for all the outputs
+        outputs = [(v, torch.as_tensor(d)) for v, d in zip(vals, dys) if v.requires_grad]
+        if outputs:
+            torch.autograd.backward([v for v, _ in outputs], [d for _, d in outputs])
         grads = []
         for v in params_for_grad:
             if v.grad is not None:
@@ -60,45 +70,106 @@ def backprop(val, params_for_grad, measure_op):
     return backward_fn
 
 
+def adjoint_differentiation(ir, params, config, backend, measure_op, result):
+    """
+    The forward pass does not record the graph, the gradients are calculated by running the circuit
+    backward from the final state, so the memory does not grow with the number of gates.
+    """
+    # The parameters of this forward pass
+    snapshot = ir.params_snapshot()
+
+    def backward_fn(dy):
+        # The gradients of all the outputs are one pass with the cotangent state sum_k dy_k O_k |psi>
+        measure_ops, dys = (measure_op, dy) if isinstance(measure_op, list) else ([measure_op], [dy])
+        for op in measure_ops:
+            if op.mtype not in ['expval', 'prob']:
+                raise ValueError(
+                    'The adjoint differentiation method only support the `expval` and `prob` measurement, '
+                    'and the hamiltonian should be `matrix`, `sparse matrix` or `PauliSumOperator`, '
+                    'may use spinqit.generate_hamiltonian_matrix or spinqit.PauliSumOperator. '
+                    'For more details, see spinqit.algorithm.loss.measurement.MeasureOp.'
+                )
+            if isinstance(op.hamiltonian, list) or result is None:
+                raise ValueError(
+                    'The `adjoint_differentiation` grad_method only support the matrix hamiltonian'
+                )
+
+        def apply_gate(state, gate, qubits):
+            gate = torch.as_tensor(gate, dtype=state.dtype, device=state.device)
+            return backend.simulator._apply_gate(state, gate, list(qubits), ir.qnum)
+
+        def inner(bra, ket):
+            return torch.vdot(bra, ket).real.item()
+
+        with torch.no_grad():
+            ket = result.states
+            bra = torch.zeros_like(ket)
+            for op, d in zip(measure_ops, dys):
+                d = onp.asarray(d)
+                if op.mtype == 'prob':
+                    mqubits = op.mqubits if op.mqubits is not None else config.mqubits
+                    weights = probability_weights(d, ir.qnum, mqubits)
+                    bra = bra + torch.as_tensor(weights, device=ket.device).to(ket.dtype) * ket
+                    continue
+                hamiltonian = op.hamiltonian
+                if isinstance(hamiltonian, PauliSumOperator):
+                    h_ket = hamiltonian.apply(ket)
+                else:
+                    if isinstance(hamiltonian, sparse.csr_matrix):
+                        hamiltonian = backend._scipy_sparse_mat_to_torch_sparse_tensor(hamiltonian)
+                    else:
+                        hamiltonian = torch.as_tensor(hamiltonian)
+                    h_ket = hamiltonian.to(ket.device, ket.dtype) @ ket
+                bra = bra + float(d.real.reshape(())) * h_ket
+            coeff_params = [Parameter(p.cpu().detach().numpy()) for p in params]
+            return adjoint_backward(ir, ket, bra, coeff_params, onp.ones(1),
+                                    apply_gate, inner, snapshot)
+
+    return backward_fn
+
+
 def parameter_shift(ir, params, config, backend, measure_op):
+    # The parameters of this forward pass
+    snapshot = ir.params_snapshot()
+
     def backward_fn(dy):
-        if measure_op.mtype == 'state':
-            raise ValueError('The `param_shift` grad method does not support measurement of state')
-        if measure_op.mtype == 'count':
-            raise ValueError('The measurement of count does not support gradients calculated')
-        if not dy.shape:
-            dy = dy.reshape(-1)
-        dy = torch.as_tensor(dy)
+        measure_ops, dys = (measure_op, dy) if isinstance(measure_op, list) else ([measure_op], [dy])
+        for op in measure_ops:
+            if op.mtype == 'state':
+                raise ValueError('The `param_shift` grad method does not support measurement of state')
+            if op.mtype == 'count':
+                raise ValueError('The measurement of count does not support gradients calculated')
+        dys = [torch.as_tensor(d).reshape(-1) if not d.shape else torch.as_tensor(d) for d in dys]
         grads = []
         for param in params:
             grads.append(torch.zeros_like(param, dtype=param.dtype))
         params_for_grad = [Parameter(p.cpu().detach()) for p in params]
         r = 0.5
         with torch.no_grad():
-            for v in ir.dag.vs:
-                if 'func' in v.attributes() and v['func'] is not None:
-                    func = v['func']
-                    origin_param = [x for x in v['params']]
-                    for i in range(len(origin_param)):
-                        if callable(func[i]) and requires_grad(origin_param[i]):
-                            v['params'][i] = origin_param[i] + torch.pi / (4 * r)
-                            value1, _ = backend.evaluate(ir, config, measure_op)
-                            v['params'][i] = origin_param[i] - torch.pi / (4 * r)
-                            value2, _ = backend.evaluate(ir, config, measure_op)
-                            v['params'][i] = origin_param[i]
-                            g = (value1 - value2)
-                            coeffs = [torch.as_tensor(x, dtype=g.dtype) for x in (egrad(func[i])(params_for_grad))]
-                            if torch.allclose(g, torch.tensor(0., dtype=g.dtype)):
-                                continue
-                            if not g.shape:
-                                g = g.reshape(-1)
-
-                            for idx, coeff in enumerate(coeffs):
-                                if torch.allclose(coeff, torch.tensor(0., dtype=g.dtype)):
-                                    continue
-                                grads[idx] += r * coeff * (
-                                    torch.tensordot(g.real, dy.real, dims=[[0], [0]])
-                                )
+            # The shifted circuits are simulated together with a batch dimension.
+            funcs, shifts = shifted_parameters(ir, torch.pi / (4 * r), snapshot)
+            # Every shifted circuit gives the values of all the measure_ops.
+            values = backend.evaluate_shifted(ir, config, measure_op, shifts, params=snapshot)
+            if not isinstance(measure_op, list):
+                values = [[v] for v in values]
+            for k, func in enumerate(funcs):
+                vjp = None
+                for plus, minus, d in zip(values[2 * k], values[2 * k + 1], dys):
+                    g = torch.as_tensor(plus - minus)
+                    if torch.allclose(g, torch.tensor(0., dtype=g.dtype)):
+                        continue
+                    if not g.shape:
+                        g = g.reshape(-1)
+                    term = torch.tensordot(g.real, d.real.to(g.real.dtype), dims=[[0], [0]])
+                    vjp = term if vjp is None else vjp + term
+                if vjp is None:
+                    continue
+                coeffs = [torch.as_tensor(x, dtype=vjp.dtype) for x in (egrad(func)(params_for_grad))]
+
+                for idx, coeff in enumerate(coeffs):
+                    if torch.allclose(coeff, torch.tensor(0., dtype=vjp.dtype)):
+                        continue
+                    grads[idx] += r * coeff * vjp
             return [g.cpu().numpy() for g in grads]
 
     return backward_fn
@@ -12,6 +12,6 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from .utils import *
-from .qlayer import to_qlayer
+from .qlayer import to_qlayer, QLayer
 from .torch_interface import QuantumFunction as TorchQuantumFunction
 from .torch_interface import QuantumModule as TorchQuantumModule
\ No newline at end of file
@@ -13,10 +13,17 @@
 # limitations under the License.
 from copy import deepcopy
 
+import numpy as np
+
 from spinqit import Circuit
 from spinqit.backend import check_backend_and_config
 from spinqit.compiler import get_compiler, IntermediateRepresentation
 
+# The backends and interfaces which evaluate a list of measure_ops from one execution
+MULTI_OUTPUT_BACKENDS = ('spinq', 'torch')
+MULTI_OUTPUT_INTERFACES = ('spinq', 'torch')
+
+
 class QLayer:
     """
     QLayer is specific for the Quantum machine learning or classic-quantum hybrid machine learning in spinqit.
@@ -25,9 +32,11 @@ class QLayer:
     Args:
         circuit (Circuit, IntermediateRepresentation): The quantum circuit. Support class `Circuit` or `IR`.
         measure (MeasureOp): Defined which type of measured results will return.
+            With a list of MeasureOp on the `spinq` and `torch` backends, the circuit is simulated once for all
+            the outputs, and their gradients are calculated together.
         interface (str): Default to `spinq`, For now, support `spinq`, `torch`, `paddle`, `tf` interface.
         grad_method (str):
-            For `torch` backend support `backprop`
+            For `torch` backend support `backprop`, `param_shift`, `adjoint_differentiation`
             For `spinq` backend, support `param_shift`, `adjoint_differentiation`
         optimization_level(int): Defined the level for optimize the IR while compiling. Default to 0
     """
@@ -77,7 +86,46 @@ class QLayer:
             raise ValueError
         return self.process_with_measure_op(_execute, *new_params)
 
+    def batch(self, *params_batch, batch_size: int = None, num_workers: int = None):
+        """
+        Evaluate the circuit for many parameter sets at once, without gradients.
+
+        Args:
+            *params_batch: One array for every circuit parameter, the parameter sets are stacked along the first axis.
+            batch_size (int): For `torch` backend, the number of parameter sets simulated together. Default to all.
+            num_workers (int): For `spinq` backend, the number of threads. Default to the number of CPUs,
+                and one thread for the circuits with less than 12 qubits.
+
+        Returns:
+            The stacked results with the parameter sets along the first axis,
+            a list of them if the measure is a list. On the `spinq` and `torch` backends the outputs of the list
+            are derived from one simulation of every parameter set, the other backends run the batch for every output.
+        """
+        if len(params_batch) != len(self.place_holder):
+            raise ValueError(
+                f'The length of circuits parameter is wrong. '
+                f'Expected {len(self.place_holder)}, but got {len(params_batch)}.'
+            )
+        params_batch = [np.asarray(p) for p in params_batch]
+        if len({len(p) for p in params_batch}) > 1:
+            raise ValueError(
+                f'The parameters in a batch should have the same length along the first axis, '
+                f'but got {[len(p) for p in params_batch]}.'
+            )
+
+        def evaluate(measure_op):
+            return self.backend.evaluate_batch(self.ir, self.config, measure_op, self.place_holder,
+                                               params_batch, batch_size=batch_size, num_workers=num_workers)
+
+        if isinstance(self.measure_op, list) and self.backend_mode not in MULTI_OUTPUT_BACKENDS:
+            return [evaluate(op) for op in self.measure_op]
+        return evaluate(self.measure_op)
+
     def process_with_measure_op(self, execute, *new_params):
+        if isinstance(self.measure_op, list) and self.backend_mode in MULTI_OUTPUT_BACKENDS \
+                and self.interface in MULTI_OUTPUT_INTERFACES:
+            # Simulate once for all the measure_ops, the gradients are one vector-Jacobian product
+            return list(execute(self, *new_params))
         if isinstance(self.measure_op, list):
             origin_measure_op = self.measure_op
             res = []
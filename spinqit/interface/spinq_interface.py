@@ -52,6 +52,9 @@ def execute(qlayer, *params):
                                                              qlayer.grad_method)(params=params)
     setattr(qlayer, 'backward_fn', backward_fn)
 
+    if isinstance(qlayer.measure_op, list):
+        # The outputs of a list of measure_ops share one backward_fn
+        return tuple(v if isinstance(v, dict) else Parameter(v) for v in loss)
     if not isinstance(loss, dict):
         loss = Parameter(loss)
     return loss
@@ -82,7 +85,9 @@ def execute_vjp(ans, qlayer, *params, **kwargs):
     delattr(qlayer, 'backward_fn')
 
     def grad_fn(g):
-        if callable(backward_fn):
+        if isinstance(g, (tuple, list)):
+            grads = backward_fn([np.conj(x) for x in g])
+        elif callable(backward_fn):
             grads = backward_fn(g.conj())
         else:
             grads = backward_fn * g.conj()
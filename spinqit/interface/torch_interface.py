@@ -40,20 +40,27 @@ class QuantumFunction(Function):
         for p in params:
             if p.is_cuda:
                 ctx.torch_device = p.get_device()
+        ctx.backward = backward
+        ctx.multiple = isinstance(qlayer.measure_op, list)
+        if ctx.multiple:
+            # The outputs of a list of measure_ops share one backward
+            return tuple(v if isinstance(v, dict) else torch.as_tensor(
+                v,
+                device=ctx.torch_device,
+                dtype=qlayer.dtype if qlayer.dtype is not None else None,
+            ) for v in loss)
         if not isinstance(loss, dict):
             loss = torch.as_tensor(
                 loss,
                 device=ctx.torch_device,
                 dtype=qlayer.dtype if qlayer.dtype is not None else None,
             )
-
-        ctx.backward = backward
         return loss
 
     @staticmethod
-    def backward(ctx, grad_output):
+    def backward(ctx, *grad_outputs):
         backward = ctx.backward
-        gradients = backward(grad_output)
+        gradients = backward(list(grad_outputs) if ctx.multiple else grad_outputs[0])
         g_params = tuple(torch.as_tensor(v, device=ctx.torch_device) for v in gradients)
         return None, *g_params,
 
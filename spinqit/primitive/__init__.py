@@ -18,7 +18,8 @@ from .pauli_builder import PauliBuilder
 from .reciprocal import Reciprocal
 from .vector_encoding import amplitude_encoding, angle_encoding, iqp_encoding
 from .power import generate_power_gate
-from .pauli_expectation import calculate_pauli_expectation, generate_hamiltonian_matrix, pauli_decompose
+from .pauli_expectation import calculate_pauli_expectation, calculate_pauli_expectation_from_state, \
+    generate_hamiltonian_matrix, pauli_decompose, group_qubit_wise_commuting, PauliSumOperator
 from .ae_Q_builder import QOperatorBuilder
 from .multi_controlled_gate_builder import MultiControlledGateBuilder
 from .uniformly_controlled_gate_builder import UniformlyControlledGateBuilder
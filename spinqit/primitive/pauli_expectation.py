@@ -18,6 +18,7 @@ from functools import reduce
 import numpy as np
 from scipy import sparse
 from spinqit import I, X, Y, Z
+from spinqit.utils.function import get_interface
 
 
 def calculate_pauli_expectation(pauli_string: str, probabilities: Dict) -> float:
@@ -47,6 +48,196 @@ def calculate_pauli_expectation(pauli_string: str, probabilities: Dict) -> float
     return expect_value
 
 
+def _pauli_masks(pauli_string: str, qubit_num: int, qubits: List = None):
+    """
+    Encode a Pauli string as bit masks over the state vector index. The qubit 0 is the most
+    significant bit, which is the same order as the state vector returned by the simulators.
+
+    Returns:
+        The x mask (bits flipped by X/Y), the z mask (bits with a Z/Y phase) and the number of Y.
+    """
+    if qubits is None:
+        qubits = list(range(len(pauli_string)))
+    if len(qubits) != len(pauli_string):
+        raise ValueError(
+            f'The length of pauli string `{pauli_string}` does not match the measured qubits {qubits}'
+        )
+    x_mask, z_mask, y_num = 0, 0, 0
+    for ch, q in zip(pauli_string, qubits):
+        bit = 1 << (qubit_num - 1 - q)
+        ch = ch.upper()
+        if ch == 'X':
+            x_mask |= bit
+        elif ch == 'Y':
+            x_mask |= bit
+            z_mask |= bit
+            y_num += 1
+        elif ch == 'Z':
+            z_mask |= bit
+        elif ch != 'I':
+            raise ValueError('The input string is not a Pauli string')
+    return x_mask, z_mask, y_num
+
+
+def _parity_sign(indices: np.ndarray, z_mask: int) -> np.ndarray:
+    """
+    The sign (-1)^popcount(index & z_mask) for every index of the state vector.
+    """
+    parity = indices & z_mask
+    shift = 32
+    while shift:
+        parity ^= parity >> shift
+        shift >>= 1
+    return 1 - 2 * (parity & 1)
+
+
+def calculate_pauli_expectation_from_state(pauli_string_list: List, state, qubits: List = None) -> float:
+    """
+    Calculate the expectation of a list of weighted Pauli strings directly from the state vector,
+    so that the circuit only needs to be simulated once for the whole hamiltonian.
+
+    For P = i^{#Y} X^x Z^z, <psi|P|psi> = i^{#Y} * sum_k conj(psi[k ^ x]) * (-1)^{|k & z|} * psi[k].
+
+    Args:
+        pauli_string_list: The hamiltonian in the form of [(pauli_string, coefficient), ...]
+        state: The state vector, qubit 0 is the most significant bit of the index.
+        qubits: The qubits the characters of the pauli strings act on, default to the first qubits.
+    """
+    psi = np.asarray(state, dtype=complex).reshape(-1)
+    qubit_num = int(np.log2(len(psi)))
+    indices = np.arange(len(psi))
+    probs = np.abs(psi) ** 2
+    sign_cache = {}
+
+    expect_value = 0.0
+    for pauli_string, coeff in pauli_string_list:
+        x_mask, z_mask, y_num = _pauli_masks(pauli_string, qubit_num, qubits)
+        if z_mask not in sign_cache:
+            sign_cache[z_mask] = _parity_sign(indices, z_mask)
+        sign = sign_cache[z_mask]
+        if x_mask == 0:
+            value = np.dot(sign, probs)
+        else:
+            value = (1j ** y_num) * np.vdot(psi[indices ^ x_mask], sign * psi)
+        expect_value += coeff * np.real(value)
+    return expect_value
+
+
+class PauliSumOperator:
+    """
+    A hamiltonian of weighted Pauli strings which is applied to the state vector with bit flips and phases,
+    the 2^n x 2^n matrix is never built. It can be used as the hamiltonian of `expval` in place of
+    `generate_hamiltonian_matrix`, for the qubit numbers where the matrix does not fit in memory.
+
+    The terms with the same X part permute the state in the same way, they are applied together:
+    (H psi)[k] = sum_x (D_x psi)[k ^ x], with D_x[k] = sum_{terms} coeff * i^{#Y} * (-1)^{|k & z|}.
+
+    Args:
+        pauli_string_list: The hamiltonian in the form of [(pauli_string, coefficient), ...]
+
+    Example:
+        hamiltonian = PauliSumOperator([('ZZ', 1.0), ('XI', 0.5)])
+        value = hamiltonian.expectation(state)
+    """
+    def __init__(self, pauli_string_list: List):
+        if len(pauli_string_list) == 0:
+            raise ValueError('The pauli string list of the PauliSumOperator should not be empty')
+        self.pauli_string_list = list(pauli_string_list)
+        self.qubit_num = len(self.pauli_string_list[0][0])
+        self._groups = {}
+        for pauli_string, coeff in self.pauli_string_list:
+            if len(pauli_string) != self.qubit_num:
+                raise ValueError(
+                    f'The pauli strings should have the same length {self.qubit_num}, but got `{pauli_string}`'
+                )
+            x_mask, z_mask, y_num = _pauli_masks(pauli_string, self.qubit_num)
+            self._groups.setdefault(x_mask, []).append((z_mask, coeff * 1j ** y_num))
+
+    @property
+    def shape(self):
+        return 2 ** self.qubit_num, 2 ** self.qubit_num
+
+    def _diagonal(self, terms, indices):
+        diag = np.zeros(len(indices), dtype=complex)
+        for z_mask, coeff in terms:
+            diag += coeff * _parity_sign(indices, z_mask)
+        return diag
+
+    def apply(self, state):
+        """
+        Apply the hamiltonian to a state vector, or a batch of them along the leading dimensions.
+        The torch tensors are kept on their device and in the autograd graph.
+        """
+        indices = np.arange(2 ** self.qubit_num)
+        if get_interface(state) == 'torch':
+            import torch
+
+            def convert(diag, perm):
+                return (torch.as_tensor(diag, dtype=state.dtype, device=state.device),
+                        torch.as_tensor(perm, device=state.device))
+        else:
+            state = np.asarray(state, dtype=complex)
+
+            def convert(diag, perm):
+                return diag, perm
+
+        if state.shape[-1] != len(indices):
+            raise ValueError(
+                f'The state of {state.shape[-1]} amplitudes does not match the {self.qubit_num} qubits hamiltonian'
+            )
+        result = 0
+        for x_mask, terms in self._groups.items():
+            diag, perm = convert(self._diagonal(terms, indices), indices ^ x_mask)
+            part = diag * state
+            result = result + (part[..., perm] if x_mask else part)
+        return result
+
+    def expectation(self, state):
+        """
+        The expectation value <psi|H|psi>, one value for every state in a batch.
+        """
+        h_state = self.apply(state)
+        if get_interface(state) == 'torch':
+            return (state.conj() * h_state).sum(-1).real
+        return np.real((np.asarray(state, dtype=complex).conj() * h_state).sum(-1))
+
+    def __matmul__(self, state):
+        return self.apply(state)
+
+    def to_matrix(self) -> sparse.csr_matrix:
+        return generate_hamiltonian_matrix(self.pauli_string_list)
+
+
+def group_qubit_wise_commuting(pauli_string_list: List) -> List:
+    """
+    Partition the pauli strings into qubit-wise commuting groups with a greedy (largest first) coloring,
+    the terms in one group can be measured with one circuit.
+    Two pauli strings are qubit-wise commuting if on every qubit the characters are equal or one of them is `I`.
+
+    Returns:
+        A list of (basis_string, [(pauli_string, coefficient), ...]). The basis string is the
+        measurement basis shared by the whole group.
+
+    Example:
+        group_qubit_wise_commuting([('ZZ', 1.0), ('ZI', 0.5), ('XX', 0.2)])
+        # [('ZZ', [('ZZ', 1.0), ('ZI', 0.5)]), ('XX', [('XX', 0.2)])]
+    """
+    order = sorted(range(len(pauli_string_list)),
+                   key=lambda k: -sum(ch.upper() != 'I' for ch in pauli_string_list[k][0]))
+    bases = []
+    members = []
+    for k in order:
+        pauli_string = pauli_string_list[k][0].upper()
+        for g, basis in enumerate(bases):
+            if all(a == 'I' or b == 'I' or a == b for a, b in zip(basis, pauli_string)):
+                bases[g] = [b if b != 'I' else a for a, b in zip(basis, pauli_string)]
+                members[g].append(k)
+                break
+        else:
+            bases.append(list(pauli_string))
+            members.append([k])
+    return [(''.join(basis), [pauli_string_list[k] for k in sorted(member)]) for basis, member in zip(bases, members)]
+
 
 def generate_hamiltonian_matrix(pauli_string_list: List) -> sparse.csr_matrix:
     imat = sparse.identity(2, format='csr')